@@ -27,21 +27,22 @@ plotting the mean SSS change.
 import os
 import os.path as op
 
-import matplotlib.pyplot as plt
 import numpy as np
 from scipy import stats
-import pandas as pd
-import seaborn as sns
 from textwrap import wrap
 
-from match import do_match_analysis, get_dataset, load_or_generate_components
-from nilearn.image import iter_img
-from nilearn.masking import apply_mask
-from nilearn_ext.masking import flip_img_lr, get_hemi_gm_mask
+from match import do_match_analysis, get_dataset, get_dataset_key, load_or_generate_components
+from nilearn_ext.backends import BACKENDS, DEFAULT_BACKEND
+from nilearn_ext.cache import get_dataset_memory
+from nilearn_ext.checkpoint import Manifest, atomic_path
 from nilearn_ext.plotting import save_and_close, rescale
+from nilearn_ext.tracing import record_trace, stage
 from nilearn_ext.utils import get_match_idx_pair
-from nilearn_ext.decomposition import compare_RL
-from sklearn.externals.joblib import Memory
+from nilearn_ext.decomposition import compare_RL, load_components
+
+# matplotlib, seaborn, pandas (which imports matplotlib) and nilearn (via
+# nilearn_ext.masking) are imported by the functions that use them, so that
+# --help starts fast.
 
 
 SPARSITY_SIGNS = ['pos', 'neg', 'abs']
@@ -55,11 +56,11 @@ def get_sparsity_threshold(images, global_percentile=99.9):
     The global_percentile for each image in each component are obtained,
     and the minimum value is returned.
     """
+    from nilearn_ext.masking import get_masked_data
     global_thr = []
     for image in images:
         g_thr = []
-        for component_img in iter_img(image):
-            dat = component_img.get_data()
+        for dat in get_masked_data(image, hemi="wb"):
             nonzero_dat = dat[np.nonzero(dat)]
             g = stats.scoreatpercentile(np.abs(nonzero_dat), global_percentile)
             g_thr.append(g)
@@ -84,9 +85,10 @@ def get_hemi_sparsity(img, hemi, thr=0.000005):
     1-vector array with the length (n_component) of the img.
     The dict also contains n_voxels for the given hemi.
     """
+    from nilearn_ext.masking import get_masked_data
+
     # Transform img to vector for the specified hemisphere
-    gm_mask = get_hemi_gm_mask(hemi=hemi)
-    masked = apply_mask(img, gm_mask)
+    masked = get_masked_data(img, hemi=hemi)
     sparsity_dict = {}
     sparsity_dict["l1"] = np.linalg.norm(masked, axis=1, ord=1)
     sparsity_dict["vc-pos"] = (masked > thr).sum(axis=1)
@@ -108,11 +110,11 @@ def calculate_acni(img, hemi, percentile=95.0):
 
     Returns an array of length equal to the n_component of the given image.
     """
+    from nilearn_ext.masking import get_masked_data
     n_components = img.shape[3]
 
     # Get threshold values for each image based on the given percentile val.
-    gm_mask = get_hemi_gm_mask(hemi=hemi)
-    masked = apply_mask(img, gm_mask)
+    masked = get_masked_data(img, hemi=hemi)
     thr = stats.scoreatpercentile(np.abs(masked), percentile, axis=1)
     reshaped_thr = thr.reshape((n_components, 1))
 
@@ -124,6 +126,28 @@ def calculate_acni(img, hemi, percentile=95.0):
     return acni
 
 
+def _get_hpai_voxels(wb_img, percentile=95.0):
+    """
+    For each sign in SPARSITY_SIGNS, (above_r, above_l): whether each
+    homotopic R and L voxel (in the L grey matter mask, R flipped onto it)
+    of each component is above the component's percentile magnitude.
+    """
+    from nilearn_ext.masking import get_masked_data
+    n_components = wb_img.shape[3]
+
+    # Get threshold values for each image based on the given percentile val.
+    wb_masked = get_masked_data(wb_img, hemi="wb")
+    thr = stats.scoreatpercentile(np.abs(wb_masked), percentile, axis=1)
+    reshaped_thr = thr.reshape((n_components, 1))
+
+    # Use only lh_masker to ensure the same size
+    masked_r = get_masked_data(wb_img, hemi="L", flip=True)
+    masked_l = get_masked_data(wb_img, hemi="L")
+    return {"pos": (masked_r > reshaped_thr, masked_l > reshaped_thr),
+            "neg": (masked_r < -reshaped_thr, masked_l < -reshaped_thr),
+            "abs": (np.abs(masked_r) > reshaped_thr, np.abs(masked_l) > reshaped_thr)}
+
+
 def calculate_hpai(wb_img, percentile=95.0):
     """
     Compute HPAI for each component image of the given WB ICA image.
@@ -136,49 +160,80 @@ def calculate_hpai(wb_img, percentile=95.0):
     HPAI is calculated separately for positive, negative, and absolute values,
     and returned as a dictionary with SPARSITY_SIGNS as keys.
     """
-    n_components = wb_img.shape[3]
-
     hpai_d = {}
 
-    # Get threshold values for each image based on the given percentile val.
-    gm_mask = get_hemi_gm_mask(hemi="wb")
-    wb_masked = apply_mask(wb_img, gm_mask)
-    thr = stats.scoreatpercentile(np.abs(wb_masked), percentile, axis=1)
-    reshaped_thr = thr.reshape((n_components, 1))
-
     # Count the number of voxels above the threshold in each hemisphere.
-    # Use only lh_masker to ensure the same size
-    hemi_mask = get_hemi_gm_mask(hemi="L")
-    masked_r = apply_mask(flip_img_lr(wb_img), hemi_mask)
-    masked_l = apply_mask(wb_img, hemi_mask)
-    for sign in SPARSITY_SIGNS:
-        if sign == "pos":
-            voxel_r = np.sum(masked_r > reshaped_thr, axis=1)
-            voxel_l = np.sum(masked_l > reshaped_thr, axis=1)
-        elif sign == "neg":
-            voxel_r = np.sum(masked_r < -reshaped_thr, axis=1)
-            voxel_l = np.sum(masked_l < -reshaped_thr, axis=1)
-        elif sign == "abs":
-            voxel_r = np.sum(np.abs(masked_r) > reshaped_thr, axis=1)
-            voxel_l = np.sum(np.abs(masked_l) > reshaped_thr, axis=1)
-
+    for sign, (above_r, above_l) in _get_hpai_voxels(wb_img, percentile).items():
+        voxel_r = np.sum(above_r, axis=1)
+        voxel_l = np.sum(above_l, axis=1)
         hpai_d[sign] = np.divide((voxel_r - voxel_l), (voxel_r + voxel_l).astype(float))
 
     return hpai_d
 
 
+def calculate_hpai_p_values(wb_img, percentile=95.0, n_permutations=1000,
+                            random_state=42, n_jobs=-1):
+    """
+    Two-sided permutation p-values of the HPAI of each component, against
+    randomly swapping the R and L values of homotopic voxels (the same swaps
+    for all components and signs, computed at once).
+
+    Returns a dictionary with SPARSITY_SIGNS as keys, like calculate_hpai.
+    """
+    from nilearn_ext.permutation import get_p_values, sign_flip_null
+
+    voxels = _get_hpai_voxels(wb_img, percentile)
+    diffs = np.vstack([above_r.astype(np.int8) - above_l
+                       for above_r, above_l in voxels.values()])
+    totals = np.concatenate([np.sum(above_r, axis=1) + np.sum(above_l, axis=1)
+                             for above_r, above_l in voxels.values()]).astype(float)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        hpai = diffs.sum(axis=1) / totals
+        null = sign_flip_null(diffs, n_permutations=n_permutations,
+                              random_state=random_state, n_jobs=n_jobs) / totals[:, np.newaxis]
+    p_values = np.split(get_p_values(hpai, null, tail='two-sided'), len(voxels))
+    return dict(zip(voxels.keys(), p_values))
+
+
+def calculate_sss_p_values(wb_img, n_permutations=1000, random_state=42, n_jobs=-1):
+    """
+    One-sided permutation p-values of the SSS (R vs L correlation, see
+    compare_RL) of each component, against randomly pairing up R and L
+    voxels (see nilearn_ext.permutation.permutation_null_corr).
+    """
+    from nilearn_ext.masking import get_masked_data
+    from nilearn_ext.permutation import get_p_values, permutation_null_corr, row_correlations
+
+    masked_r = get_masked_data(wb_img, hemi="L", flip=True)
+    masked_l = get_masked_data(wb_img, hemi="L")
+    null = permutation_null_corr(masked_r, masked_l, n_permutations=n_permutations,
+                                 random_state=random_state, n_jobs=n_jobs)
+    return get_p_values(row_correlations(masked_r, masked_l), null, tail='greater')
+
+
 def load_or_generate_summary(images, term_scores, n_components, scoring, dataset,
                              sparsity_threshold, acni_percentile=95.0, hpai_percentile=95.0,
                              force=False, plot=True, out_dir=None,
-                             memory=Memory(cachedir='nilearn_cache')):
+                             memory=None, resolution=None,
+                             parcellation=None, backend=DEFAULT_BACKEND, n_seeds=10,
+                             random_state=42, n_permutations=0):
     """
     For a given n_components, load summary csvs if they already exist, or
     run main.py to get and save necessary summary data required for plotting.
 
+    With n_permutations, the wb summary also gets permutation p-values
+    for HPAI and SSS (the "_p" columns; see calculate_hpai_p_values and
+    calculate_sss_p_values).
+
     Returns (wb_summary, R_summary, L_summary), each of which are DataFrame.
     """
+    import pandas as pd
+
     # Directory to find or save the summary csvs
-    out_dir = out_dir or op.join('ica_imgs', dataset, 'analyses', str(n_components))
+    dataset_key = get_dataset_key(dataset, resolution=resolution,
+                                  parcellation=parcellation, backend=backend, n_seeds=n_seeds,
+                                  random_state=random_state)
+    out_dir = out_dir or op.join('ica_imgs', dataset_key, 'analyses', str(n_components))
     summary_csvs = ["wb_summary.csv", "R_summary.csv", "L_summary.csv"]
 
     # If summary data are already saved as csv files, simply load them
@@ -186,9 +241,12 @@ def load_or_generate_summary(images, term_scores, n_components, scoring, dataset
         print("Loading summary data from %s" % out_dir)
         (wb_summary, R_summary, L_summary) = (pd.read_csv(op.join(out_dir, csv))
                                               for csv in summary_csvs)
+        if n_permutations and "wb_SSS_p" not in wb_summary:
+            print("No p-values in the summary data; generating them.")
+            force = True
 
     # Otherwise run match analysis and save them as csv files
-    else:
+    if force or not all([op.exists(op.join(out_dir, csv)) for csv in summary_csvs]):
         # Initialize summary DFs
         (wb_summary, R_summary, L_summary) = (pd.DataFrame(
             {"n_comp": [n_components] * n_components}) for i in range(3))
@@ -201,7 +259,9 @@ def load_or_generate_summary(images, term_scores, n_components, scoring, dataset
         img_d, score_mats_d, sign_mats_d = do_match_analysis(
             dataset=dataset, images=images, term_scores=term_scores,
             key=match_method, force=False, plot=plot,
-            plot_dir=out_dir, n_components=n_components, scoring=scoring)
+            plot_dir=out_dir, n_components=n_components, scoring=scoring,
+            resolution=resolution, parcellation=parcellation, backend=backend, n_seeds=n_seeds,
+            random_state=random_state)
 
         # 1) For each of "wb", "R", and "L" image, get sparsity and ACNI
         # (Anti-Correlated Network index). For "wb", also get HPAI
@@ -214,39 +274,57 @@ def load_or_generate_summary(images, term_scores, n_components, scoring, dataset
                       "R": (R_summary, ["R"]),
                       "L": (L_summary, ["L"])}
 
-        for key in label_dict:
-            (df, labels) = label_dict[key]
+        with stage('summary_metrics', n_components=n_components):
+            for key in label_dict:
+                (df, labels) = label_dict[key]
 
-            # 1-1) Sparsity
-            # sparsity_results = {label: sparsity_dict}
-            sparsity_results = {label: get_hemi_sparsity(img_d[key], label,
-                                thr=sparsity_threshold) for label in labels}
+                # 1-1) Sparsity
+                # sparsity_results = {label: sparsity_dict}
+                sparsity_results = {label: get_hemi_sparsity(img_d[key], label,
+                                    thr=sparsity_threshold) for label in labels}
 
-            for s_type in sparsityTypes:
-                for label in labels:
-                    df["%s_%s" % (s_type, label)] = sparsity_results[label][s_type]
+                for s_type in sparsityTypes:
+                    for label in labels:
+                        df["%s_%s" % (s_type, label)] = sparsity_results[label][s_type]
 
-            # 1-2) ACNI
-            for label in labels:
-                df["ACNI_%s" % label] = calculate_acni(
-                    img_d[key], hemi=label, percentile=acni_percentile)
-
-            # 1-3) For wb only, also compute HPAI
-            if key == "wb":
-                hpai_d = calculate_hpai(img_d[key], percentile=hpai_percentile)
+                # 1-2) ACNI
+                for label in labels:
+                    df["ACNI_%s" % label] = calculate_acni(
+                        img_d[key], hemi=label, percentile=acni_percentile)
+
+                # 1-3) For wb only, also compute HPAI
+                if key == "wb":
+                    hpai_d = calculate_hpai(img_d[key], percentile=hpai_percentile)
+                    for sign in SPARSITY_SIGNS:
+                        df["%sHPAI" % sign] = hpai_d[sign]
+
+        if n_permutations:
+            with stage('hpai_null', n_components=n_components) as st:
+                hpai_p_d = calculate_hpai_p_values(
+                    img_d["wb"], percentile=hpai_percentile,
+                    n_permutations=n_permutations, random_state=random_state)
                 for sign in SPARSITY_SIGNS:
-                    df["%sHPAI" % sign] = hpai_d[sign]
+                    wb_summary["%sHPAI_p" % sign] = hpai_p_d[sign]
+                st.add(n_permutations)
 
         # Save R/L_summary DFs
-        R_summary.to_csv(op.join(out_dir, "R_summary.csv"))
-        L_summary.to_csv(op.join(out_dir, "L_summary.csv"))
+        for summary, csv in ((R_summary, "R_summary.csv"), (L_summary, "L_summary.csv")):
+            with atomic_path(op.join(out_dir, csv)) as tmp_path:
+                summary.to_csv(tmp_path)
 
         # 2) Get SSS of wb component images as well as matched RL images
         col_img_pairs = [("wb_SSS", img_d["wb"]),
                          ("matchedRL_SSS", img_d["RL-unforced"])]
-        for (col, img) in col_img_pairs:
-            score_arr = compare_RL(img)
-            wb_summary[col] = score_arr
+        with stage('compare_RL', n_components=n_components):
+            for (col, img) in col_img_pairs:
+                score_arr = compare_RL(img)
+                wb_summary[col] = score_arr
+        if n_permutations:
+            with stage('sss_null', n_components=n_components) as st:
+                for (col, img) in col_img_pairs:
+                    wb_summary["%s_p" % col] = calculate_sss_p_values(
+                        img, n_permutations=n_permutations, random_state=random_state)
+                st.add(n_permutations * len(col_img_pairs))
 
         # 3) Finally store indices of matched R, L, and RL components, and the
         # respective match scores against wb
@@ -265,13 +343,16 @@ def load_or_generate_summary(images, term_scores, n_components, scoring, dataset
             wb_summary["n_unmatched%s" % comparison[1]] = num_unmatched
 
             # Save wb_summary
-            wb_summary.to_csv(op.join(out_dir, "wb_summary.csv"))
+            with atomic_path(op.join(out_dir, "wb_summary.csv")) as tmp_path:
+                wb_summary.to_csv(tmp_path)
 
     return (wb_summary, R_summary, L_summary)
 
 
 def generate_component_specific_plots(wb_master, components, scoring, out_dir=None):
     """Asdf"""
+    import matplotlib.pyplot as plt
+    import seaborn as sns
     start_idx = 0
     for c in components:
         wb_summary = wb_master[start_idx:(start_idx + c)]
@@ -347,6 +428,8 @@ def generate_component_specific_plots(wb_master, components, scoring, out_dir=No
 
 
 def _generate_plot_1(wb_master, sparsity_threshold, out_dir):
+    import matplotlib.pyplot as plt
+    import seaborn as sns
     # 1) HPAI-for pos, neg, and abs in wb components
     print "Plotting HPAI of wb components"
     out_path = op.join(out_dir, '1_wb_HPAI.png')
@@ -376,6 +459,8 @@ def _generate_plot_1(wb_master, sparsity_threshold, out_dir):
 
 
 def _generate_plot_2_3(wb_master, R_master, L_master, out_dir):
+    import matplotlib.pyplot as plt
+    import seaborn as sns
     # 2) VC and 3) L1 Sparsity comparison between wb and hemi components
     print "Plotting sparsity for WB and hemi-components"
     pastel2 = sns.color_palette("Pastel2")
@@ -426,6 +511,9 @@ def _generate_plot_2_3(wb_master, R_master, L_master, out_dir):
 
 
 def _generate_plot_4(wb_master, scoring, out_dir):
+    import matplotlib.pyplot as plt
+    import pandas as pd
+    import seaborn as sns
 
     # 4) Matching results: average matching scores and proportion of unmatched
     print "Plotting matching results"
@@ -468,6 +556,9 @@ def _generate_plot_4(wb_master, scoring, out_dir):
 
 
 def _generate_plot_5(wb_master, scoring, out_dir):
+    import matplotlib.pyplot as plt
+    import pandas as pd
+    import seaborn as sns
 
     # 5) SSS for wb components and matched RL components
     print "Plotting SSS for wb components"
@@ -527,6 +618,9 @@ def _generate_plot_5(wb_master, scoring, out_dir):
 
 
 def _generate_plot_6(wb_master, R_master, L_master, out_dir):
+    import matplotlib.pyplot as plt
+    import pandas as pd
+    import seaborn as sns
     # 6) Plot ACNI for wb and hemi-components
     print "Generating plots of ACNI for wb and hemi-components"
     set2 = sns.color_palette("Set2")
@@ -559,11 +653,30 @@ def _generate_plot_6(wb_master, R_master, L_master, out_dir):
 
 def loop_main_and_plot(components, scoring, dataset, query_server=True,
                        force=False, plot=True, max_images=np.inf,
-                       memory=Memory(cachedir='nilearn_cache')):
+                       memory=None, resolution=None,
+                       parcellation=None, backend=DEFAULT_BACKEND, n_seeds=10,
+                       random_state=42, n_permutations=0, resume=False):
     """
     Loop main.py to plot summaries of WB vs hemi ICA components
+
+    With resolution (mm), everything runs on a coarser grid (see
+    generate_components), for quick sweeps over n_components.
+
+    With n_permutations, the summaries get permutation p-values for
+    HPAI and SSS.
+
+    With resume, pick up an interrupted sweep where it stopped: each ICA
+    and each n_components summary is checkpointed as it's done, and
+    loaded from its saved output instead of re-run (even with force).
     """
-    out_dir = op.join('ica_imgs', dataset, 'analyses')
+    import pandas as pd
+
+    dataset_key = get_dataset_key(dataset, resolution=resolution,
+                                  parcellation=parcellation, backend=backend, n_seeds=n_seeds,
+                                  random_state=random_state)
+    out_dir = op.join('ica_imgs', dataset_key, 'analyses')
+    memory = get_dataset_memory(dataset_key) if memory is None else memory
+    manifest = Manifest(op.join(out_dir, 'manifest.json'), resume=resume)
 
     # Get data once
     images, term_scores = get_dataset(dataset, max_images=max_images,
@@ -576,20 +689,31 @@ def loop_main_and_plot(components, scoring, dataset, query_server=True,
         for c in components:
             print("Generating or loading ICA components for %s,"
                   " n=%d components" % (hemi, c))
-            nii_dir = op.join('ica_nii', dataset, str(c))
+            nii_dir = op.join('ica_nii', dataset_key, str(c))
             kwargs = dict(images=[im['local_path'] for im in images],
                           n_components=c, term_scores=term_scores,
-                          out_dir=nii_dir, memory=memory)
-
-            img = load_or_generate_components(
-                hemi=hemi, force=force, no_plot=not plot, **kwargs)
+                          out_dir=nii_dir, memory=memory, resolution=resolution,
+                          parcellation=parcellation, backend=backend, n_seeds=n_seeds,
+                          random_state=random_state)
+
+            unit = 'ica/%s/%d' % (hemi, c)
+            if manifest.is_done(unit):
+                print("Skipping ICA for %s, n=%d components; done already." % (hemi, c))
+                with stage('load_components', hemi=hemi, n_components=c):
+                    img = load_components(
+                        op.join(nii_dir, '%s_ica_components.nii.gz' % hemi), hemi=hemi)
+            else:
+                img = load_or_generate_components(
+                    hemi=hemi, force=force, no_plot=not plot, **kwargs)
+                manifest.mark_done(unit)
             imgs[hemi].append(img)
 
     # Use wb images to determine threshold for voxel count sparsity
     print("Getting sparsity threshold.")
     global_percentile = 99.9
-    sparsity_threshold = get_sparsity_threshold(
-        images=imgs["wb"], global_percentile=global_percentile)
+    with stage('sparsity_threshold'):
+        sparsity_threshold = get_sparsity_threshold(
+            images=imgs["wb"], global_percentile=global_percentile)
     print("Using global sparsity threshold of %0.8f for sparsity calculation"
           % sparsity_threshold)
 
@@ -598,10 +722,21 @@ def loop_main_and_plot(components, scoring, dataset, query_server=True,
     (wb_master, R_master, L_master) = (pd.DataFrame() for i in range(3))
     for c in components:
         print("Running analysis with %d components" % c)
-        (wb_summary, R_summary, L_summary) = load_or_generate_summary(
-            images=images, term_scores=term_scores, n_components=c,
-            scoring=scoring, dataset=dataset, sparsity_threshold=sparsity_threshold,
-            acni_percentile=95.0, hpai_percentile=95.0, force=force, memory=memory)
+        unit = 'summary/%s/%d' % (scoring, c)
+        summary_dir = op.join(out_dir, str(c))
+        if manifest.is_done(unit):
+            print("Skipping analysis with %d components; done already." % c)
+            (wb_summary, R_summary, L_summary) = (
+                pd.read_csv(op.join(summary_dir, '%s_summary.csv' % hemi)) for hemi in hemis)
+        else:
+            (wb_summary, R_summary, L_summary) = load_or_generate_summary(
+                images=images, term_scores=term_scores, n_components=c,
+                scoring=scoring, dataset=dataset, sparsity_threshold=sparsity_threshold,
+                acni_percentile=95.0, hpai_percentile=95.0,
+                force=force, out_dir=summary_dir, memory=memory,
+                resolution=resolution, parcellation=parcellation, backend=backend, n_seeds=n_seeds,
+                random_state=random_state, n_permutations=n_permutations)
+            manifest.mark_done(unit, sparsity_threshold=float(sparsity_threshold))
         # Append them to master DFs
         wb_master = wb_master.append(wb_summary)
         R_master = R_master.append(R_summary)
@@ -613,7 +748,8 @@ def loop_main_and_plot(components, scoring, dataset, query_server=True,
     print "Saving summary csvs..."
     for key in master_DFs:
         master_DFs[key].reset_index(inplace=True)
-        master_DFs[key].to_csv(op.join(out_dir, '%s_summary.csv' % key))
+        with atomic_path(op.join(out_dir, '%s_summary.csv' % key)) as tmp_path:
+            master_DFs[key].to_csv(tmp_path)
 
     # Generate plots
     # To set size proportional to vc sparsity in several graphs, add columns with
@@ -623,17 +759,19 @@ def loop_main_and_plot(components, scoring, dataset, query_server=True,
 
     # 1) Component-specific plots
     print "Generating plots for each n_components."
-    generate_component_specific_plots(
-        wb_master=wb_master, components=components, scoring=scoring, out_dir=out_dir)
+    with stage('component_plots'):
+        generate_component_specific_plots(
+            wb_master=wb_master, components=components, scoring=scoring, out_dir=out_dir)
 
     # 2) Main summary plots over the range of n_components
     print "Generating summary plots.."
-    _generate_plot_1(wb_master=wb_master, sparsity_threshold=sparsity_threshold,
-                     out_dir=out_dir)
-    _generate_plot_2_3(out_dir=out_dir, **master_DFs)
-    _generate_plot_4(wb_master=wb_master, scoring=scoring, out_dir=out_dir)
-    _generate_plot_5(wb_master=wb_master, scoring=scoring, out_dir=out_dir)
-    _generate_plot_6(out_dir=out_dir, **master_DFs)
+    with stage('summary_plots'):
+        _generate_plot_1(wb_master=wb_master, sparsity_threshold=sparsity_threshold,
+                         out_dir=out_dir)
+        _generate_plot_2_3(out_dir=out_dir, **master_DFs)
+        _generate_plot_4(wb_master=wb_master, scoring=scoring, out_dir=out_dir)
+        _generate_plot_5(wb_master=wb_master, scoring=scoring, out_dir=out_dir)
+        _generate_plot_6(out_dir=out_dir, **master_DFs)
 
 
 if __name__ == '__main__':
@@ -648,6 +786,9 @@ if __name__ == '__main__':
     hemi_choices = ['R', 'L', 'wb']
     parser = ArgumentParser(description="Really?")
     parser.add_argument('--force', action='store_true', default=False)
+    parser.add_argument('--resume', action='store_true', default=False,
+                        help="Continue an interrupted run, skipping the "
+                             "components and summaries already done.")
     parser.add_argument('--offline', action='store_true', default=False)
     parser.add_argument('--no-plot', action='store_true', default=False)
     parser.add_argument('--components', nargs='?',
@@ -657,6 +798,25 @@ if __name__ == '__main__':
     parser.add_argument('--scoring', nargs='?', default='correlation',
                         choices=['l1norm', 'l2norm', 'correlation'])
     parser.add_argument('--max-images', nargs='?', type=int, default=np.inf)
+    parser.add_argument('--seed', nargs='?', type=int, default=42,
+                        dest='random_state')
+    parser.add_argument('--permutations', nargs='?', type=int, default=0,
+                        dest='n_permutations',
+                        help="Add permutation p-values for HPAI and SSS to the "
+                             "summaries, from this many permutations (e.g. 1000).")
+    parser.add_argument('--resolution', nargs='?', type=float, default=None,
+                        help="Resample mask and images to this resolution (mm), "
+                             "e.g. 4 or 6, for fast exploratory runs.")
+    parser.add_argument('--parcellation', nargs='?', default=None,
+                        help="Label image (path); run ICA on parcel means "
+                             "instead of voxels.")
+    parser.add_argument('--backend', nargs='?', default=DEFAULT_BACKEND,
+                        choices=sorted(BACKENDS))
+    parser.add_argument('--n-seeds', nargs='?', type=int, default=10,
+                        help="Number of FastICA runs for the ensemble backend.")
+    parser.add_argument('--trace', nargs='?', const='trace.json', default=None,
+                        help="Save per-stage timings to this Chrome trace (json) file, "
+                             "and print a summary.")
     args = vars(parser.parse_args())
 
     # Alias args
@@ -664,5 +824,6 @@ if __name__ == '__main__':
     plot = not args.pop('no_plot')
     components = [int(c) for c in args.pop('components').split(',')]
 
-    loop_main_and_plot(
-        components=components, query_server=query_server, plot=plot, **args)
+    with record_trace(args.pop('trace')):
+        loop_main_and_plot(
+            components=components, query_server=query_server, plot=plot, **args)
@@ -0,0 +1,244 @@
+# *- encoding: utf-8 -*-
+# Author: Ben Cipollini, Ami Tsuchida
+# License: BSD
+"""
+Time the hot paths of the analyses on synthetic data.
+
+Everything runs offline: a synthetic grey matter mask is put in a
+temporary nilearn data directory, and images / component images are
+generated on the 2mm MNI grid. Results are saved as json in
+benchmarks/results/, so runs can be compared across commits:
+
+    python benchmarks/run.py --sizes 50x10,200x20
+    python benchmarks/run.py --compare benchmarks/results/<earlier>.json
+"""
+
+import json
+import os
+import os.path as op
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from timeit import default_timer
+
+import matplotlib
+import nibabel as nib
+import numpy as np
+matplotlib.use('Agg')  # before anything imports pyplot
+
+REPO_DIR = op.dirname(op.dirname(op.abspath(__file__)))
+RESULTS_DIR = op.join(REPO_DIR, 'benchmarks', 'results')
+
+MNI_AFFINE = np.array([[-2., 0., 0., 90.],
+                       [0., 2., 0., -126.],
+                       [0., 0., 2., -72.],
+                       [0., 0., 0., 1.]])
+MNI_SHAPE = (91, 109, 91)
+
+
+def make_gm_mask(data_dir):
+    """Save an ellipsoid 'grey matter' mask where fetch_grey_matter_mask looks."""
+    ijk = np.indices(MNI_SHAPE).astype(float)
+    center = (np.asarray(MNI_SHAPE) - 1) / 2.
+    radii = np.asarray([34., 42., 34.])
+    dist = sum(((ijk[ii] - center[ii]) / radii[ii]) ** 2 for ii in range(3))
+    mask = ((dist < 1) & (dist > 0.4)).astype(np.int8)
+
+    out_dir = op.join(data_dir, 'neurovault')
+    os.makedirs(out_dir)
+    nib.save(nib.Nifti1Image(mask, MNI_AFFINE), op.join(out_dir, 'gm_mask.nii.gz'))
+
+
+def make_images(n_images, out_dir, n_sources=20, random_state=0):
+    """Save n_images 3D maps: random mixtures of smooth blobs, plus noise."""
+    rng = np.random.RandomState(random_state)
+    ijk = np.indices(MNI_SHAPE).astype(np.float32)
+    sources = []
+    for _ in range(n_sources):
+        center = rng.uniform(0.25, 0.75, 3) * MNI_SHAPE
+        dist = sum((ijk[ii] - center[ii]) ** 2 for ii in range(3))
+        sources.append(np.exp(-dist / (2 * rng.uniform(4, 10) ** 2)))
+    sources = np.asarray(sources).reshape(n_sources, -1)
+
+    paths = []
+    for ii in range(n_images):
+        data = np.dot(rng.laplace(size=n_sources), sources)
+        data += 0.1 * rng.randn(data.size)
+        path = op.join(out_dir, 'image%04d.nii.gz' % ii)
+        nib.save(nib.Nifti1Image(data.reshape(MNI_SHAPE).astype(np.float32),
+                                 MNI_AFFINE), path)
+        paths.append(path)
+    return paths
+
+
+def make_components(n_components, out_dir, n_terms=50, random_state=0):
+    """Save wb, R and L component images (with terms and masked sidecars),
+    as generate_components would; return them loaded as load_components does."""
+    from nibabel_ext import NiftiImageWithTerms
+    from nilearn_ext.decomposition import get_masked_path, load_components
+    from nilearn_ext.masking import get_hemi_gm_mask
+
+    rng = np.random.RandomState(random_state)
+    terms = ['term%d' % ii for ii in range(n_terms)]
+    imgs = dict()
+    for hemi in ('wb', 'R', 'L'):
+        mask = get_hemi_gm_mask(hemi).get_data() > 0
+        maps = rng.laplace(size=(n_components, mask.sum())).astype(np.float32)
+        data = np.zeros(MNI_SHAPE + (n_components,), dtype=np.float32)
+        data[mask] = maps.T
+
+        img = NiftiImageWithTerms(data, MNI_AFFINE)
+        img.terms = dict((term, rng.randn(n_components)) for term in terms)
+        img_path = op.join(out_dir, '%s_ica_components.nii.gz' % hemi)
+        img.to_filename(img_path)
+        np.save(get_masked_path(img_path), maps)
+        imgs[hemi] = load_components(img_path, hemi=hemi)
+    return imgs
+
+
+def time_it(func, repeat=3):
+    """Wall times (seconds) of repeat calls; returns (times, last result)."""
+    times = []
+    for _ in range(repeat):
+        start = default_timer()
+        result = func()
+        times.append(default_timer() - start)
+    return times, result
+
+
+def run_benchmarks(sizes, work_dir, repeat=3, plot=True):
+    from analysis import (calculate_acni, calculate_hpai, calculate_hpai_p_values,
+                          calculate_sss_p_values, get_hemi_sparsity, get_sparsity_threshold)
+    from match import _concat_RL
+    from nilearn_ext.backends import get_backend
+    from nilearn_ext.decomposition import compare_components, mask_images
+    from nilearn_ext.masking import GreyMatterNiftiMasker
+    from nilearn_ext.plotting import plot_components
+    from nilearn_ext.utils import get_match_idx_pair, reorder_mat
+
+    results = []
+
+    def record(name, n_images, n_components, func, n_repeat=repeat):
+        times, result = time_it(func, repeat=n_repeat)
+        print("%-28s images=%-5s components=%-4d best=%.4fs" % (
+            name, n_images, n_components, min(times)))
+        results.append(dict(name=name, n_images=n_images, n_components=n_components,
+                            times=times, best=min(times)))
+        return result
+
+    masker = GreyMatterNiftiMasker().fit()
+    for n_images, n_components in sizes:
+        size_dir = op.join(work_dir, '%dx%d' % (n_images, n_components))
+        os.makedirs(size_dir)
+        image_paths = make_images(n_images, size_dir)
+
+        # generate_components, in its two stages
+        X, _ = record('mask_images', n_images, n_components,
+                      lambda: mask_images(image_paths, masker, hemi='wb'))
+        record('fastica', n_images, n_components,
+               lambda: get_backend('fastica')(X, n_components=n_components))
+
+        # Comparing and matching components
+        imgs = make_components(n_components, size_dir)
+        for scoring in ('l1norm', 'l2norm', 'correlation'):
+            score_mat, sign_mat = record(
+                'compare_components-%s' % scoring, None, n_components,
+                lambda: compare_components([imgs['wb'], imgs['R']], ['wb', 'R'],
+                                           scoring=scoring))
+        record('reorder_mat', None, n_components, lambda: reorder_mat(score_mat))
+        for force in (True, False):
+            record('get_match_idx_pair-%s' % ('forced' if force else 'unforced'),
+                   None, n_components,
+                   lambda: get_match_idx_pair(score_mat, sign_mat, force=force))
+        match, _ = get_match_idx_pair(score_mat, sign_mat, force=True)
+        record('_concat_RL', None, n_components,
+               lambda: _concat_RL(imgs['R'], imgs['L'], tuple(match['idx']),
+                                  tuple(match['sign'])))
+
+        # analysis.py metrics
+        wb_img = imgs['wb']
+        record('get_sparsity_threshold', None, n_components,
+               lambda: get_sparsity_threshold([wb_img]))
+        record('get_hemi_sparsity', None, n_components,
+               lambda: get_hemi_sparsity(wb_img, 'wb'))
+        record('calculate_acni', None, n_components,
+               lambda: calculate_acni(wb_img, 'wb'))
+        record('calculate_hpai', None, n_components,
+               lambda: calculate_hpai(wb_img))
+        record('calculate_hpai_p_values', None, n_components,
+               lambda: calculate_hpai_p_values(wb_img, n_permutations=1000), n_repeat=1)
+        record('calculate_sss_p_values', None, n_components,
+               lambda: calculate_sss_p_values(wb_img, n_permutations=1000), n_repeat=1)
+
+        if plot:
+            record('plot_components', None, n_components,
+                   lambda: plot_components(wb_img, hemi='wb',
+                                           out_dir=op.join(size_dir, 'png')),
+                   n_repeat=1)
+
+    return results
+
+
+def get_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       cwd=REPO_DIR).decode().strip()
+    except Exception:
+        return 'unknown'
+
+
+def compare_results(old, new):
+    """Print the change in best time for each benchmark in both result sets."""
+    def key(res):
+        return (res['name'], res['n_images'], res['n_components'])
+    old_best = dict((key(res), res['best']) for res in old['results'])
+    print("\nvs. %s (%s):" % (old['commit'], old['date']))
+    for res in new['results']:
+        if key(res) in old_best:
+            print("%-28s images=%-5s components=%-4d %.4fs => %.4fs (x%.2f)" % (
+                key(res) + (old_best[key(res)], res['best'],
+                            res['best'] / max(old_best[key(res)], 1e-12))))
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(description="Time the analysis hot paths on synthetic data.")
+    parser.add_argument('--sizes', nargs='?', default="50x10,200x20",
+                        help="Comma-separated list of (# images)x(# components)")
+    parser.add_argument('--repeat', nargs='?', type=int, default=3)
+    parser.add_argument('--no-plot', action='store_true', default=False)
+    parser.add_argument('--compare', nargs='?', default=None,
+                        help="Earlier results (json) to compare against.")
+    args = parser.parse_args()
+
+    sizes = [tuple(int(v) for v in size.split('x')) for size in args.sizes.split(',')]
+
+    # Keep nilearn (and the grey matter mask) away from real data.
+    work_dir = tempfile.mkdtemp(prefix='ohbm2016-bench-')
+    os.environ['NILEARN_DATA'] = op.join(work_dir, 'nilearn_data')
+    make_gm_mask(os.environ['NILEARN_DATA'])
+    sys.path.insert(0, REPO_DIR)
+    try:
+        results = run_benchmarks(sizes, work_dir, repeat=args.repeat,
+                                 plot=not args.no_plot)
+    finally:
+        shutil.rmtree(work_dir)
+
+    commit = get_commit()
+    out = dict(commit=commit, date=time.strftime('%Y-%m-%dT%H:%M:%S'),
+               python=platform.python_version(), numpy=np.__version__,
+               results=results)
+    if not op.exists(RESULTS_DIR):
+        os.makedirs(RESULTS_DIR)
+    out_path = op.join(RESULTS_DIR, '%s-%s.json' % (time.strftime('%Y%m%d-%H%M%S'), commit))
+    with open(out_path, 'w') as fp:
+        json.dump(out, fp, indent=2)
+    print("Saved results to %s" % out_path)
+
+    if args.compare:
+        with open(args.compare) as fp:
+            compare_results(json.load(fp), out)
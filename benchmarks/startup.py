@@ -0,0 +1,95 @@
+# *- encoding: utf-8 -*-
+# Author: Ben Cipollini, Ami Tsuchida
+# License: BSD
+"""
+Time how long the scripts take to start.
+
+For each script, times `python <script> --help` and a bare import of
+the script module (the start-up cost of a --no-plot run, before any
+work), each in a fresh interpreter, and lists which slow-to-import
+packages the import pulls in. None should be: they're only needed
+once a script plots, masks or decomposes.
+
+    python benchmarks/startup.py
+    python benchmarks/startup.py --scripts match,analysis --repeat 10
+
+Exits with an error if a script imports any of them at start-up.
+"""
+
+import json
+import os
+import os.path as op
+import platform
+import subprocess
+import sys
+import time
+from timeit import default_timer
+
+from run import REPO_DIR, RESULTS_DIR, get_commit
+
+HEAVY_MODULES = ('matplotlib', 'seaborn', 'nilearn', 'sklearn', 'pandas')
+
+IMPORT_CODE = """
+import json, sys
+import %s
+print(json.dumps(sorted(set(name.split('.')[0] for name in sys.modules
+                            if name.split('.')[0] in %r))))
+"""
+
+
+def time_command(cmd, repeat=5):
+    """Best wall time (seconds) of repeat runs of cmd, and its last output."""
+    times = []
+    for _ in range(repeat):
+        start = default_timer()
+        output = subprocess.check_output(cmd, cwd=REPO_DIR)
+        times.append(default_timer() - start)
+    return times, output.decode()
+
+
+def run_benchmarks(scripts, repeat=5):
+    results = []
+    base_times, _ = time_command([sys.executable, '-c', 'pass'], repeat=repeat)
+    print("%-12s %-8s best=%.3fs" % ('python', '', min(base_times)))
+
+    for script in scripts:
+        help_times, _ = time_command(
+            [sys.executable, '%s.py' % script, '--help'], repeat=repeat)
+        import_times, output = time_command(
+            [sys.executable, '-c', IMPORT_CODE % (script, HEAVY_MODULES)],
+            repeat=repeat)
+        heavy = json.loads(output.strip().splitlines()[-1])
+
+        for name, times in (('--help', help_times), ('import', import_times)):
+            print("%-12s %-8s best=%.3fs" % (script, name, min(times)))
+            results.append(dict(name='%s %s' % (script, name), times=times,
+                                best=min(times)))
+        if heavy:
+            print("%-12s imports %s at start-up" % (script, ', '.join(heavy)))
+        results[-1]['heavy_modules'] = heavy
+
+    return dict(python_best=min(base_times), results=results)
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(description="Time the scripts' start-up.")
+    parser.add_argument('--scripts', nargs='?', default="match,analysis,ps,hierarchy",
+                        help="Comma-separated list of scripts (without .py)")
+    parser.add_argument('--repeat', nargs='?', type=int, default=5)
+    args = parser.parse_args()
+
+    out = run_benchmarks(args.scripts.split(','), repeat=args.repeat)
+    out.update(commit=get_commit(), date=time.strftime('%Y-%m-%dT%H:%M:%S'),
+               python=platform.python_version())
+    if not op.exists(RESULTS_DIR):
+        os.makedirs(RESULTS_DIR)
+    out_path = op.join(RESULTS_DIR, 'startup-%s-%s.json' % (
+        time.strftime('%Y%m%d-%H%M%S'), out['commit']))
+    with open(out_path, 'w') as fp:
+        json.dump(out, fp, indent=2)
+    print("Saved results to %s" % out_path)
+
+    if any(res.get('heavy_modules') for res in out['results']):
+        sys.exit(1)
@@ -0,0 +1,119 @@
+# *- encoding: utf-8 -*-
+# Author: Ben Cipollini, Ami Tsuchida
+# License: BSD
+"""
+How do components split and merge as the model order grows?
+
+Match the components of each n_components run to those of the next
+(e.g. 5 => 10 => 15 ...), for wb, R and L, and save the
+split / merge tree as a compact json graph.
+
+Components are read from the ica_nii directory (with their masked
+.npy sidecars); run ps.py or analysis.py first to compute them.
+"""
+
+import json
+import os
+import os.path as op
+
+import numpy as np
+from scipy.optimize import linear_sum_assignment
+
+from match import get_dataset_key
+from nilearn_ext.backends import BACKENDS, DEFAULT_BACKEND
+from nilearn_ext.decomposition import load_components, score_components
+
+
+def match_model_orders(score_mat, sign_mat):
+    """
+    Link the components of a lower model order (rows) to those of
+    the next model order (columns).
+
+    Every row is matched one-to-one by optimal assignment ("match").
+    Columns left unassigned are linked to their best row ("split"),
+    and rows whose best column went to another row are linked to it
+    as well ("merge").
+
+    Returns a list of [row, col, edge_type, sign, score].
+    """
+    rows, cols = linear_sum_assignment(score_mat)
+    edges = [[i, j, 'match'] for i, j in zip(rows, cols)]
+
+    assigned = set(cols)
+    edges += [[int(np.argmin(score_mat[:, j])), j, 'split']
+              for j in range(score_mat.shape[1]) if j not in assigned]
+    linked = set((i, j) for i, j, _ in edges)
+    best_cols = np.argmin(score_mat, axis=1)
+    edges += [[i, int(best_cols[i]), 'merge'] for i in range(score_mat.shape[0])
+              if (i, best_cols[i]) not in linked]
+
+    return [[int(i), int(j), edge_type, int(sign_mat[i, j]), round(float(score_mat[i, j]), 4)]
+            for i, j, edge_type in edges]
+
+
+def build_hierarchy(components, dataset, scoring='correlation',
+                    hemis=('wb', 'R', 'L'), **kwargs):
+    """
+    Build the split / merge graph across model orders, for each hemi.
+
+    kwargs are passed to get_dataset_key, to find the components.
+    """
+    from nilearn_ext.masking import get_masked_data  # imports nilearn; slow
+    dataset_key = get_dataset_key(dataset, **kwargs)
+    components = sorted(components)
+
+    graph = dict(dataset=dataset_key, scoring=scoring,
+                 components=components, hemis=dict())
+    for hemi in hemis:
+        print("Matching %s components across %d model orders" % (
+            hemi, len(components)))
+        data = []
+        for c in components:
+            img_path = op.join('ica_nii', dataset_key, str(c),
+                               '%s_ica_components.nii.gz' % hemi)
+            if not op.exists(img_path):
+                raise IOError("%s not found; compute components with ps.py "
+                              "or analysis.py first." % img_path)
+            data.append(get_masked_data(load_components(img_path, hemi=hemi), hemi=hemi))
+
+        graph['hemis'][hemi] = [
+            dict(orders=[lo, hi], edges=match_model_orders(
+                *score_components(lo_data, hi_data, scoring=scoring)))
+            for lo, hi, lo_data, hi_data in zip(
+                components[:-1], components[1:], data[:-1], data[1:])]
+    return graph
+
+
+def save_hierarchy(graph, out_path):
+    if not op.exists(op.dirname(out_path)):
+        os.makedirs(op.dirname(out_path))
+    with open(out_path, 'w') as fp:
+        json.dump(graph, fp, separators=(',', ':'))
+    return out_path
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(description="Match components across model orders, "
+                                        "and save the split / merge tree.")
+    parser.add_argument('--components', nargs='?',
+                        default="5,10,15,20,25,30,35,40,45,50")
+    parser.add_argument('--dataset', nargs='?', default='neurovault',
+                        choices=['neurovault', 'abide', 'nyu'])
+    parser.add_argument('--scoring', nargs='?', default='correlation',
+                        choices=['l1norm', 'l2norm', 'correlation'])
+    parser.add_argument('--resolution', nargs='?', type=float, default=None)
+    parser.add_argument('--parcellation', nargs='?', default=None)
+    parser.add_argument('--backend', nargs='?', default=DEFAULT_BACKEND,
+                        choices=sorted(BACKENDS))
+    parser.add_argument('--n-seeds', nargs='?', type=int, default=10)
+    parser.add_argument('--seed', nargs='?', type=int, default=42,
+                        dest='random_state')
+    args = vars(parser.parse_args())
+
+    components = [int(c) for c in args.pop('components').split(',')]
+    graph = build_hierarchy(components=components, **args)
+    out_path = op.join('ica_imgs', graph['dataset'],
+                       'hierarchy_%s.json' % graph['scoring'])
+    print("Saved hierarchy to %s" % save_hierarchy(graph, out_path))
@@ -6,17 +6,16 @@ import os.path as op
 
 import nibabel as nib
 import numpy as np
-import pandas as pd
-import matplotlib.pyplot as plt
-from nilearn import datasets
-from nilearn.image import index_img, math_img
 
-from nibabel_ext import NiftiImageWithTerms
+from nilearn_ext.backends import BACKENDS, DEFAULT_BACKEND
+from nilearn_ext.cache import get_dataset_memory
+from nilearn_ext.checkpoint import atomic_path
 from nilearn_ext.datasets import fetch_neurovault
-from nilearn_ext.decomposition import compare_components, generate_components
+from nilearn_ext.decomposition import compare_components, generate_components, load_components
 from nilearn_ext.plotting import (plot_matched_components, plot_components,
                                   plot_components_summary, plot_comparison_matrix,
                                   plot_term_comparisons)
+from nilearn_ext.tracing import record_trace, stage
 from nilearn_ext.utils import get_ic_terms, get_n_terms, get_match_idx_pair
 
 
@@ -32,12 +31,15 @@ def load_or_generate_components(hemi, out_dir='.', force=False,
     if generate_imgs:
         img = generate_components(hemi=hemi, out_dir=out_dir, *args, **kwargs)
     else:
-        img = NiftiImageWithTerms.from_filename(img_path)
+        with stage('load_components', hemi=hemi, n_components=kwargs.get('n_components')):
+            img = load_components(img_path, hemi=hemi)
 
     if not no_plot:
         plot_dir = plot_dir or op.join(out_dir, 'png')
-        plot_components(img, hemi=hemi, out_dir=plot_dir)
-        plot_components_summary(img, hemi=hemi, out_dir=plot_dir)
+        with stage('plot_components', hemi=hemi, n_components=img.shape[3]) as st:
+            plot_components(img, hemi=hemi, out_dir=plot_dir)
+            plot_components_summary(img, hemi=hemi, out_dir=plot_dir)
+            st.add(img.shape[3])
 
     return img
 
@@ -48,6 +50,8 @@ def _concat_RL(R_img, L_img, rl_idx_pair, rl_sign_pair=None):
     create bilateral image using the index pairs. Sign flipping can be specified in rl_sign_pair.
 
     """
+    from nilearn.image import index_img, math_img
+
     # Make sure images have same number of components and indices are less than the n_components
     assert R_img.shape == L_img.shape
     n_components = R_img.shape[3]
@@ -91,23 +95,152 @@ def _concat_RL(R_img, L_img, rl_idx_pair, rl_sign_pair=None):
     return concat_img
 
 
-def _compare_components_and_plot(images, labels, scoring, out_dir=None):
+def _compare_components_and_plot(images, labels, scoring, out_dir=None,
+                                 saved_mats=None, plot=True):
     """
     For any given pair of ica component images, compute score matrix and plot the matrix.
     Returns score matrix and sign matrix.
+
+    saved_mats: (score_mats, sign_mats, matches) from load_match_results;
+    if they have this comparison, it is not recomputed.
     """
     # Compare components
     # The sign_mat contains signs that gave the best score for the comparison
-    score_mat, sign_mat = compare_components(images, labels, scoring)
+    labels = tuple(labels)
+    if saved_mats is not None and labels in saved_mats[0]:
+        score_mat, sign_mat = saved_mats[0][labels], saved_mats[1][labels]
+    else:
+        score_mat, sign_mat = compare_components(images, labels, scoring)
+    if not plot:
+        return score_mat, sign_mat
 
     # Plot comparison matrix
-    for normalize in [False, True]:
-        plot_comparison_matrix(
-            score_mat, labels, scoring, normalize=normalize, out_dir=out_dir)
+    with stage('plot_comparison_matrix', hemi=' vs '.join(labels),
+               n_components=images[0].shape[3]):
+        for normalize in [False, True]:
+            plot_comparison_matrix(
+                score_mat, labels, scoring, normalize=normalize, out_dir=out_dir)
 
     return score_mat, sign_mat
 
 
+def get_match_results_path(nii_dir, key, scoring):
+    """Archive of the score / sign matrices and matches of a match analysis."""
+    return op.join(nii_dir, '%s-matching_%s.npz' % (key, scoring))
+
+
+def save_match_results(out_path, score_mats, sign_mats):
+    """
+    Save the score and sign matrix of each comparison, with its forced and
+    unforced matches (see get_match_idx_pair), in a single npz archive.
+
+    Arrays are named "<labels>:<array>", e.g. "wb:R:score",
+    "wb:R:forced:match-idx" or "wb:R:unforced:unmatch-sign".
+    """
+    arrays = dict()
+    for comp in score_mats:
+        score_mat, sign_mat = score_mats[comp], sign_mats[comp]
+        prefix = ':'.join(comp)
+        arrays['%s:score' % prefix] = score_mat
+        arrays['%s:sign' % prefix] = sign_mat
+        for force_match in (True, False):
+            force_status = 'forced' if force_match else 'unforced'
+            match, unmatch = get_match_idx_pair(score_mat, sign_mat, force=force_match)
+            for name, result in (('match', match), ('unmatch', unmatch)):
+                if result["idx"] is not None:
+                    arrays['%s:%s:%s-idx' % (prefix, force_status, name)] = result["idx"]
+                    arrays['%s:%s:%s-sign' % (prefix, force_status, name)] = result["sign"]
+
+    with atomic_path(out_path) as tmp_path:
+        np.savez_compressed(tmp_path, **arrays)
+    return out_path
+
+
+def load_match_results(results_path):
+    """
+    The (score_mats, sign_mats, matches) dicts saved by save_match_results.
+    matches maps (labels, "forced" or "unforced") to the (match, unmatch)
+    of get_match_idx_pair.
+    """
+    score_mats, sign_mats, matches = dict(), dict(), dict()
+    npz = np.load(results_path)
+    try:
+        arrays = dict((name, npz[name]) for name in npz.files)
+    finally:
+        npz.close()
+
+    for name in arrays:
+        parts = name.split(':')
+        if parts[-1] == 'score':
+            score_mats[tuple(parts[:-1])] = arrays[name]
+        elif parts[-1] == 'sign':
+            sign_mats[tuple(parts[:-1])] = arrays[name]
+    for comp in score_mats:
+        prefix = ':'.join(comp)
+        for force_status in ('forced', 'unforced'):
+            results = []
+            for name in ('match', 'unmatch'):
+                idx_name = '%s:%s:%s-idx' % (prefix, force_status, name)
+                sign_name = '%s:%s:%s-sign' % (prefix, force_status, name)
+                results.append({"idx": arrays.get(idx_name), "sign": arrays.get(sign_name)})
+            if results[0]["idx"] is not None:
+                matches[(comp, force_status)] = tuple(results)
+    return score_mats, sign_mats, matches
+
+
+def get_matches(comp, score_mat, sign_mat, force_match, saved_mats=None):
+    """
+    The (match, unmatch) of a comparison (see get_match_idx_pair): from
+    saved_mats (see load_match_results) if saved there, else computed.
+    """
+    force_status = 'forced' if force_match else 'unforced'
+    if saved_mats is not None and (tuple(comp), force_status) in saved_mats[2]:
+        return saved_mats[2][(tuple(comp), force_status)]
+    return get_match_idx_pair(score_mat, sign_mat, force=force_match)
+
+
+def is_newer(path, dependencies):
+    """Whether path exists and is newer than all (existing) dependencies."""
+    if not op.exists(path):
+        return False
+    mtime = op.getmtime(path)
+    return all(op.getmtime(dep) <= mtime for dep in dependencies if op.exists(dep))
+
+
+def load_saved_match_results(nii_dir, key, scoring, hemis=('wb', 'R', 'L')):
+    """
+    The (score_mats, sign_mats, matches) saved by an earlier do_match_analysis,
+    or None if there are none, or the component images changed since.
+    """
+    results_path = get_match_results_path(nii_dir, key, scoring)
+    img_paths = [op.join(nii_dir, '%s_ica_components.nii.gz' % hemi) for hemi in hemis]
+    if not is_newer(results_path, img_paths):
+        return None
+    print("Loading score and sign matrices from %s" % results_path)
+    return load_match_results(results_path)
+
+
+def get_dataset_key(dataset, resolution=None, parcellation=None,
+                    backend=DEFAULT_BACKEND, n_seeds=10, random_state=42):
+    """
+    Name used for a dataset's output directories (ica_nii, ica_imgs).
+    Non-default analysis settings get their own directories,
+    so their results never mix with the default results.
+    """
+    key = dataset
+    if resolution is not None:
+        key += '-%gmm' % resolution
+    if parcellation is not None:
+        key += '-%s' % op.basename(parcellation).split('.')[0]
+    if backend != DEFAULT_BACKEND:
+        key += '-%s' % backend
+    if backend == 'ensemble':
+        key += '%d' % n_seeds
+    if random_state != 42:
+        key += '-seed%d' % random_state
+    return key
+
+
 def get_dataset(dataset, max_images=np.inf, **kwargs):
     """Retrieve & normalize dataset from nilearn"""
     # Download
@@ -115,12 +248,14 @@ def get_dataset(dataset, max_images=np.inf, **kwargs):
         images, term_scores = fetch_neurovault(max_images=max_images, **kwargs)
 
     elif dataset == 'abide':
+        from nilearn import datasets
         dataset = datasets.fetch_abide_pcp(
             n_subjects=min(94, max_images), **kwargs)
         images = [{'local_path': p} for p in dataset['func_preproc']]
         term_scores = None
 
     elif dataset == 'nyu':
+        from nilearn import datasets
         dataset = datasets.fetch_nyu_rest(
             n_subjects=min(25, max_images), **kwargs)
         images = [{'local_path': p} for p in dataset['func']]
@@ -142,6 +277,8 @@ def load_or_generate_term_comparisons(imgs_list, img_labels, ic_idx_list, sign_l
     If force=False and the termscore summary is already present in the out_dir, simply
     open and return the summary as df.
     """
+    import pandas as pd
+
     termscores_summary_csv = op.join(out_dir, "termscores_summary.csv")
     if not force and op.exists(termscores_summary_csv):
         print "Found termscores summary csv in %s: Loading the dataframe..." % out_dir
@@ -209,7 +346,8 @@ def load_or_generate_term_comparisons(imgs_list, img_labels, ic_idx_list, sign_l
         # top n and bottom n terms for each comparison
         # 1) termscore summary
         termscores_summary = pd.concat(termscore_dfs, axis=0)
-        termscores_summary.to_csv(op.join(out_dir, 'termscores_summary.csv'), index=False)
+        with atomic_path(op.join(out_dir, 'termscores_summary.csv')) as tmp_path:
+            termscores_summary.to_csv(tmp_path, index=False)
 
         # 2) term summary
         term_dfs = []
@@ -219,7 +357,8 @@ def load_or_generate_term_comparisons(imgs_list, img_labels, ic_idx_list, sign_l
             term_df.insert(0, "%s_idx" % label, np.multiply(ic_idx_list[i].astype(int), sign_list[i].astype(int)))
             term_dfs.append(term_df)
         term_summary = pd.concat(term_dfs, axis=1)
-        term_summary.to_csv(op.join(out_dir, 'term_summary.csv'), index=False)
+        with atomic_path(op.join(out_dir, 'term_summary.csv')) as tmp_path:
+            term_summary.to_csv(tmp_path, index=False)
 
     return termscores_summary
 
@@ -227,11 +366,15 @@ def load_or_generate_term_comparisons(imgs_list, img_labels, ic_idx_list, sign_l
 def do_match_analysis(dataset, images, term_scores, key="wb", n_components=20,
                       random_state=42, max_images=np.inf, scoring='l1norm',
                       query_server=True, force=False, nii_dir=None,
-                      plot=True, plot_dir=None, hemis=('wb', 'R', 'L')):
+                      plot=True, plot_dir=None, hemis=('wb', 'R', 'L'),
+                      resolution=None, parcellation=None, backend=DEFAULT_BACKEND, n_seeds=10):
 
     # Output directories
-    nii_dir = nii_dir or op.join('ica_nii', dataset, str(n_components))
-    plot_dir = plot_dir or op.join('ica_imgs', dataset,
+    dataset_key = get_dataset_key(dataset, resolution=resolution,
+                                  parcellation=parcellation, backend=backend, n_seeds=n_seeds,
+                                  random_state=random_state)
+    nii_dir = nii_dir or op.join('ica_nii', dataset_key, str(n_components))
+    plot_dir = plot_dir or op.join('ica_imgs', dataset_key,
                                    '%s-%dics' % (scoring, n_components),
                                    '%s-matching' % key)
 
@@ -242,12 +385,18 @@ def do_match_analysis(dataset, images, term_scores, key="wb", n_components=20,
     # Load or generate components
     kwargs = dict(images=[im['local_path'] for im in images],
                   n_components=n_components, term_scores=term_scores,
-                  out_dir=nii_dir, plot_dir=plot_dir, no_plot=not plot)
+                  out_dir=nii_dir, plot_dir=plot_dir, no_plot=not plot,
+                  resolution=resolution, parcellation=parcellation,
+                  backend=backend, n_seeds=n_seeds,
+                  memory=get_dataset_memory(dataset_key))
     for hemi in hemis:
         print("Running analyses on %s" % hemi)
         imgs[hemi] = (load_or_generate_components(
             hemi=hemi, force=force, random_state=random_state, **kwargs))
 
+    # Score matrices of an earlier run on these images needn't be recomputed.
+    saved_mats = None if force else load_saved_match_results(nii_dir, key, scoring, hemis)
+
     # 2) Compare components in order to get concatenated RL image
     #    "wb": R- and L- is compared to wb-components, then matched
     #    "rl": direct R- and L- comparison, using R as a ref
@@ -268,12 +417,9 @@ def do_match_analysis(dataset, images, term_scores, key="wb", n_components=20,
 
         # Compare components and plot similarity matrix
         # The sign_mat contains signs that gave the best score for the comparison
-        if plot:
-            score_mat, sign_mat = _compare_components_and_plot(
-                images=img_pair, labels=comp, scoring=scoring, out_dir=plot_dir)
-        else:
-            score_mat, sign_mat = compare_components(
-                images=img_pair, labels=comp, scoring=scoring)
+        score_mat, sign_mat = _compare_components_and_plot(
+            images=img_pair, labels=comp, scoring=scoring, out_dir=plot_dir,
+            saved_mats=saved_mats, plot=plot)
 
         # Store score_mat and sign_mat
         score_mats[comp] = score_mat
@@ -284,7 +430,7 @@ def do_match_analysis(dataset, images, term_scores, key="wb", n_components=20,
         for force_match in [True, False]:
             force_status = 'forced' if force_match else 'unforced'
             plot_sub_dir = op.join(plot_dir, '%s-match' % force_status)
-            match, unmatch = get_match_idx_pair(score_mat, sign_mat, force=force_match)
+            match, unmatch = get_matches(comp, score_mat, sign_mat, force_match, saved_mats)
 
             # Store R and L indices/signs to match up R and L
             for i, hem in enumerate(comp):
@@ -294,9 +440,11 @@ def do_match_analysis(dataset, images, term_scores, key="wb", n_components=20,
 
             # If plot=True, plot matched (and unmatched, if unforced matching) components
             if plot:
-                plot_matched_components(images=img_pair, labels=comp,
-                                        score_mat=score_mat, sign_mat=sign_mat,
-                                        force=force_match, out_dir=plot_sub_dir)
+                with stage('plot_matched_components', hemi=' vs '.join(comp),
+                           n_components=n_components):
+                    plot_matched_components(images=img_pair, labels=comp,
+                                            score_mat=score_mat, sign_mat=sign_mat,
+                                            force=force_match, out_dir=plot_sub_dir)
 
     # 3) Now match up R and L (forced vs unforced match)
     for force_match in [True, False]:
@@ -305,20 +453,18 @@ def do_match_analysis(dataset, images, term_scores, key="wb", n_components=20,
 
         rl_idx_pair = (RL_arr[(force_status, "R", "idx")], RL_arr[(force_status, "L", "idx")])
         rl_sign_pair = (RL_arr[(force_status, "R", "sign")], RL_arr[(force_status, "L", "sign")])
-        imgs['RL-%s' % force_status] = _concat_RL(R_img=imgs['R'], L_img=imgs['L'],
-                                                  rl_idx_pair=rl_idx_pair,
-                                                  rl_sign_pair=rl_sign_pair)
+        with stage('concat_RL', hemi='RL-%s' % force_status, n_components=n_components):
+            imgs['RL-%s' % force_status] = _concat_RL(R_img=imgs['R'], L_img=imgs['L'],
+                                                      rl_idx_pair=rl_idx_pair,
+                                                      rl_sign_pair=rl_sign_pair)
 
         # 4) Compare the concatenated image to bilateral components (ie wb vs RL)
         # Note that for wb-matching, diagnal components will be matched by definition
         comp = ('wb', 'RL-%s' % force_status)
         img_pair = [imgs[comp[0]], imgs[comp[1]]]
-        if plot:
-            score_mat, sign_mat = _compare_components_and_plot(
-                images=img_pair, labels=comp, scoring=scoring, out_dir=plot_sub_dir)
-        else:
-            score_mat, sign_mat = compare_components(
-                images=img_pair, labels=comp, scoring=scoring)
+        score_mat, sign_mat = _compare_components_and_plot(
+            images=img_pair, labels=comp, scoring=scoring, out_dir=plot_sub_dir,
+            saved_mats=saved_mats, plot=plot)
 
         # Store score_mat and sign_mat
         score_mats[comp] = score_mat
@@ -326,12 +472,14 @@ def do_match_analysis(dataset, images, term_scores, key="wb", n_components=20,
 
         # If plot=True, plot matched (and unmatched, if unforced matching) components
         if plot:
-            plot_matched_components(images=img_pair, labels=comp,
-                                    score_mat=score_mat, sign_mat=sign_mat,
-                                    force=force_match, out_dir=plot_sub_dir)
+            with stage('plot_matched_components', hemi=' vs '.join(comp),
+                       n_components=n_components):
+                plot_matched_components(images=img_pair, labels=comp,
+                                        score_mat=score_mat, sign_mat=sign_mat,
+                                        force=force_match, out_dir=plot_sub_dir)
 
         # Compare terms between the matched wb, R and L components
-        match, unmatch = get_match_idx_pair(score_mat, sign_mat, force=force_match)
+        match, unmatch = get_matches(comp, score_mat, sign_mat, force_match, saved_mats)
         imgs_list = [imgs[hemi] for hemi in hemis]
 
         # component index list for wb, R and L
@@ -344,22 +492,28 @@ def do_match_analysis(dataset, images, term_scores, key="wb", n_components=20,
         r_sign_arr, l_sign_arr = [match["sign"][1] * arr[match["idx"][1]] for arr in rl_sign_pair]
         sign_list = [wb_sign_arr, r_sign_arr, l_sign_arr]
 
-        termscores_summary = load_or_generate_term_comparisons(
-            imgs_list=imgs_list, img_labels=hemis, ic_idx_list=ic_idx_list,
-            sign_list=sign_list, top_n=5, bottom_n=5, standardize=True, force=force,
-            out_dir=plot_sub_dir)
+        with stage('term_comparisons', hemi='RL-%s' % force_status, n_components=n_components):
+            termscores_summary = load_or_generate_term_comparisons(
+                imgs_list=imgs_list, img_labels=hemis, ic_idx_list=ic_idx_list,
+                sign_list=sign_list, top_n=5, bottom_n=5, standardize=True, force=force,
+                out_dir=plot_sub_dir)
 
         if plot:
-            for plot_type in ("heatmap", "rader"):
-                plot_term_comparisons(
-                    termscores_summary, labels=hemis, plot_type=plot_type, out_dir=plot_sub_dir)
-
+            with stage('plot_term_comparisons', hemi='RL-%s' % force_status,
+                       n_components=n_components):
+                for plot_type in ("heatmap", "rader"):
+                    plot_term_comparisons(
+                        termscores_summary, labels=hemis, plot_type=plot_type, out_dir=plot_sub_dir)
+
+    if saved_mats is None:
+        save_match_results(get_match_results_path(nii_dir, key, scoring), score_mats, sign_mats)
     return imgs, score_mats, sign_mats
 
 
 def match_main(dataset, key="wb", n_components=20, plot=True,
                max_images=np.inf, scoring='l1norm', query_server=True,
-               force=False, nii_dir=None, plot_dir=None, random_state=42):
+               force=False, nii_dir=None, plot_dir=None, random_state=42,
+               resolution=None, parcellation=None, backend=DEFAULT_BACKEND, n_seeds=10):
     """
     Compute components, then run requested comparisons.
 
@@ -381,7 +535,8 @@ def match_main(dataset, key="wb", n_components=20, plot=True,
         dataset=dataset, images=images, term_scores=term_scores,
         key=key, n_components=n_components, plot=plot, scoring=scoring,
         force=force, nii_dir=nii_dir, plot_dir=plot_dir,
-        random_state=random_state)
+        random_state=random_state, resolution=resolution,
+        parcellation=parcellation, backend=backend, n_seeds=n_seeds)
 
 
 if __name__ == '__main__':
@@ -416,6 +571,19 @@ if __name__ == '__main__':
     parser.add_argument('--scoring', nargs='?', default='l1norm',
                         choices=['l1norm', 'l2norm', 'correlation'])
     parser.add_argument('--max-images', nargs='?', type=int, default=np.inf)
+    parser.add_argument('--resolution', nargs='?', type=float, default=None,
+                        help="Resample mask and images to this resolution (mm), "
+                             "e.g. 4 or 6, for fast exploratory runs.")
+    parser.add_argument('--parcellation', nargs='?', default=None,
+                        help="Label image (path); run ICA on parcel means "
+                             "instead of voxels.")
+    parser.add_argument('--backend', nargs='?', default=DEFAULT_BACKEND,
+                        choices=sorted(BACKENDS))
+    parser.add_argument('--n-seeds', nargs='?', type=int, default=10,
+                        help="Number of FastICA runs for the ensemble backend.")
+    parser.add_argument('--trace', nargs='?', const='trace.json', default=None,
+                        help="Save per-stage timings to this Chrome trace (json) file, "
+                             "and print a summary.")
     args = vars(parser.parse_args())
 
     # Run qc
@@ -426,6 +594,9 @@ if __name__ == '__main__':
 
     # Run main
     plot = not args.pop('no_plot')
-    match_main(query_server=query_server, plot=plot, **args)
+    with record_trace(args.pop('trace')):
+        match_main(query_server=query_server, plot=plot, **args)
 
-    plt.show()
+    if plot:
+        import matplotlib.pyplot as plt
+        plt.show()
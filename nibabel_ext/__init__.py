@@ -2,22 +2,62 @@
 # Author: Ben Cipollini
 # License: BSD
 
+import json
+import struct
+from collections import OrderedDict
+
 import nibabel as nib
+import numpy as np
 from six.moves import cPickle
 
 
+# Terms are stored in a header extension as:
+#   magic | header length (uint32) | json header (term list, shape) | float32 matrix
+# Older files hold a pickled dict instead; those are still read.
+# nibabel strips trailing NUL bytes from extensions on read, so trailing
+# 0.0 values are restored from the shape when decoding.
+TERMS_MAGIC = b'NIITERMS1\x00'
+
+
+def encode_terms(terms):
+    """Encode a dict of term => values (one per component) to bytes."""
+    names = list(terms.keys())
+    matrix = np.asarray([terms[name] for name in names], dtype='<f4')
+    header = json.dumps(dict(terms=names, shape=matrix.shape)).encode('utf-8')
+    return (TERMS_MAGIC + struct.pack('<I', len(header)) + header +
+            matrix.tobytes())
+
+
+def decode_terms(content):
+    """Decode bytes from `encode_terms` (or an older pickled dict)."""
+    if not content.startswith(TERMS_MAGIC):
+        return cPickle.loads(content)
+
+    offset = len(TERMS_MAGIC)
+    header_len = struct.unpack('<I', content[offset:offset + 4])[0]
+    offset += 4
+    header = json.loads(content[offset:offset + header_len].decode('utf-8'))
+    offset += header_len
+    n_bytes = 4 * int(np.prod(header['shape']))
+    payload = content[offset:offset + n_bytes].ljust(n_bytes, b'\x00')
+    matrix = np.frombuffer(payload, dtype='<f4').reshape(header['shape'])
+    return OrderedDict(zip(header['terms'], matrix.astype(np.float32)))
+
+
 class NiftiImageWithTerms(nib.Nifti1Image):
     def __init__(self, *args, **kwargs):
         super(NiftiImageWithTerms, self).__init__(*args, **kwargs)
 
+        # Terms are decoded on first access (see the terms property).
         if len(self.header.extensions) > 0:
             self.ext = self.header.extensions[-1]
-            self.terms = cPickle.loads(self.ext.get_content())
         if 'terms' in kwargs:
             self.terms = kwargs.get('terms', dict())
 
     @property
     def terms(self):
+        if 'terms' not in self.extra and getattr(self, 'ext', None):
+            self.extra['terms'] = decode_terms(self.ext.get_content())
         return self.extra.get('terms')
 
     @terms.setter
@@ -28,6 +68,9 @@ class NiftiImageWithTerms(nib.Nifti1Image):
 
         # In with the new.
         self.extra['terms'] = terms
-        self.ext = nib.nifti1.Nifti1Extension('pypickle',
-                                              cPickle.dumps(self.terms))
-        self.header.extensions.append(self.ext)
+        self.ext = None
+        if terms is not None:
+            # Binary data; 'ignore' is the NIfTI code for private formats.
+            self.ext = nib.nifti1.Nifti1Extension('ignore',
+                                                  encode_terms(self.terms))
+            self.header.extensions.append(self.ext)
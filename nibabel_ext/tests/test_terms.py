@@ -0,0 +1,31 @@
+import os.path as op
+
+import numpy as np
+from six.moves import cPickle
+
+from nibabel_ext import NiftiImageWithTerms, decode_terms, encode_terms
+
+
+def test_save_load_terms(tmpdir):
+    # Negative term scores are clamped to 0, so matrices often end in 0.0;
+    # nibabel strips the trailing NUL bytes of extensions on read.
+    terms = dict(a=[1., 2., 3., 0.], b=[0., 0., 0., 0.])
+    img = NiftiImageWithTerms(np.ones((2, 2, 2, 4), dtype=np.float32), np.eye(4))
+    img.terms = terms
+    path = op.join(str(tmpdir), 'img.nii.gz')
+    img.to_filename(path)
+
+    loaded = NiftiImageWithTerms.from_filename(path)
+    assert sorted(loaded.terms) == ['a', 'b']
+    for term, vals in terms.items():
+        np.testing.assert_array_equal(loaded.terms[term], vals)
+    assert loaded.ext.get_code() == 0  # 'ignore': a private binary format
+
+
+def test_decode_terms():
+    terms = dict(a=np.arange(3, dtype=np.float32))
+    content = encode_terms(terms)
+    np.testing.assert_array_equal(decode_terms(content.rstrip(b'\x00'))['a'], terms['a'])
+
+    # Files from before the binary format hold a pickled dict.
+    assert decode_terms(cPickle.dumps(dict(a=[1, 2]))) == dict(a=[1, 2])
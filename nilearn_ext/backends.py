@@ -0,0 +1,138 @@
+# *- encoding: utf-8 -*-
+# Author: Ben Cipollini
+# License: BSD
+"""
+Decomposition backends for generate_components.
+
+Each backend takes the (images x voxels) matrix X and returns
+(maps, components[, info]):
+    maps: (n_components x voxels) spatial maps
+    components: (n_components x images) image loadings, such that
+        X.T ~ maps.T * components (up to scaling and centering)
+    info: optional dict of extra per-component results (e.g. stability)
+
+Voxels are the samples, images the features (as for FastICA).
+"""
+
+import numpy as np
+
+# sklearn is imported where it's used, so that choosing
+# (or listing) backends doesn't import it.
+
+
+# Backends aren't cached themselves: generate_components caches their
+# results (see nilearn_ext.cache).
+
+
+def fit_fastica(X, n_components, random_state=42, **kwargs):
+    from sklearn.decomposition import FastICA
+    fast_ica = FastICA(n_components=n_components, random_state=random_state).fit(X.T)
+    maps = fast_ica.transform(X.T).T
+    return maps, fast_ica.components_
+
+
+def fit_dictlearning(X, n_components, random_state=42, alpha=1.,
+                     chunk_size=10000, n_epochs=3, **kwargs):
+    """Fit with partial_fit over chunks of voxels, so each step only
+    touches (chunk_size x images) of the data."""
+    from sklearn.decomposition import MiniBatchDictionaryLearning
+    dict_learning = MiniBatchDictionaryLearning(
+        n_components=n_components, alpha=alpha, n_iter=1,
+        random_state=random_state)
+    rng = np.random.RandomState(random_state)
+    starts = np.arange(0, X.shape[1], chunk_size)
+    for epoch in range(n_epochs):
+        for start in rng.permutation(starts):
+            dict_learning.partial_fit(X[:, start:start + chunk_size].T)
+
+    maps = np.vstack([dict_learning.transform(X[:, start:start + chunk_size].T)
+                      for start in starts]).T
+    return maps, dict_learning.components_
+
+
+def fit_pca(X, n_components, random_state=42, **kwargs):
+    """Whitened PCA; a baseline (PCA is deterministic, so no seed)."""
+    from sklearn.decomposition import PCA
+    pca = PCA(n_components=n_components, whiten=True).fit(X.T)
+    return pca.transform(X.T).T, pca.components_
+
+
+def fit_sparsepca(X, n_components, random_state=42, alpha=1., **kwargs):
+    from sklearn.decomposition import MiniBatchSparsePCA
+    sparse_pca = MiniBatchSparsePCA(n_components=n_components, alpha=alpha,
+                                    random_state=random_state).fit(X.T)
+    return sparse_pca.transform(X.T).T, sparse_pca.components_
+
+
+def _whiten(X, n_components):
+    """PCA-whiten the voxels x images data once, for all seeds.
+
+    Returns the (voxels x n_components) whitened data, and the
+    (n_components x images) whitening matrix."""
+    from sklearn.decomposition import PCA
+    pca = PCA(n_components=n_components, whiten=True).fit(X.T)
+    whitening = pca.components_ / np.sqrt(pca.explained_variance_)[:, np.newaxis]
+    return pca.transform(X.T), whitening
+
+
+def _fit_unmixing(X_white, random_state):
+    from sklearn.decomposition import FastICA
+    fast_ica = FastICA(whiten=False, random_state=random_state).fit(X_white)
+    return fast_ica.components_
+
+
+def _align(ref_maps, maps):
+    """Permutation and signs that best match maps (rows) to ref_maps,
+    and the (sign-corrected) correlation of each matched pair."""
+    from scipy.optimize import linear_sum_assignment
+    from .decomposition import score_components  # avoid a circular import
+    score_mat, sign_mat = score_components(ref_maps, maps, scoring='correlation')
+    _, perm = linear_sum_assignment(score_mat)
+    rows = np.arange(len(perm))
+    return perm, sign_mat[rows, perm], 1 - score_mat[rows, perm]
+
+
+def fit_ensemble(X, n_components, random_state=42, n_seeds=10, n_jobs=-1, **kwargs):
+    """FastICA over n_seeds seeds (in parallel) on data whitened once;
+    components are matched across runs and averaged, with a stability
+    score (mean correlation to the consensus, 1 = identical in all runs)."""
+    from sklearn.externals.joblib import Parallel, delayed
+    X_white, whitening = _whiten(X, n_components)
+    seeds = random_state + np.arange(n_seeds)
+    unmixings = Parallel(n_jobs=n_jobs)(
+        delayed(_fit_unmixing)(X_white, seed) for seed in seeds)
+    all_maps = [np.dot(X_white, W.T).T for W in unmixings]
+    all_components = [np.dot(W, whitening) for W in unmixings]
+
+    # Align every run to the first and average; then re-align to the average.
+    consensus = all_maps[0]
+    for _ in range(2):
+        alignments = [_align(consensus, maps) for maps in all_maps]
+        consensus = np.mean([maps[perm] * signs[:, np.newaxis]
+                             for maps, (perm, signs, _) in zip(all_maps, alignments)],
+                            axis=0)
+    components = np.mean([comps[perm] * signs[:, np.newaxis]
+                          for comps, (perm, signs, _) in zip(all_components, alignments)],
+                         axis=0)
+
+    # Stability: mean correlation of the matched run components to the consensus.
+    stability = np.mean([corrs for _, _, corrs in alignments], axis=0)
+
+    return consensus, components, dict(stability=stability)
+
+
+BACKENDS = {
+    'fastica': fit_fastica,
+    'ensemble': fit_ensemble,
+    'dictlearning': fit_dictlearning,
+    'pca': fit_pca,
+    'sparsepca': fit_sparsepca,
+}
+DEFAULT_BACKEND = 'fastica'
+
+
+def get_backend(name):
+    if name not in BACKENDS:
+        raise ValueError("Unknown decomposition backend %s; choose from %s" % (
+            name, ', '.join(sorted(BACKENDS))))
+    return BACKENDS[name]
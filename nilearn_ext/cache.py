@@ -0,0 +1,253 @@
+# *- encoding: utf-8 -*-
+# Author: Ben Cipollini
+# License: BSD
+"""
+The joblib cache shared by the analyses (ICA fits, maskers, ...).
+
+Each dataset (see match.get_dataset_key) gets its own joblib cache under
+CACHE_DIR, so usage can be reported per dataset as well as per function.
+The cache can be kept under a size budget, by evicting the least recently
+used entries: set NILEARN_CACHE_BUDGET (e.g. "20G") to enforce it after
+each decomposition, or run
+
+    python -m nilearn_ext.cache report
+    python -m nilearn_ext.cache evict --budget 20G
+
+Last access is the atime of an entry's files (or its mtime, if later);
+with the common relatime mount option, atime is updated at least daily.
+
+Large inputs are expensive for joblib to hash, so some results are cached
+by a precomputed fingerprint instead (see fingerprint, load_arrays and
+save_arrays); those are kept in the same directories, and evicted alike.
+"""
+
+import hashlib
+import json
+import os
+import os.path as op
+import shutil
+import time
+
+import numpy as np
+
+CACHE_DIR = 'nilearn_cache'
+BUDGET_ENV = 'NILEARN_CACHE_BUDGET'
+
+_memories = dict()
+
+_SIZE_UNITS = dict(K=1024, M=1024 ** 2, G=1024 ** 3, T=1024 ** 4)
+
+
+def get_memory(cachedir=CACHE_DIR):
+    """Get the (memoized) joblib Memory for cachedir.
+
+    Use this instead of a Memory(...) default argument, so that importing
+    a module neither imports joblib nor creates the cache directory."""
+    if cachedir not in _memories:
+        from sklearn.externals.joblib import Memory
+        _memories[cachedir] = Memory(cachedir=cachedir)
+    return _memories[cachedir]
+
+
+def get_dataset_memory(dataset_key, cache_dir=CACHE_DIR):
+    """Get the joblib Memory for a dataset (a sub-directory of cache_dir)."""
+    return get_memory(op.join(cache_dir, dataset_key))
+
+
+def get_store_dir(memory):
+    """Directory where a joblib Memory stores its results (None if it
+    doesn't cache)."""
+    if hasattr(memory, 'location'):  # joblib >= 0.12
+        return memory.location and op.join(memory.location, 'joblib')
+    return getattr(memory, 'cachedir', None)
+
+
+def file_stamp(path):
+    """[absolute path, mtime, size] of a file: a cheap stand-in for its content."""
+    stat = os.stat(path)
+    return [op.abspath(path), stat.st_mtime, stat.st_size]
+
+
+def hash_array(arr):
+    arr = np.ascontiguousarray(arr)
+    sha1 = hashlib.sha1(str((arr.dtype.str, arr.shape)).encode('utf-8'))
+    sha1.update(arr.view(np.uint8).ravel() if arr.size else b'')
+    return sha1.hexdigest()
+
+
+def fingerprint(obj):
+    """Hash of a json-serializable description (of inputs and parameters)."""
+    return hashlib.sha1(json.dumps(obj, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def _get_arrays_path(memory, namespace, key):
+    store_dir = get_store_dir(memory)
+    if store_dir is None:
+        return None
+    return op.join(store_dir, namespace.replace('.', os.sep), key, 'output.npz')
+
+
+def load_arrays(memory, namespace, key):
+    """Arrays saved by save_arrays, as a dict; None if not cached."""
+    path = _get_arrays_path(memory, namespace, key)
+    if path is None or not op.exists(path):
+        return None
+    npz = np.load(path)
+    try:
+        arrays = dict((name, npz[name]) for name in npz.files)
+    finally:
+        npz.close()
+    os.utime(path, None)  # Mark as used, for eviction.
+    return arrays
+
+
+def save_arrays(memory, namespace, key, **arrays):
+    """Cache arrays in memory's directory, under namespace (e.g. the module
+    and function they come from) and key (e.g. a fingerprint)."""
+    path = _get_arrays_path(memory, namespace, key)
+    if path is None:
+        return None
+    if not op.exists(op.dirname(path)):
+        os.makedirs(op.dirname(path))
+    # Write to a temp file first, so that an interrupted run
+    # never leaves a truncated entry behind.
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp_path, 'wb') as fp:
+        np.savez(fp, **arrays)
+    os.rename(tmp_path, path)
+    return path
+
+
+def parse_size(size):
+    """Bytes in a size like 500M, 20G or 1024 (bytes)."""
+    size = str(size).strip().upper().rstrip('B')
+    if size and size[-1] in _SIZE_UNITS:
+        return int(float(size[:-1]) * _SIZE_UNITS[size[-1]])
+    return int(size)
+
+
+def format_size(n_bytes):
+    for unit in ('T', 'G', 'M', 'K'):
+        if n_bytes >= _SIZE_UNITS[unit]:
+            return '%.1f%s' % (n_bytes / float(_SIZE_UNITS[unit]), unit)
+    return '%dB' % n_bytes
+
+
+def get_budget():
+    """The cache budget (bytes) from the environment, or None (unbounded)."""
+    budget = os.environ.get(BUDGET_ENV)
+    return parse_size(budget) if budget else None
+
+
+def list_entries(cache_dir=CACHE_DIR):
+    """
+    One dict per cached call: path, dataset, func, size (bytes) and
+    last_access (seconds since the epoch).
+
+    A cached call is a joblib output directory (the one holding
+    output.pkl, or output.npz from save_arrays); its function is its
+    parent's path under the joblib directory, and its dataset the
+    directory above that (or '-' for the top-level, shared cache).
+    """
+    entries = []
+    for dirpath, dirnames, filenames in os.walk(cache_dir):
+        if 'output.pkl' not in filenames and 'output.npz' not in filenames:
+            continue
+        dirnames[:] = []  # numpy arrays are saved next to output.pkl
+
+        rel_parts = op.relpath(dirpath, cache_dir).split(os.sep)
+        if 'joblib' not in rel_parts:
+            continue
+        joblib_idx = rel_parts.index('joblib')
+        size, last_access = 0, 0
+        for filename in filenames:
+            try:
+                st = os.stat(op.join(dirpath, filename))
+            except OSError:  # removed meanwhile
+                continue
+            size += st.st_size
+            last_access = max(last_access, st.st_atime, st.st_mtime)
+        entries.append(dict(
+            path=dirpath, size=size, last_access=last_access,
+            dataset=op.join(*rel_parts[:joblib_idx]) if joblib_idx else '-',
+            func='.'.join(rel_parts[joblib_idx + 1:-1])))
+    return entries
+
+
+def evict(budget, cache_dir=CACHE_DIR, verbose=True):
+    """Remove least recently used entries until the cache fits in budget
+    (bytes). Returns the removed entries."""
+    entries = sorted(list_entries(cache_dir), key=lambda entry: entry['last_access'])
+    total = sum(entry['size'] for entry in entries)
+    removed = []
+    for entry in entries:
+        if total <= budget:
+            break
+        shutil.rmtree(entry['path'], ignore_errors=True)
+        total -= entry['size']
+        removed.append(entry)
+
+    if verbose and removed:
+        print("Evicted %d cache entries (%s); cache is now %s (budget %s)." % (
+            len(removed), format_size(sum(entry['size'] for entry in removed)),
+            format_size(total), format_size(budget)))
+    return removed
+
+
+def enforce_budget(cache_dir=CACHE_DIR):
+    """Evict to the budget in the environment, if one is set."""
+    budget = get_budget()
+    if budget is not None:
+        return evict(budget, cache_dir=cache_dir)
+    return []
+
+
+def summarize(entries, by=('dataset', 'func')):
+    """Entries, size and last access per (by) key, largest first."""
+    totals = dict()
+    for entry in entries:
+        key = tuple(entry[field] for field in by)
+        tot = totals.setdefault(key, dict(entries=0, size=0, last_access=0))
+        tot['entries'] += 1
+        tot['size'] += entry['size']
+        tot['last_access'] = max(tot['last_access'], entry['last_access'])
+    return sorted(totals.items(), key=lambda item: -item[1]['size'])
+
+
+def print_report(cache_dir=CACHE_DIR):
+    entries = list_entries(cache_dir)
+    print("%s: %d entries, %s" % (cache_dir, len(entries),
+                                  format_size(sum(entry['size'] for entry in entries))))
+    budget = get_budget()
+    if budget is not None:
+        print("Budget (%s): %s" % (BUDGET_ENV, format_size(budget)))
+
+    for by in (('dataset',), ('func',), ('dataset', 'func')):
+        print("")
+        header = by + ('entries', 'size', 'last access')
+        print(("%-40s" * len(by) + " %8s %10s %17s") % header)
+        for key, tot in summarize(entries, by=by):
+            print(("%-40s" * len(by) + " %8d %10s %17s") % (key + (
+                tot['entries'], format_size(tot['size']),
+                time.strftime('%Y-%m-%d %H:%M', time.localtime(tot['last_access'])))))
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(description="Report on, or shrink, the joblib cache.")
+    parser.add_argument('--cache-dir', nargs='?', default=CACHE_DIR)
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.add_parser('report', help="Cache usage per dataset and per function.")
+    evict_parser = subparsers.add_parser(
+        'evict', help="Remove least recently used entries, down to a size budget.")
+    evict_parser.add_argument('--budget', nargs='?', default=os.environ.get(BUDGET_ENV),
+                              help="e.g. 500M or 20G (default: $%s)" % BUDGET_ENV)
+    args = parser.parse_args()
+
+    if args.command == 'report':
+        print_report(cache_dir=args.cache_dir)
+    elif args.budget is None:
+        parser.error("evict needs --budget (or $%s)" % BUDGET_ENV)
+    else:
+        evict(parse_size(args.budget), cache_dir=args.cache_dir)
@@ -0,0 +1,190 @@
+# *- encoding: utf-8 -*-
+# Author: Ben Cipollini
+# License: BSD
+"""
+Local catalog of downloaded NeuroVault metadata.
+
+When run offline, the neurovault fetcher re-reads every downloaded image
+and collection json file, then filters them one python function at a time.
+The catalog stores the same metadata in a single sqlite file, and the
+neurosynth term scores as a (terms x images) matrix in a binary .npz file
+next to it. Both are built once, so offline fetches become indexed queries.
+"""
+
+import json
+import os
+import os.path as op
+import sqlite3
+
+import numpy as np
+
+from .terms import TermScores
+
+
+# Image metadata fields stored as (indexed) columns, so they can be queried.
+INDEXED_FIELDS = ('collection_id', 'map_type', 'modality',
+                  'analysis_level', 'is_thresholded', 'not_mni')
+
+# Bump when the schema changes; older catalogs are rebuilt on next use.
+CATALOG_VERSION = 2
+
+
+def get_catalog_path(data_dir=None):
+    from nilearn import datasets
+    return op.join(datasets.utils._get_dataset_dir('neurovault', data_dir=data_dir),
+                   'catalog.sqlite')
+
+
+def get_catalog_terms_path(catalog_path):
+    return op.splitext(catalog_path)[0] + '_terms.npz'
+
+
+def remove_catalog(catalog_path=None):
+    """Remove the catalog (e.g. when it goes stale); it is rebuilt on next use."""
+    catalog_path = catalog_path or get_catalog_path()
+    for path in (catalog_path, get_catalog_terms_path(catalog_path)):
+        if op.exists(path):
+            os.remove(path)
+
+
+def get_catalog_version(catalog_path):
+    conn = sqlite3.connect(catalog_path)
+    try:
+        return conn.execute("PRAGMA user_version").fetchone()[0]
+    finally:
+        conn.close()
+
+
+def build_catalog(catalog_path=None, **kwargs):
+    """Build the catalog from all locally downloaded NeuroVault data."""
+    from nilearn import datasets
+    catalog_path = catalog_path or get_catalog_path()
+    print("Building neurovault catalog at %s; may take time." % catalog_path)
+
+    ss_all = datasets.fetch_neurovault(
+        query_server=False, max_images=np.inf, fetch_terms=True, **kwargs)
+    images = ss_all['images']
+    collections = ss_all['collections'].values()
+    term_scores = TermScores.from_dict(ss_all.get('terms'), n_images=len(images))
+
+    # Term scores go in a binary file, indexed by image id.
+    # (Written to a per-process temp file: builders may run concurrently.)
+    terms_path = get_catalog_terms_path(catalog_path)
+    tmp_terms_path = '%s.%d.tmp' % (terms_path, os.getpid())
+    with open(tmp_terms_path, 'wb') as fp:
+        np.savez(fp, image_ids=[image['id'] for image in images],
+                 terms=term_scores.terms, matrix=term_scores.matrix)
+    os.rename(tmp_terms_path, terms_path)
+
+    # Build into a temp file, so an interrupted build
+    # never leaves a partial catalog behind.
+    tmp_path = '%s.%d.tmp' % (catalog_path, os.getpid())
+    if op.exists(tmp_path):
+        os.remove(tmp_path)
+    conn = sqlite3.connect(tmp_path)
+    with conn:
+        # fetch_order: position in the fetcher's output, so that max_images
+        # picks the same images as the fetcher does.
+        conn.execute("CREATE TABLE images (id INTEGER PRIMARY KEY, fetch_order INTEGER, "
+                     "%s, metadata TEXT)" % ', '.join(INDEXED_FIELDS))
+        conn.execute("CREATE TABLE collections (id INTEGER PRIMARY KEY, "
+                     "metadata TEXT)")
+        for field in INDEXED_FIELDS:
+            conn.execute("CREATE INDEX images_%s ON images (%s)" % (field, field))
+
+        conn.execute("CREATE INDEX images_fetch_order ON images (fetch_order)")
+        conn.execute("PRAGMA user_version = %d" % CATALOG_VERSION)
+
+        conn.executemany(
+            "INSERT INTO images VALUES (?, ?, %s, ?)" % ', '.join(['?'] * len(INDEXED_FIELDS)),
+            [[image['id'], ii] + [image.get(field) for field in INDEXED_FIELDS] +
+             [json.dumps(image, default=str)] for ii, image in enumerate(images)])
+        conn.executemany(
+            "INSERT INTO collections VALUES (?, ?)",
+            [(coll['id'], json.dumps(coll, default=str)) for coll in collections])
+    conn.close()
+    os.rename(tmp_path, catalog_path)
+
+    print("Cataloged %d images from %d collections." % (
+        len(images), len(collections)))
+    return catalog_path
+
+
+def query_catalog(catalog_path=None, map_types=None, analysis_levels=None, filters=None,
+                  collection_ids=tuple(), image_filters=tuple(),
+                  max_images=np.inf, fetch_terms=True, data_dir=None):
+    """Query the catalog; mirrors the output of the neurovault fetcher.
+
+    analysis_levels: list
+        Allowed analysis levels; '' matches images with no level given.
+    filters: dict
+        Exact-match values for any of INDEXED_FIELDS.
+    collection_ids: list
+        Positive ids restrict to those collections; negative ids exclude them.
+    image_filters: list
+        Python functions (image dict => bool), applied after the query.
+    data_dir: str
+        nilearn data directory (of the downloads, and the default catalog).
+
+    Images are returned in the fetcher's order (as of building the
+    catalog), so max_images keeps the same images as the fetcher would.
+    """
+    catalog_path = catalog_path or get_catalog_path(data_dir=data_dir)
+    if not (op.exists(catalog_path) and
+            op.exists(get_catalog_terms_path(catalog_path)) and
+            get_catalog_version(catalog_path) == CATALOG_VERSION):
+        build_catalog(catalog_path, data_dir=data_dir)
+
+    # Build the query
+    where, params = [], []
+    if map_types is not None:
+        where.append("map_type IN (%s)" % ', '.join(['?'] * len(map_types)))
+        params += list(map_types)
+    if analysis_levels is not None:
+        where.append("COALESCE(analysis_level, '') IN (%s)" % ', '.join(['?'] * len(analysis_levels)))
+        params += list(analysis_levels)
+    for field, val in (filters or dict()).items():
+        assert field in INDEXED_FIELDS, "Cannot query on %s" % field
+        where.append("%s = ?" % field)
+        params.append(val)
+    include_ids = [cid for cid in collection_ids if cid > 0]
+    exclude_ids = [-cid for cid in collection_ids if cid < 0]
+    for ids, op_str in ((include_ids, "IN"), (exclude_ids, "NOT IN")):
+        if ids:
+            where.append("collection_id %s (%s)" % (op_str, ', '.join(['?'] * len(ids))))
+            params += ids
+    sql = "SELECT metadata FROM images"
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += " ORDER BY fetch_order"
+    if not image_filters and np.isfinite(max_images):
+        sql += " LIMIT %d" % max_images
+
+    conn = sqlite3.connect(catalog_path)
+    images = [json.loads(row[0]) for row in conn.execute(sql, params)]
+    images = [image for image in images
+              if all(filt(image) for filt in image_filters)]
+    if np.isfinite(max_images):
+        images = images[:int(max_images)]
+
+    coll_ids = sorted(set(image['collection_id'] for image in images))
+    collections = dict()
+    for cid in coll_ids:
+        row = conn.execute("SELECT metadata FROM collections WHERE id = ?",
+                           (cid,)).fetchone()
+        if row is not None:
+            collections[cid] = json.loads(row[0])
+
+    conn.close()
+
+    out = dict(images=images, collections=collections)
+    if fetch_terms:
+        with np.load(get_catalog_terms_path(catalog_path)) as npz:
+            # Look up each image's column by binary search on the ids.
+            all_ids = npz['image_ids']
+            sort_idx = np.argsort(all_ids)
+            cols = sort_idx[np.searchsorted(all_ids[sort_idx],
+                                            [image['id'] for image in images])]
+            out['terms'] = TermScores(npz['terms'], npz['matrix'][:, cols])
+
+    return out
@@ -0,0 +1,71 @@
+# *- encoding: utf-8 -*-
+# Author: Ben Cipollini, Ami Tsuchida
+# License: BSD
+"""
+Checkpoints, so that long sweeps can be resumed.
+
+Outputs are written with atomic_path: to a temporary file that is
+renamed into place once complete, so a crash never leaves a truncated
+output behind. A Manifest records which units of work (e.g. the ICA of
+one hemisphere at one n_components) are done, with their results.
+"""
+
+import json
+import os
+import os.path as op
+from contextlib import contextmanager
+
+
+def get_tmp_path(path):
+    """path, with a temporary (per-process) suffix before its extension(s),
+    so writers that check or add extensions (nibabel, numpy) are happy."""
+    dirname, basename = op.split(path)
+    stem, dot, ext = basename.partition('.')
+    return op.join(dirname, '%s.tmp%d%s%s' % (stem, os.getpid(), dot, ext))
+
+
+@contextmanager
+def atomic_path(path):
+    """Yield a temporary path to write to; on success, it's renamed to path."""
+    if op.dirname(path) and not op.exists(op.dirname(path)):
+        os.makedirs(op.dirname(path))
+    tmp_path = get_tmp_path(path)
+    try:
+        yield tmp_path
+        os.rename(tmp_path, path)
+    finally:
+        if op.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+class Manifest(object):
+    """
+    Units of work done so far, saved as json after each one.
+
+    Units are strings, e.g. 'ica/wb/20'; each maps to a dict of
+    (json-serializable) results. Unless resume, the manifest starts empty.
+    """
+    def __init__(self, path, resume=False):
+        self.path = path
+        self.units = dict()
+        if resume and op.exists(path):
+            with open(path, 'r') as fp:
+                self.units = json.load(fp)
+            print("Resuming from %s (%d units done)" % (path, len(self.units)))
+        else:
+            self.save()
+
+    def is_done(self, unit):
+        return unit in self.units
+
+    def get(self, unit):
+        return self.units[unit]
+
+    def mark_done(self, unit, **results):
+        self.units[unit] = results
+        self.save()
+
+    def save(self):
+        with atomic_path(self.path) as tmp_path:
+            with open(tmp_path, 'w') as fp:
+                json.dump(self.units, fp, indent=1, sort_keys=True)
@@ -2,30 +2,32 @@
 # Author: Ben Cipollini, Ami Tsucihda
 # License: BSD
 
-from collections import OrderedDict
+import hashlib
+import json
+import os
+import os.path as op
 
 import nibabel as nib
 import numpy as np
-from nilearn import datasets
 
+# nilearn and joblib are imported where they're used; they're slow to import.
+from .catalog import get_catalog_path, query_catalog, remove_catalog
+from .terms import TermScores
 
-def _dict_compare(d1, d2):
-    d1_keys = set(d1.keys())
-    d2_keys = set(d2.keys())
-    intersect_keys = d1_keys.intersection(d2_keys)
-    added = d1_keys - d2_keys
-    removed = d2_keys - d1_keys
-    modified = {o: (d1[o], d2[o]) for o in intersect_keys if d1[o] != d2[o]}
-    same = set(o for o in intersect_keys if d1[o] == d2[o])
-    return added, removed, modified, same
+# Extra fetcher arguments (kwargs) the local catalog handles (see fetch_neurovault).
+CATALOG_KWARGS = ('data_dir',)
 
 
-def _is_dict_same(d1, d2):
-    added, removed, modified, same = _dict_compare(d1, d2)
-    return len(added) == 0 and len(removed) == 0 and len(modified) == 0 and len(same) == len(d1)
+def _image_content_hash(path):
+    """Hash of an image's (non-nan) voxel data, for exact duplicate checks."""
+    dat = nib.load(path).get_data()
+    dat = dat[np.logical_not(np.isnan(dat))].astype(np.float64)
+    return hashlib.sha1(dat.tobytes()).hexdigest()
 
 
-def _neurovault_dedupe(images, term_scores, strict=False, verbose=False):
+def _neurovault_dedupe(images, term_scores, strict=False, verbose=False,
+                       n_jobs=-1):
+    from sklearn.externals.joblib import Parallel, delayed
     print "Deduping %d images..." % len(images)
 
     # map type is from the user, so not dependable.
@@ -34,55 +36,127 @@ def _neurovault_dedupe(images, term_scores, strict=False, verbose=False):
         'not_mni', 'perc_bad_voxels',
         'perc_voxels_outside']
 
-    reduced_dicts = OrderedDict()  # store as dicts for easy manual verification
+    # Index kept images by their reduced metadata, so each image
+    # is checked against all previously kept ones with a single lookup.
+    kept_by_key = dict()
     non_dup_images = []
+    dup_pairs = []  # (duplicate image, kept image it duplicates)
     binary_idx = []
 
     for image in images:
-        reduced_image = dict([(key, image.get(key))
-                              for key in keys_to_compare])
-        dup_images = [_is_dict_same(reduced_image, im)
-                      for key, im in reduced_dicts.items()]
-        is_dup = not np.any(dup_images)
+        reduced_key = tuple(image.get(key) for key in keys_to_compare)
+        dup_image = kept_by_key.get(reduced_key)
+        is_dup = dup_image is None
         binary_idx.append(is_dup)
 
         if is_dup:
             # print "Added image %s" % image['id']
-            reduced_dicts[image['id']] = reduced_image
+            kept_by_key[reduced_key] = image
             non_dup_images.append(image)
-
-        elif verbose:
-            dup_idx = np.where(dup_images)[0][0]
-            dup_key = reduced_dicts.keys()[dup_idx]
-            dup_image = non_dup_images[np.find(dup_images)[0]]
-
+        else:
+            dup_pairs.append((image, dup_image))
+
+    if verbose and dup_pairs:
+        if strict:
+            # Duplicate; verify via image data. Only images involved in
+            # a metadata collision need hashing.
+            paths = sorted(set(im['local_path'] for pair in dup_pairs
+                               for im in pair))
+            hashes = Parallel(n_jobs=n_jobs)(
+                delayed(_image_content_hash)(path) for path in paths)
+            content_hash = dict(zip(paths, hashes))
+
+        for image, dup_image in dup_pairs:
             if not strict:
                 hard_reject = True
             else:
-                # Duplicate; verify via image data.
-                d1 = nib.load(dup_image['local_path']).get_data()
-                d1 = d1[np.logical_not(np.isnan(d1))]
-                d2 = nib.load(image['local_path']).get_data()
-                d2 = d2[np.logical_not(np.isnan(d2))]
-
-                hard_reject = np.all(np.abs(d1 - d2) < 1E-10)
+                hard_reject = (content_hash[image['local_path']] ==
+                               content_hash[dup_image['local_path']])
 
             if hard_reject:
                 print "Duplicate: %s duplicates %s" % (
-                    image['id'], dup_key)
+                    image['id'], dup_image['id'])
             else:
                 print "Duplicate metadata, but not duplicate image (%s and %s). Discarding anyway." % (
-                    image['id'], dup_key)
+                    image['id'], dup_image['id'])
 
     # Now filter each term
-    binary_idx = np.asarray(binary_idx)
-    for term in term_scores:
-        term_scores[term] = term_scores[term][binary_idx]
+    term_scores = term_scores.take(np.asarray(binary_idx, dtype=bool))
 
     print "Kept %d of %d images" % (len(non_dup_images), len(images))
     return non_dup_images, term_scores
 
 
+def _file_stamp(path):
+    """(mtime, size) of a file; used to detect stale cached entries."""
+    stat = os.stat(path)
+    return [stat.st_mtime, stat.st_size]
+
+
+# Bump when _compute_image_stats changes, so indexed stats are recomputed.
+IMAGE_STATS_VERSION = 2
+
+
+def _compute_image_stats(path):
+    """Summary statistics of an image's data, for quality control."""
+    img = nib.load(path)
+    dat = img.get_data()
+    vals = dat[dat != 0]  # nonzero, including nan and inf
+    nans = np.isnan(vals)
+    return dict(
+        stamp=_file_stamp(path),
+        version=IMAGE_STATS_VERSION,
+        n_pos=int((vals > 0).sum()),
+        n_neg=int((vals < 0).sum()),
+        n_nan=int(nans.sum()),
+        # Each nan counts as a unique value (as np.unique did before numpy 1.21)
+        n_unique=int(np.unique(vals[~nans]).size + nans.sum()),
+        frac_nonfinite=1. - np.isfinite(dat).sum() / float(dat.size),
+        shape=list(dat.shape),
+        affine=img.affine.tolist())
+
+
+def get_image_stats(paths, index_path=None, n_jobs=-1):
+    """Return per-image QC statistics, computing them only for new files.
+
+    Stats are kept in a json sidecar index (by default next to the
+    neurovault data), keyed by file path. Entries whose file mtime or
+    size changed (or from an older IMAGE_STATS_VERSION) are recomputed;
+    new entries are computed in parallel.
+
+    Returns a list of dicts (one per path) with keys:
+    n_pos, n_neg (including +/-inf), n_nan, n_unique (of nonzero values;
+    each nan counts as one), frac_nonfinite, shape, affine.
+    """
+    from nilearn import datasets
+    from sklearn.externals.joblib import Parallel, delayed
+    if index_path is None:
+        index_path = op.join(datasets.utils._get_dataset_dir('neurovault'),
+                             'image_stats.json')
+    index = dict()
+    if op.exists(index_path):
+        with open(index_path, 'r') as fp:
+            index = json.load(fp)
+
+    stale_paths = [path for path in set(paths)
+                   if index.get(path, {}).get('stamp') != _file_stamp(path) or
+                   index[path].get('version') != IMAGE_STATS_VERSION]
+    if stale_paths:
+        print "Computing image statistics for %d new images..." % len(stale_paths)
+        all_stats = Parallel(n_jobs=n_jobs)(
+            delayed(_compute_image_stats)(path) for path in stale_paths)
+        index.update(zip(stale_paths, all_stats))
+
+        # Write to a temp file first, so an interrupted run
+        # never leaves a truncated index behind.
+        tmp_path = '%s.%d.tmp' % (index_path, os.getpid())
+        with open(tmp_path, 'w') as fp:
+            json.dump(index, fp)
+        os.rename(tmp_path, index_path)
+
+    return [index[path] for path in paths]
+
+
 def _neurovault_remove_bad_images(images, term_scores, verbose=False):
     """Bad images are:
     * Images that only have positive or negative values.
@@ -92,10 +166,12 @@ def _neurovault_remove_bad_images(images, term_scores, verbose=False):
     good_images = []
     binary_idx = []
 
-    for image in images:
-        dat = nib.load(image['local_path']).get_data()
-        dat = dat[dat != 0]
-        is_rejected = np.all(dat > 0) or np.all(dat < 0) or (np.unique(dat).size < 2000)
+    all_stats = get_image_stats([image['local_path'] for image in images])
+    for image, stats in zip(images, all_stats):
+        # Nonzero values all positive, or all negative (a nan is neither)
+        all_pos = stats['n_neg'] + stats['n_nan'] == 0
+        all_neg = stats['n_pos'] + stats['n_nan'] == 0
+        is_rejected = all_pos or all_neg or stats['n_unique'] < 2000
 
         image['rejected'] = is_rejected
         binary_idx.append(not is_rejected)
@@ -106,9 +182,7 @@ def _neurovault_remove_bad_images(images, term_scores, verbose=False):
             print "REJECT: %s %s " % (image['map_type'], image['local_path'])
 
     # Now filter each term
-    binary_idx = np.asarray(binary_idx)
-    for term in term_scores:
-        term_scores[term] = term_scores[term][binary_idx]
+    term_scores = term_scores.take(np.asarray(binary_idx, dtype=bool))
 
     print "Kept %d of %d images" % (len(good_images), len(images))
     return good_images, term_scores
@@ -116,8 +190,19 @@ def _neurovault_remove_bad_images(images, term_scores, verbose=False):
 
 def fetch_neurovault(max_images=np.inf, query_server=True, fetch_terms=True,
                      map_types=['F map', 'T map', 'Z map'], collection_ids=tuple(),
-                     image_filters=tuple(), sort_images=True, **kwargs):
-    """Give meaningful defaults, extra computations."""
+                     image_filters=tuple(), sort_images=True, use_catalog=True,
+                     **kwargs):
+    """Give meaningful defaults, extra computations.
+
+    When offline (query_server=False) and use_catalog, metadata are read
+    from a local sqlite catalog (see nilearn_ext.catalog), built once from
+    the downloaded files. The catalog handles the collection_ids,
+    image_filters and data_dir fetcher arguments; with any other
+    fetcher arguments (kwargs), the fetcher is used instead. Either way,
+    max_images keeps the first images in the fetcher's order.
+    """
+    from nilearn import datasets
+
     # Set image filters: The filt_dict contains metadata field for the key
     # and the desired entry for each field as the value.
     # Since neurovault metadata are not always filled, it also includes any
@@ -125,14 +210,7 @@ def fetch_neurovault(max_images=np.inf, query_server=True, fetch_terms=True,
     filt_dict = {'modality': 'fMRI-BOLD',
                  'is_thresholded': False, 'not_mni': False}
 
-    def make_fun(key, val):
-        return lambda img: img.get(key) == val
-    image_filters = list(image_filters) + [
-        lambda img: (img.get('map_type') or '') in map_types,
-        lambda img: (img.get('analysis_level') or '') in ('', 'group')
-    ]
-    image_filters = (image_filters +
-                     [make_fun(key, val) for key, val in filt_dict.items()])
+    analysis_levels = ('', 'group')
 
     # Also remove bad collections
     bad_collects = [367,   # Single image w/ large uniform area value > 0
@@ -144,16 +222,41 @@ def fetch_neurovault(max_images=np.inf, query_server=True, fetch_terms=True,
     col_ids = [-bid for bid in bad_collects]
     collection_ids = list(collection_ids) + col_ids
 
-    kwargs['image_filters'] = (list(kwargs.get('image_filters', [])) +
-                               image_filters)
-    kwargs['collection_ids'] = (kwargs.get('collection_ids', []) +
-                                collection_ids)
-    ss_all = datasets.fetch_neurovault(
-        query_server=query_server,
-        max_images=max_images, map_types=map_types,
-        fetch_terms=fetch_terms, **kwargs)
+    use_catalog = use_catalog and not set(kwargs) - set(CATALOG_KWARGS)
+    if not query_server and use_catalog:
+        # Offline: filter and sort through indexed queries on the local catalog;
+        # only user-specified python filters are run image by image.
+        ss_all = query_catalog(
+            map_types=map_types, analysis_levels=analysis_levels, filters=filt_dict,
+            collection_ids=collection_ids, image_filters=list(image_filters),
+            max_images=max_images, fetch_terms=fetch_terms,
+            data_dir=kwargs.get('data_dir'))
+
+    else:
+        def make_fun(key, val):
+            return lambda img: img.get(key) == val
+        image_filters = list(image_filters) + [
+            lambda img: (img.get('map_type') or '') in map_types,
+            lambda img: (img.get('analysis_level') or '') in analysis_levels
+        ]
+        image_filters = (image_filters +
+                         [make_fun(key, val) for key, val in filt_dict.items()])
+
+        kwargs['image_filters'] = (list(kwargs.get('image_filters', [])) +
+                                   image_filters)
+        kwargs['collection_ids'] = (kwargs.get('collection_ids', []) +
+                                    collection_ids)
+        ss_all = datasets.fetch_neurovault(
+            query_server=query_server,
+            max_images=max_images, map_types=map_types,
+            fetch_terms=fetch_terms, **kwargs)
+
+        # New downloads make the local catalog stale; rebuild on next use.
+        if query_server:
+            remove_catalog(get_catalog_path(data_dir=kwargs.get('data_dir')))
+
     images = ss_all['images']
-    term_scores = ss_all.get('terms', dict())
+    term_scores = TermScores.from_dict(ss_all.get('terms'), n_images=len(images))
 
     # Post-fetcher filtering: remove duplicates, bad images from raw data.
     images, term_scores = _neurovault_dedupe(images, term_scores)
@@ -166,9 +269,8 @@ def fetch_neurovault(max_images=np.inf, query_server=True, fetch_terms=True,
 
     if fetch_terms:
         # Clean & report term scores
-        terms = np.array(term_scores.keys())
-        term_matrix = np.asarray(term_scores.values())
-        term_matrix[term_matrix < 0] = 0
+        terms = term_scores.terms
+        term_matrix = term_scores.matrix.clip(min=0)
         total_scores = np.mean(term_matrix, axis=1)
 
         print("Top 10 neurosynth terms from downloaded images:")
@@ -176,16 +278,14 @@ def fetch_neurovault(max_images=np.inf, query_server=True, fetch_terms=True,
             print('\t%-25s: %.2f' % (terms[term_idx], total_scores[term_idx]))
 
     if sort_images:
-        idx = sorted(
-            range(len(images)),
-            lambda k1, k2: images[k1]['id'] - images[k2]['id'])
+        idx = np.argsort([image['id'] for image in images], kind='mergesort')
         images = [images[ii] for ii in idx]
-        for key in term_scores:
-            term_scores[key] = [term_scores[key][ti] for ti in idx]
+        term_scores = term_scores.take(idx)
     return images, term_scores
 
 
 def fetch_grey_matter_mask():
+    from nilearn import datasets
     url = 'https://github.com/NeuroVault/neurovault_analysis/raw/master/gm_mask.nii.gz'
     mask = datasets.utils._fetch_files(
         datasets.utils._get_dataset_dir('neurovault'),
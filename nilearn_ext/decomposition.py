@@ -6,28 +6,153 @@
 
 import os
 import os.path as op
+from collections import OrderedDict
 
 import numpy as np
-from nilearn import datasets
-from nilearn.image import iter_img
-from nilearn.masking import apply_mask
 
 from six import string_types
-from sklearn.decomposition import FastICA
-from sklearn.externals.joblib import Memory
-from scipy import stats
+from scipy import sparse, stats
 
 from nibabel_ext import NiftiImageWithTerms
-from .image import cast_img, clean_img
-from .masking import HemisphereMasker, flip_img_lr, GreyMatterNiftiMasker, get_hemi_gm_mask
+from .backends import DEFAULT_BACKEND, get_backend
+from .checkpoint import atomic_path
+from .cache import (enforce_budget, file_stamp, fingerprint, get_memory, hash_array,
+                    load_arrays, parse_size, save_arrays)
+from .image import get_grid_key, get_resampling_matrix, load_clean_img
+from .terms import TermScores
+from .tracing import stage
+
+# nilearn (and so .masking) and joblib are imported where they're used;
+# they're slow to import.
+
+
+def mask_images(images, masker, hemi='', reducer=None):
+    """
+    Load, clean and mask images into an (images x voxels) matrix.
+
+    NeuroVault images come on a handful of distinct grids, so images are
+    grouped by (affine, shape). Each group gets a single (sparse) resampling
+    map onto the mask voxels, applied to every image in the group; images
+    already on the mask's grid skip resampling altogether.
+
+    reducer: optional sparse (voxels x features) matrix; each masked image
+    is multiplied by it as it's loaded, so the full (images x voxels)
+    matrix is never held in memory.
+
+    Returns the matrix (only rows of images that could be masked) and a
+    boolean array marking those images.
+    """
+    from nilearn._utils import check_niimg
+
+    mask_img = masker.mask_img_
+    mask_data = mask_img.get_data() > 0
+    n_features = (np.count_nonzero(mask_data) if reducer is None
+                  else reducer.shape[1])
+
+    # Images may fail to be transformed, and are of different shapes,
+    # so we need to trasnform one-by-one and keep track of failures.
+    X = np.zeros((len(images), n_features), dtype=np.float32)  # noqa
+    xformable_idx = np.ones((len(images),), dtype=bool)
+    n_nonfinite = np.zeros((len(images),), dtype=int)
+
+    grid_groups = OrderedDict()
+    for ii, im in enumerate(images):
+        grid_groups.setdefault(get_grid_key(check_niimg(im)), []).append(ii)
+
+    for (affine, shape), group_idx in grid_groups.items():
+        affine = np.reshape(affine, (4, 4))
+        on_grid = (shape == mask_data.shape and
+                   np.allclose(affine, mask_img.affine))
+        resampler = None if on_grid else get_resampling_matrix(
+            affine, shape, mask_img)
+
+        for ii in group_idx:
+            im = images[ii]
+            img, n_nonfinite[ii] = load_clean_img(im, dtype=np.float32)
+            try:
+                data = img.get_data()
+                if data.ndim == 4 and data.shape[3] == 1:
+                    data = data[..., 0]
+                if data.ndim != 3:  # Leave odd images to the masker.
+                    row = masker.transform(img).ravel()
+                elif on_grid:
+                    row = data[mask_data]
+                else:
+                    row = resampler.dot(data.ravel())
+                X[ii] = row if reducer is None else reducer.T.dot(row)
+            except Exception as e:
+                print("Failed to mask/reshape image %s: %s" % (
+                    op.basename(im) if isinstance(im, string_types) else ii, e))
+                xformable_idx[ii] = False
+
+    print("%s: Masked %d images from %d distinct grids." % (
+        hemi, np.count_nonzero(xformable_idx), len(grid_groups)))
+    if n_nonfinite.any():
+        print("%s: Zeroed non-finite voxels in %d of %d images." % (
+            hemi, np.count_nonzero(n_nonfinite), len(images)))
+
+    return X[xformable_idx], xformable_idx
+
+
+def get_image_fingerprint(img):
+    """Cheap description of an image: its path, mtime and size for files,
+    a hash of its data and affine otherwise."""
+    from nilearn._utils import check_niimg
+    if isinstance(img, string_types):
+        return file_stamp(img)
+    img = check_niimg(img)
+    return [hash_array(img.get_data()), hash_array(img.affine)]
+
+
+def get_decomposition_key(images, mask_img, parcellation=None, **params):
+    """
+    Fingerprint of a decomposition: of the input images (see
+    get_image_fingerprint), the mask, the parcellation and the parameters.
+
+    Computing it reads file metadata, not image data, so it's
+    O(images), where hashing the masked data is O(images x voxels).
+    """
+    return fingerprint(dict(
+        images=[get_image_fingerprint(img) for img in images],
+        mask=[hash_array(mask_img.get_data()), hash_array(mask_img.affine)],
+        parcellation=(None if parcellation is None
+                      else get_image_fingerprint(parcellation)),
+        params=params))
 
 
 def generate_components(images, hemi, term_scores=None,
                         n_components=20, random_state=42,
-                        out_dir=None, memory=Memory(cachedir='nilearn_cache')):
+                        out_dir=None, memory=None,
+                        resolution=None, parcellation=None,
+                        backend=DEFAULT_BACKEND, n_seeds=10):
     """Images: list
     Can be nibabel images, can be file paths.
+
+    term_scores: TermScores (terms x images), or dict of term => scores
+
+    resolution: if set, the grey matter mask and all images are resampled
+    to an isotropic grid of this resolution (mm) before masking and ICA.
+
+    parcellation: if set, a label image (or path). Each image is reduced to
+    its mean over each (hemisphere-split) parcel, ICA runs on the
+    (images x parcels) matrix, and the component maps are projected back
+    onto the voxels (constant within each parcel).
+
+    backend: name of the decomposition backend (see nilearn_ext.backends).
+
+    n_seeds: number of FastICA runs for the 'ensemble' backend. Per-component
+    stability scores are kept in img.extra['stability'], and saved next to
+    the image (see get_stability_path).
+
+    memory: joblib Memory for the masker (default: get_memory()). Masked
+    images aren't cached; decompositions are cached in its directory,
+    keyed by get_decomposition_key, so neither masking nor the
+    decomposition re-run for the same images, mask and parameters.
     """
+    from nilearn import datasets
+    from .masking import GreyMatterNiftiMasker, HemisphereMasker, get_parcel_matrix
+    memory = get_memory() if memory is None else memory
+
     # Create grey matter mask from mni template
     target_img = datasets.load_mni152_template()
 
@@ -36,57 +161,76 @@ def generate_components(images, hemi, term_scores=None,
     if hemi == 'wb':
         masker = GreyMatterNiftiMasker(target_affine=target_img.affine,
                                        target_shape=target_img.shape,
-                                       memory=memory)
+                                       memory=memory, resolution=resolution)
 
     else:  # R and L maskers
         masker = HemisphereMasker(target_affine=target_img.affine,
                                   target_shape=target_img.shape,
                                   memory=memory,
-                                  hemisphere=hemi)
+                                  hemisphere=hemi,
+                                  resolution=resolution)
     masker = masker.fit()
 
-    # Images may fail to be transformed, and are of different shapes,
-    # so we need to trasnform one-by-one and keep track of failures.
-    X = []  # noqa
-    xformable_idx = np.ones((len(images),), dtype=bool)
-    for ii, im in enumerate(images):
-        img = cast_img(im, dtype=np.float32)
-        img = clean_img(img)
-        try:
-            X.append(masker.transform(img))
-        except Exception as e:
-            print("Failed to mask/reshape image %d/%s: %s" % (
-                im.get('collection_id', 0),
-                op.basename(im),
-                e))
-            xformable_idx[ii] = False
-
-    # Now reshape list into 2D matrix
-    X = np.vstack(X)  # noqa
-
-    # Run ICA and map components to terms
-    print("%s: Running ICA; may take time..." % hemi)
-    fast_ica = FastICA(n_components=n_components, random_state=random_state)
-    fast_ica = memory.cache(fast_ica.fit)(X.T)
-    ica_maps = memory.cache(fast_ica.transform)(X.T).T
+    if parcellation is None:
+        membership = reducer = None
+    else:
+        membership, parcels = get_parcel_matrix(parcellation, masker.mask_img_)
+        n_voxels = np.asarray(membership.sum(axis=0)).ravel()
+        reducer = membership.dot(sparse.diags(1. / n_voxels, 0)).tocsc()  # parcel means
+        print("%s: Reducing images to %d parcels." % (hemi, len(parcels)))
+
+    decomposition_key = get_decomposition_key(
+        images, masker.mask_img_, parcellation=parcellation,
+        n_components=n_components, random_state=random_state,
+        backend=backend, n_seeds=n_seeds if backend == 'ensemble' else None)
+    cached = load_arrays(memory, 'nilearn_ext.decomposition.generate_components',
+                         decomposition_key)
+    if cached is not None:
+        print("%s: Loaded %s results from the cache." % (hemi, backend))
+        ica_maps, C = cached.pop('maps'), cached.pop('components')
+        xformable_idx = cached.pop('xformable_idx')
+        info = cached
+
+    else:
+        with stage('mask_images', hemi=hemi, n_components=n_components) as st:
+            X, xformable_idx = mask_images(images, masker, hemi=hemi, reducer=reducer)  # noqa
+            st.add(len(X))
+
+        # Run ICA
+        print("%s: Running %s; may take time..." % (hemi, backend))
+        with stage('decompose', hemi=hemi, n_components=n_components, backend=backend) as st:
+            result = get_backend(backend)(
+                X, n_components=n_components, random_state=random_state,
+                n_seeds=n_seeds)
+            st.add(len(X))
+        ica_maps, C = result[:2]
+        info = result[2] if len(result) > 2 else dict()
+        save_arrays(memory, 'nilearn_ext.decomposition.generate_components',
+                    decomposition_key, maps=ica_maps, components=C,
+                    xformable_idx=xformable_idx, **info)
+        del X
 
     # Tomoki's suggestion to normalize components_
-    # X ~ ica_maps * fast_ica.components_
-    #   = (ica_maps * f) * (fast_ica.components_ / f)
+    # X ~ ica_maps * components_
+    #   = (ica_maps * f) * (components_ / f)
     #   = new_ica_map * new_components_
-    C = fast_ica.components_
     factor = np.sqrt(
         np.multiply(C, C).sum(axis=1, keepdims=True))  # (n_components x 1)
     ica_maps = np.multiply(ica_maps, factor)
-    fast_ica.components_ = np.multiply(C, 1.0 / (factor + 1e-12))
+    components = np.multiply(C, 1.0 / (factor + 1e-12))
+
+    if membership is not None:  # parcels => voxels
+        ica_maps = membership.dot(ica_maps.T).T
 
     if term_scores is not None:
-        terms = term_scores.keys()
-        term_matrix = np.asarray(term_scores.values())
-        term_matrix[term_matrix < 0] = 0
-        term_matrix = term_matrix[:, xformable_idx]  # terms x images
-        # Don't use the transform method as it centers the data
-        ica_terms = np.dot(term_matrix, fast_ica.components_.T).T
+        with stage('term_projection', hemi=hemi, n_components=n_components) as st:
+            term_scores = TermScores.from_dict(term_scores, n_images=len(images))
+            terms = term_scores.terms
+            term_matrix = term_scores.matrix.clip(min=0)
+            term_matrix = term_matrix[:, xformable_idx]  # terms x images
+            # Don't use the transform method as it centers the data
+            ica_terms = np.dot(term_matrix, components.T).T
+            st.add(len(terms))
 
     # 2015/12/26 - sign matters for comparison, so don't do this!
     # 2016/02/01 - sign flipping is ok for R-L comparison, but RL concat
@@ -105,105 +249,232 @@ def generate_components(images, hemi, term_scores=None,
     if term_scores:
         ica_image.terms = dict(zip(terms, ica_terms.T))
 
+    # Keep the masked maps, so later analyses needn't re-mask the image.
+    ica_maps = ica_maps.astype(np.float32)
+    ica_image.extra['masked'] = (hemi, ica_maps)
+    if 'stability' in info:
+        ica_image.extra['stability'] = info['stability']
+
     # Write to disk
     if out_dir is not None:
         out_path = op.join(out_dir, '%s_ica_components.nii.gz' % hemi)
         if not op.exists(op.dirname(out_path)):
             os.makedirs(op.dirname(out_path))
-        ica_image.to_filename(out_path)
+        # Each file is written atomically, and the image last: if it
+        # exists, the run that wrote it completed.
+        with stage('save_components', hemi=hemi, n_components=n_components):
+            with atomic_path(get_masked_path(out_path)) as tmp_path:
+                np.save(tmp_path, ica_maps)
+            if 'stability' in info:
+                with atomic_path(get_stability_path(out_path)) as tmp_path:
+                    np.savetxt(tmp_path,
+                               np.c_[np.arange(len(info['stability'])), info['stability']],
+                               fmt=['%d', '%.6f'], delimiter=',',
+                               header='component,stability', comments='')
+            with atomic_path(out_path) as tmp_path:
+                ica_image.to_filename(tmp_path)
+
+    # Fits and maskers just added to the cache may put it over budget.
+    enforce_budget()
     return ica_image
 
 
+def get_masked_path(img_path):
+    """Path of the (n_components x voxels) .npy sidecar of a components image."""
+    return img_path.replace('.nii.gz', '.npy')
+
+
+def get_stability_path(img_path):
+    """Path of the per-component stability .csv of a components image."""
+    return img_path.replace('_components.nii.gz', '_stability.csv')
+
+
+# Components images kept loaded by load_components, as (file stamp, image)
+# keyed on (hemi, path); None unless keep_components_loaded (see server.py).
+_loaded_components = None
+
+
+def keep_components_loaded(keep=True):
+    """Keep the images load_components reads (and their masked data) in
+    memory, and return them on later calls until their file changes."""
+    global _loaded_components
+    _loaded_components = dict() if keep else None
+
+
+def load_components(img_path, hemi):
+    """
+    Load a components image. If it has a masked-data sidecar, it is
+    memory-mapped (see nilearn_ext.masking.get_masked_data), so analyses
+    only read the voxels they need and skip decompressing the image.
+    """
+    if _loaded_components is not None:
+        key, stamp = (hemi, op.abspath(img_path)), tuple(file_stamp(img_path))
+        if _loaded_components.get(key, (None,))[0] != stamp:
+            # New, or its file changed: (re)load, and drop the stale image.
+            _loaded_components[key] = (stamp, _load_components(img_path, hemi, mmap_mode=None))
+        return _loaded_components[key][1]
+    return _load_components(img_path, hemi)
+
+
+def _load_components(img_path, hemi, mmap_mode='r'):
+    img = NiftiImageWithTerms.from_filename(img_path)
+    masked_path = get_masked_path(img_path)
+    if op.exists(masked_path):
+        masked_data = np.load(masked_path, mmap_mode=mmap_mode)
+        masked_data.flags.writeable = False  # shared by all users of img
+        img.extra['masked'] = (hemi, masked_data)
+    stability_path = get_stability_path(img_path)
+    if op.exists(stability_path):
+        img.extra['stability'] = np.loadtxt(stability_path, delimiter=',',
+                                            skiprows=1, ndmin=2)[:, 1]
+    return img
+
+
+def _l1_tiles(data1, data2, signs, max_memory=2 ** 28, n_jobs=1):
+    """
+    l1 distances between all rows of data1 and data2, for each sign.
+
+    Computed in (rows x cols) tiles, so that the (rows x cols x voxels)
+    intermediate of each tile stays under max_memory bytes (split across
+    n_jobs threads; numpy releases the GIL, so tiles run in parallel).
+    """
+    from sklearn.externals.joblib import Parallel, delayed
+    n1, n2 = len(data1), len(data2)
+    pair_bytes = max(data1.shape[1] * data1.itemsize, 1)
+    tile_size = max(int(np.sqrt(max_memory / float(max(n_jobs, 1)) / pair_bytes)), 1)
+    scores = [np.empty((n1, n2)) for sign in signs]
+
+    def score_tile(rows, cols):
+        d1 = data1[rows, np.newaxis, :]
+        d2 = data2[np.newaxis, cols, :]
+        # One buffer per tile, reused for each sign (so the budget holds).
+        diff = np.empty((d1.shape[0], d2.shape[1], d1.shape[2]),
+                        dtype=np.result_type(d1, d2))
+        for score, sign in zip(scores, signs):
+            (np.subtract if sign > 0 else np.add)(d1, d2, out=diff)
+            score[rows, cols] = np.abs(diff, out=diff).sum(axis=2, dtype=float)
+
+    tiles = [(slice(i, i + tile_size), slice(j, j + tile_size))
+             for i in range(0, n1, tile_size) for j in range(0, n2, tile_size)]
+    Parallel(n_jobs=n_jobs, backend='threading')(
+        delayed(score_tile)(rows, cols) for rows, cols in tiles)
+    return scores
+
+
+# Defaults for the memory budget and threads of l1norm scoring, e.g. on a
+# big node: NILEARN_L1_MEMORY=4G NILEARN_L1_JOBS=8 python match.py ...
+L1_MEMORY_ENV = 'NILEARN_L1_MEMORY'
+L1_JOBS_ENV = 'NILEARN_L1_JOBS'
+
+
+def get_l1_settings(max_memory=None, n_jobs=None):
+    """max_memory (bytes) and n_jobs for l1norm scoring; unless given, from
+    $NILEARN_L1_MEMORY (e.g. 500M or 4G; default 256M) and $NILEARN_L1_JOBS
+    (default 1; -1 for all CPUs)."""
+    if max_memory is None:
+        max_memory = parse_size(os.environ.get(L1_MEMORY_ENV) or 2 ** 28)
+    if n_jobs is None:
+        n_jobs = int(os.environ.get(L1_JOBS_ENV) or 1)
+    if n_jobs < 0:
+        from sklearn.externals.joblib import cpu_count
+        n_jobs = max(cpu_count() + 1 + n_jobs, 1)
+    return max_memory, n_jobs
+
+
+def score_components(data1, data2, scoring='correlation', flip=True,
+                     max_memory=None, n_jobs=None):
+    """
+    Score every component (row) of data1 against every row of data2.
+
+    Score should indicate DISSIMILARITY.
+    Component sign is meaningless, so try both unless flip = False,
+    and keep track of comparisons that had better score
+    when flipping the sign.
+
+    max_memory: bytes for the l1norm intermediates (see _l1_tiles);
+    n_jobs: threads to compute l1norm tiles in parallel
+    (defaults for both: see get_l1_settings).
+
+    Returns (score_mat, sign_mat), each (n1 x n2).
+    """
+    signs = [1, -1] if flip else [1]
+
+    if scoring == 'l1norm':
+        max_memory, n_jobs = get_l1_settings(max_memory, n_jobs)
+        # Keep float32 data as is; it halves the memory of the tiles.
+        dtype = np.result_type(np.asarray(data1).dtype, np.asarray(data2).dtype, np.float32)
+        scores = _l1_tiles(np.asarray(data1, dtype=dtype), np.asarray(data2, dtype=dtype),
+                           signs, max_memory=max_memory, n_jobs=n_jobs)
+    else:
+        data1 = np.asarray(data1, dtype=float)
+        data2 = np.asarray(data2, dtype=float)
+        if not isinstance(scoring, string_types):  # function
+            scores = [np.asarray([[scoring(c1d, sign * c2d) for c2d in data2]
+                                  for c1d in data1]) for sign in signs]
+        elif scoring == 'l2norm':
+            sq1 = (data1 ** 2).sum(axis=1)[:, np.newaxis]
+            sq2 = (data2 ** 2).sum(axis=1)[np.newaxis, :]
+            dot = np.dot(data1, data2.T)
+            scores = [np.sqrt(np.maximum(sq1 + sq2 - 2 * sign * dot, 0))
+                      for sign in signs]
+        elif scoring == 'correlation':
+            z1 = stats.zscore(data1, axis=1)
+            z2 = stats.zscore(data2, axis=1)
+            r = np.dot(z1, z2.T) / data1.shape[1]
+            scores = [1 - sign * r for sign in signs]
+        else:
+            raise NotImplementedError(scoring)
+
+    score_mat = scores[0]
+    sign_mat = np.ones(score_mat.shape, dtype=np.int)
+    if flip:
+        # Only flip when strictly better.
+        sign_mat[scores[1] < scores[0]] = -1
+        score_mat = np.minimum(scores[0], scores[1])
+
+    return score_mat, sign_mat
+
+
 def compare_components(images, labels, scoring='correlation', flip=True,
-                       memory=Memory(cachedir='nilearn_cache')):
+                       memory=None, max_memory=None, n_jobs=None):
+    from .masking import get_masked_data
     assert len(images) == 2
     assert len(labels) == 2
     assert images[0].shape == images[1].shape
-    n_components = images[0].shape[3]  # values @ 0 and 1 are the same
     labels = [l.upper() for l in labels]  # make input labels case insensitive
     print("Loading images.")
-    for img in images:
-        img.get_data()  # Just loaded to get them in memory..
 
-    print("Scoring closest components (by %s)" % str(scoring))
-    score_mat = np.zeros((n_components, n_components))
-    sign_mat = np.zeros((n_components, n_components), dtype=np.int)
-    c1_data = [None] * n_components
-    c2_data = [None] * n_components
-
-    c1_images = list(iter_img(images[0]))
-    c2_images = list(iter_img(images[1]))
-
-    lh_masker = HemisphereMasker(hemisphere='L', memory=memory).fit()
-    rh_masker = HemisphereMasker(hemisphere='R', memory=memory).fit()
-
-    for c1i, comp1 in enumerate(c1_images):
-        for c2i, comp2 in enumerate(c2_images):
-            # Make sure the two images align (i.e. not R and L opposite),
-            #   and that only good voxels are compared (i.e. not full vs half)
-            if 'R' in labels and 'L' in labels:
-                if c1_data[c1i] is None or c2_data[c2i] is None:
-                    R_img = comp1 if labels.index('R') == 0 else comp2  # noqa
-                    L_img = comp1 if labels.index('L') == 0 else comp2  # noqa
-                    masker = lh_masker  # use same masker; ensures same size
-                if c1_data[c1i] is None:
-                    c1_data[c1i] = masker.transform(flip_img_lr(R_img)).ravel()
-                if c2_data[c2i] is None:
-                    c2_data[c2i] = masker.transform(L_img).ravel()
-
-            elif 'R' in labels or 'L' in labels:
-                masker = rh_masker if 'R' in labels else lh_masker
-                if c1_data[c1i] is None:
-                    c1_data[c1i] = masker.transform(comp1).ravel()
-                if c2_data[c2i] is None:
-                    c2_data[c2i] = masker.transform(comp2).ravel()
-
-            else:
-                if c1_data[c1i] is None:
-                    c1_data[c1i] = comp1.get_data().ravel()
-                if c2_data[c2i] is None:
-                    c2_data[c2i] = comp2.get_data().ravel()
-
-            # Choose a scoring system.
-            # Score should indicate DISSIMILARITY
-            # Component sign is meaningless, so try both unless flip = False,
-            # and keep track of comparisons that had better score
-            # when flipping the sign
-            score = np.inf
-            if flip:
-                signs = [1, -1]
-            else:
-                signs = [1]
-            for sign in signs:
-                c1d, c2d = c1_data[c1i], sign * c2_data[c2i]
-                if not isinstance(scoring, string_types):  # function
-                    sc = scoring(c1d, c2d)
-                elif scoring == 'l1norm':
-                    sc = np.linalg.norm(c1d - c2d, ord=1)
-                elif scoring == 'l2norm':
-                    sc = np.linalg.norm(c1d - c2d, ord=2)
-                elif scoring == 'correlation':
-                    sc = 1 - stats.stats.pearsonr(c1d, c2d)[0]
-                else:
-                    raise NotImplementedError(scoring)
-                if sc < score:
-                    sign_mat[c1i, c2i] = sign
-                score = min(score, sc)
-            score_mat[c1i, c2i] = score
+    # Make sure the two images align (i.e. not R and L opposite),
+    #   and that only good voxels are compared (i.e. not full vs half)
+    if 'R' in labels and 'L' in labels:
+        # use the same (L) mask for both; ensures same size
+        data = [get_masked_data(img, hemi='L', flip=label == 'R')
+                for img, label in zip(images, labels)]
 
-    return score_mat, sign_mat
+    elif 'R' in labels or 'L' in labels:
+        hemi = 'R' if 'R' in labels else 'L'
+        data = [get_masked_data(img, hemi=hemi) for img in images]
+
+    else:
+        data = [get_masked_data(img, hemi='wb') for img in images]
+
+    print("Scoring closest components (by %s)" % str(scoring))
+    with stage('score_components', hemi=' vs '.join(labels),
+               n_components=images[0].shape[3], scoring=str(scoring)) as st:
+        st.add(len(data[0]) * len(data[1]))
+        return score_components(data[0], data[1], scoring=scoring, flip=flip,
+                                max_memory=max_memory, n_jobs=n_jobs)
 
 
-def compare_RL(wb_img, scoring="correlation",
-               memory=Memory(cachedir='nilearn_cache')):
+def compare_RL(wb_img, scoring="correlation", memory=None):
     ''' Compare R and L side of the whole-brain image using the specified method'''
+    from .masking import get_masked_data
 
     n_components = wb_img.shape[3]
 
     # Use only lh_masker to ensure the same size
-    mask = get_hemi_gm_mask(hemi="L")
-    masked_r = apply_mask(flip_img_lr(wb_img), mask)
-    masked_l = apply_mask(wb_img, mask)
+    masked_r = get_masked_data(wb_img, hemi="L", flip=True)
+    masked_l = get_masked_data(wb_img, hemi="L")
 
     print("Comparing R and L spatial similarity using %s" % scoring)
     score_arr = np.zeros(n_components)
@@ -2,14 +2,17 @@
 # Author: Ben Cipollini
 # License: BSD
 
-import numpy as np
+import itertools
 
-from nilearn._utils import check_niimg
-from nilearn.image import new_img_like
+import nibabel as nib
+import numpy as np
+from scipy import sparse
 
 
 def clean_img(img):
     """Remove nan/inf entries."""
+    from nilearn._utils import check_niimg
+    from nilearn.image import new_img_like
     img = check_niimg(img)
     img_data = img.get_data()
     img_data[np.isnan(img_data)] = 0
@@ -19,6 +22,77 @@ def clean_img(img):
 
 def cast_img(img, dtype=np.float32):
     """Cast image to the specified dtype"""
+    from nilearn._utils import check_niimg
+    from nilearn.image import new_img_like
     img = check_niimg(img)
     img_data = img.get_data().astype(dtype)
     return new_img_like(img, img_data, copy_header=True)
+
+
+def load_clean_img(img, dtype=np.float32):
+    """Load an image, cast it to the specified dtype, and zero out
+    nan/inf entries, with a single read of the data and a single new image.
+
+    Returns the image and the number of non-finite voxels.
+    """
+    from nilearn._utils import check_niimg
+    from nilearn.image import new_img_like
+    img = check_niimg(img)
+    if nib.is_proxy(img.dataobj):
+        # Load, then cast: ArrayProxy.__array__ takes no dtype (nibabel < 3).
+        img_data = np.asarray(img.dataobj).astype(dtype, copy=False)
+        if not img_data.flags.writeable:  # e.g. a read-only memmap
+            img_data = np.array(img_data)
+    else:  # in-memory; don't modify the caller's data
+        img_data = np.array(img.dataobj, dtype=dtype)
+    nonfinite = np.logical_not(np.isfinite(img_data))
+    n_nonfinite = np.count_nonzero(nonfinite)
+    if n_nonfinite > 0:
+        img_data[nonfinite] = 0
+    return new_img_like(img, img_data, copy_header=True), n_nonfinite
+
+
+def get_grid_key(img):
+    """Hashable (affine, shape) key, for grouping images on the same grid."""
+    return (tuple(np.round(img.affine, 6).ravel()), tuple(img.shape[:3]))
+
+
+def get_resampling_matrix(src_affine, src_shape, mask_img):
+    """
+    Sparse (mask voxels x source voxels) matrix that (trilinearly)
+    resamples a 3D image with the given affine and shape onto the
+    voxels of mask_img, in the same order as masking.
+
+    Voxels that fall outside the source image get a value of 0
+    (as with nilearn.image.resample_img).
+    """
+    src_shape = tuple(src_shape[:3])
+    mask_data = mask_img.get_data() > 0
+    n_voxels = np.count_nonzero(mask_data)
+    ijk = np.asarray(np.where(mask_data))  # 3 x n_voxels
+
+    # mask voxel => world => source voxel coordinates
+    xform = np.dot(np.linalg.inv(src_affine), mask_img.affine)
+    src_ijk = np.dot(xform[:3, :3], ijk) + xform[:3, 3:4]
+    in_bounds = np.all(np.logical_and(
+        src_ijk >= 0, src_ijk <= np.asarray(src_shape)[:, np.newaxis] - 1), axis=0)
+    base = np.floor(src_ijk).astype(int)
+    frac = src_ijk - base
+
+    rows, cols, weights = [], [], []
+    for corner in itertools.product((0, 1), repeat=3):
+        corner_ijk = base + np.asarray(corner)[:, np.newaxis]
+        weight = np.prod([frac[d] if corner[d] else 1 - frac[d]
+                          for d in range(3)], axis=0)
+        inside = np.logical_and(
+            np.all(corner_ijk >= 0, axis=0),
+            np.all(corner_ijk < np.asarray(src_shape)[:, np.newaxis], axis=0))
+        inside = np.logical_and(inside, in_bounds)
+        inside = np.logical_and(inside, weight > 0)
+        rows.append(np.arange(n_voxels)[inside])
+        cols.append(np.ravel_multi_index(corner_ijk[:, inside], src_shape))
+        weights.append(weight[inside])
+
+    return sparse.csr_matrix(
+        (np.concatenate(weights), (np.concatenate(rows), np.concatenate(cols))),
+        shape=(n_voxels, int(np.prod(src_shape))))
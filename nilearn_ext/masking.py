@@ -3,16 +3,63 @@
 # License: BSD
 
 import numpy as np
+from scipy import sparse
 
 import nibabel as nib
 from nilearn import datasets
-from nilearn.image import iter_img, reorder_img, new_img_like, index_img
+from nilearn._utils import check_niimg
+from nilearn.image import iter_img, reorder_img, new_img_like, index_img, resample_img
 from nilearn.input_data import NiftiMasker
+from nilearn.masking import apply_mask
 from sklearn.externals.joblib import Memory
 
 from nilearn_ext.datasets import fetch_grey_matter_mask
 
 
+_gm_mask_imgs = dict()
+
+
+def get_gm_mask_img(resolution=None):
+    """
+    Get the (binary) grey matter mask, optionally resampled to a
+    coarser isotropic grid of the given resolution (in mm).
+
+    The coarse grid covers the same field of view and keeps the same
+    center, so L/R flipping still maps each hemisphere onto the other.
+    """
+    if resolution not in _gm_mask_imgs:
+        target_img = nib.load(fetch_grey_matter_mask())
+        if resolution is not None:
+            affine = target_img.affine
+            vox = np.diag(affine)[:3]
+            new_vox = np.sign(vox) * resolution
+            shape = np.asarray(target_img.shape[:3])
+            center = affine[:3, 3] + (shape - 1) * vox / 2.
+            new_shape = np.ceil((shape - 1) * np.abs(vox) / resolution).astype(int) + 1
+            new_affine = np.eye(4)
+            new_affine[:3, :3] = np.diag(new_vox)
+            new_affine[:3, 3] = center - (new_shape - 1) * new_vox / 2.
+            target_img = resample_img(
+                new_img_like(target_img, (target_img.get_data() > 0).astype(float)),
+                target_affine=new_affine, target_shape=tuple(new_shape),
+                interpolation='continuous')
+        threshold = 0 if resolution is None else 0.5
+        grey_voxels = (target_img.get_data() > threshold).astype(int)
+        _gm_mask_imgs[resolution] = new_img_like(
+            target_img, grey_voxels, copy_header=True)
+    return _gm_mask_imgs[resolution]
+
+
+def get_img_resolution(img):
+    """Resolution (mm) of an image on a coarse grid (see get_gm_mask_img);
+    None for images on the grey matter mask's own grid."""
+    gm_img = get_gm_mask_img()
+    if (img.shape[:3] == gm_img.shape[:3] and
+            np.allclose(img.affine, gm_img.affine)):
+        return None
+    return float(abs(img.affine[0, 0]))
+
+
 class GreyMatterNiftiMasker(NiftiMasker):
     def __init__(self, sessions=None, smoothing_fwhm=None,
                  standardize=False, detrend=False,
@@ -21,13 +68,12 @@ class GreyMatterNiftiMasker(NiftiMasker):
                  mask_strategy='background',
                  mask_args=None, sample_mask=None,
                  memory_level=1, memory=Memory(cachedir=None),
-                 verbose=0):
+                 verbose=0, resolution=None):
 
         # Use grey matter mask computed for Neurovault analysis
         # ('https://github.com/NeuroVault/neurovault_analysis/')
-        target_img = nib.load(fetch_grey_matter_mask())
-        grey_voxels = (target_img.get_data() > 0).astype(int)
-        mask_img = new_img_like(target_img, grey_voxels, copy_header=True)
+        mask_img = get_gm_mask_img(resolution=resolution)
+        self.resolution = resolution
 
         super(GreyMatterNiftiMasker, self).__init__(
             mask_img=mask_img,
@@ -97,6 +143,8 @@ def split_bilateral_rois(maps_img):
     """
     new_rois = []
 
+    # A 3D image (e.g. the grey matter mask) is a single map.
+    maps_img = check_niimg(maps_img, atleast_4d=True)
     for map_img in iter_img(maps_img):
         for hemi in ['L', 'R']:
             hemi_mask = HemisphereMasker(hemisphere=hemi)
@@ -121,19 +169,109 @@ def join_bilateral_rois(R_img, L_img):  # noqa
     return new_img_like(R_img, data=joined_data)
 
 
-def get_hemi_gm_mask(hemi="L"):
+_hemi_gm_masks = dict()
+
+
+def get_hemi_gm_mask(hemi="L", resolution=None):
     """Convenience function for getting WB, R or L gm mask"""
-    target_img = nib.load(fetch_grey_matter_mask())
-    grey_voxels = (target_img.get_data() > 0).astype(int)
-    gm_img = new_img_like(target_img, grey_voxels, copy_header=True)
-    gm_imgs = split_bilateral_rois(gm_img)
-    gm_imgs_d = {hemi: index_img(gm_imgs, i)
-                 for hemi, i in zip(("L", "R"), (0, 1))}
-    gm_imgs_d["wb"] = gm_img
+    if (hemi, resolution) not in _hemi_gm_masks:
+        gm_img = get_gm_mask_img(resolution=resolution)
+        if resolution is None:
+            gm_imgs = split_bilateral_rois(gm_img)
+            hemi_imgs = [index_img(gm_imgs, i) for i in (0, 1)]
+        else:
+            # split_bilateral_rois works on the full-resolution grid.
+            hemi_imgs = [HemisphereMasker(mask_img=gm_img, hemisphere=h).fit().mask_img_
+                         for h in ("L", "R")]
+        _hemi_gm_masks.update({(h, resolution): img
+                               for h, img in zip(("L", "R"), hemi_imgs)})
+        _hemi_gm_masks[("wb", resolution)] = gm_img
 
-    return gm_imgs_d[hemi]
+    return _hemi_gm_masks[(hemi, resolution)]
 
 
+_mask_indices = dict()
+
+
+def get_mask_index(src_hemi, dst_hemi, flip=False, resolution=None):
+    """
+    For data masked by the src_hemi gm mask, get the column index of each
+    voxel in the dst_hemi gm mask (after flipping L/R, if flip).
+    Voxels outside the src_hemi mask get an index of -1.
+    """
+    key = (src_hemi, dst_hemi, flip, resolution)
+    if key not in _mask_indices:
+        src_mask = get_hemi_gm_mask(src_hemi, resolution=resolution).get_data() > 0
+        dst_mask = get_hemi_gm_mask(dst_hemi, resolution=resolution).get_data() > 0
+        index_vol = -np.ones(src_mask.shape, dtype=int)
+        index_vol[src_mask] = np.arange(src_mask.sum())
+        if flip:
+            index_vol = index_vol[::-1]  # same as flip_img_lr
+        _mask_indices[key] = index_vol[dst_mask]
+    return _mask_indices[key]
+
+
+def get_masked_data(img, hemi="wb", flip=False):
+    """
+    Get (n_components x voxels) data of a 4D image in the hemi gm mask,
+    flipping the image L/R first if flip.
+
+    Images on a coarse grid (see get_gm_mask_img) use the mask
+    at that resolution.
+
+    If the image carries masked data (img.extra['masked'] = (hemi, array),
+    e.g. memory-mapped from a sidecar file), the voxels are selected from
+    that instead of masking the full 4D volume.
+    """
+    resolution = get_img_resolution(img)
+    masked = getattr(img, 'extra', dict()).get('masked')
+    if masked is None:
+        return apply_mask(flip_img_lr(img) if flip else img,
+                          get_hemi_gm_mask(hemi=hemi, resolution=resolution))
+
+    src_hemi, src_data = masked
+    if src_hemi == hemi and not flip:
+        return src_data
+    idx = get_mask_index(src_hemi, hemi, flip=flip, resolution=resolution)
+    # A new array: src_data may be read-only (so may be a selection of it,
+    # on older numpy).
+    return np.where(idx >= 0, src_data[:, np.maximum(idx, 0)], 0).astype(src_data.dtype)
+
+
+def get_parcel_matrix(parcellation, mask_img):
+    """
+    Get the sparse (voxels x parcels) membership matrix of a label image,
+    over the voxels of mask_img.
+
+    Each label is split into unilateral parcels with the hemisphere gm masks
+    (the same split as split_bilateral_rois), so parcels never straddle
+    the midline. Unlabeled (0) voxels belong to no parcel.
+
+    Returns the matrix and a list of (label, hemi) for each parcel.
+    """
+    label_img = check_niimg(parcellation)
+    mask_data = mask_img.get_data() > 0
+    if (label_img.shape[:3] != mask_data.shape or
+            not np.allclose(label_img.affine, mask_img.affine)):
+        label_img = resample_img(label_img, target_affine=mask_img.affine,
+                                 target_shape=mask_data.shape,
+                                 interpolation='nearest')
+    labels = np.round(label_img.get_data()).astype(int).reshape(mask_data.shape)
+    labels = labels[mask_data]
+
+    resolution = get_img_resolution(mask_img)
+    is_left = get_hemi_gm_mask("L", resolution=resolution).get_data()[mask_data] > 0
+
+    # One parcel per (label, hemi) pair present in the mask.
+    keys = labels * 2 + is_left
+    parcel_keys, parcel_idx = np.unique(keys[labels != 0], return_inverse=True)
+    voxel_idx = np.flatnonzero(labels != 0)
+    membership = sparse.csr_matrix(
+        (np.ones(len(voxel_idx), dtype=np.float32), (voxel_idx, parcel_idx)),
+        shape=(len(labels), len(parcel_keys)))
+    parcels = [(key // 2, "L" if key % 2 else "R") for key in parcel_keys]
+    return membership, parcels
+
 
 class HemisphereMasker(NiftiMasker):
     """
@@ -151,7 +289,7 @@ class HemisphereMasker(NiftiMasker):
                  mask_strategy='background',
                  mask_args=None, sample_mask=None,
                  memory_level=1, memory=Memory(cachedir=None),
-                 verbose=0, hemisphere='L'):
+                 verbose=0, hemisphere='L', resolution=None):
         if hemisphere.lower() in ['l', 'left']:
             self.hemi = 'l'
         elif hemisphere.lower() in ['r', 'right']:
@@ -160,7 +298,8 @@ class HemisphereMasker(NiftiMasker):
             raise ValueError('Hemisphere must be left or right; '
                              'got value %s' % self.hemi)
 
-        mask_img = mask_img or nib.load(fetch_grey_matter_mask())
+        mask_img = mask_img or get_gm_mask_img(resolution=resolution)
+        self.resolution = resolution
         target_affine = mask_img.affine
         target_shape = mask_img.shape
         super(HemisphereMasker, self).__init__(mask_img=mask_img,
@@ -187,7 +326,7 @@ class HemisphereMasker(NiftiMasker):
         hemi_mask_data = reorder_img(self.mask_img_).get_data().astype(np.bool)
 
         xvals = hemi_mask_data.shape[0]
-        midpt = np.ceil(xvals / 2.)
+        midpt = int(np.ceil(xvals / 2.))  # numpy >= 1.12 needs int slices
         if self.hemi == 'r':
             other_hemi_slice = slice(midpt, xvals)
         else:
@@ -0,0 +1,130 @@
+# *- encoding: utf-8 -*-
+# Author: Ben Cipollini, Ami Tsuchida
+# License: BSD
+"""
+Null distributions for the R vs L measures (HPAI, SSS), by relabeling
+voxels at random.
+
+All components are scored at once, for each relabeling: sign flips are
+drawn as one (n_permutations x voxels) array per batch, so a batch is a
+single matrix product over (components x voxels) data. Batches run in
+n_jobs threads (numpy releases the GIL); together they hold about
+max_memory bytes. Each permutation is drawn from its own seed (derived
+from random_state), so a null depends on random_state only, not on
+max_memory or n_jobs.
+"""
+
+import numpy as np
+
+
+def _get_n_jobs(n_jobs):
+    from sklearn.externals.joblib import cpu_count
+    return max(cpu_count() + 1 + n_jobs, 1) if n_jobs < 0 else max(n_jobs, 1)
+
+
+def _run_batches(score_batch, n_permutations, batch_size, random_state=42, n_jobs=1):
+    """
+    Columns of score_batch(seeds) for batches of (at most batch_size)
+    permutations, concatenated (n_permutations in all). seeds holds one
+    seed per permutation of the batch.
+    """
+    from sklearn.externals.joblib import Parallel, delayed
+    seeds = np.random.RandomState(random_state).randint(
+        np.iinfo(np.int32).max, size=n_permutations)
+    batch_size = max(min(batch_size, n_permutations), 1)
+    nulls = Parallel(n_jobs=n_jobs, backend='threading')(
+        delayed(score_batch)(seeds[start:start + batch_size])
+        for start in range(0, n_permutations, batch_size))
+    return np.concatenate(nulls, axis=1)
+
+
+def sign_flip_null(diffs, n_permutations=1000, random_state=42,
+                   max_memory=2 ** 28, n_jobs=1):
+    """
+    Sums over voxels (columns) of each row of diffs, with the sign of each
+    voxel flipped at random (the same flips for all rows).
+
+    For diffs = R - L of homotopic voxels, flipping a voxel swaps its
+    R and L values: a null for the asymmetry of each row.
+
+    Returns an (n_rows x n_permutations) array.
+    """
+    diffs = np.asarray(diffs, dtype=np.float32)  # float32 BLAS; exact for counts
+    n_voxels = diffs.shape[1]
+    # One (batch_size x voxels) array of signs per thread
+    batch_size = int(max_memory / _get_n_jobs(n_jobs) / (max(n_voxels, 1) * diffs.itemsize))
+
+    def score_batch(seeds):
+        signs = np.empty((len(seeds), n_voxels), dtype=np.float32)
+        for ii, seed in enumerate(seeds):
+            signs[ii] = np.random.RandomState(seed).randint(2, size=n_voxels)
+        signs *= 2
+        signs -= 1
+        return np.dot(diffs, signs.T)
+
+    return _run_batches(score_batch, n_permutations, batch_size,
+                        random_state=random_state, n_jobs=n_jobs)
+
+
+def _zscore_rows(data):
+    data = np.asarray(data, dtype=float)
+    data = data - data.mean(axis=1)[:, np.newaxis]
+    std = data.std(axis=1)[:, np.newaxis]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return data / std
+
+
+def row_correlations(data1, data2):
+    """Pearson correlation of each row of data1 with the same row of data2."""
+    return (_zscore_rows(data1) * _zscore_rows(data2)).mean(axis=1)
+
+
+def permutation_null_corr(data1, data2, n_permutations=1000, random_state=42, n_jobs=1):
+    """
+    Correlation of each row of data1 with the same row of data2, with the
+    voxels (columns) of data2 shuffled (the same shuffle for all rows).
+
+    For homotopic R and L voxels, that's a null for their spatial similarity.
+    Voxels are shuffled independently, ignoring spatial autocorrelation,
+    so the null is narrower than the "true" one (p-values are optimistic).
+
+    Returns an (n_rows x n_permutations) array.
+    """
+    # (voxels x rows), so a shuffle gathers contiguous rows.
+    z1 = np.ascontiguousarray(_zscore_rows(data1).T)
+    z2 = np.ascontiguousarray(_zscore_rows(data2).T)
+    n_voxels = z1.shape[0]
+    n_batches = 4 * _get_n_jobs(n_jobs)  # a few per thread, to balance the load
+
+    def score_batch(seeds):
+        shuffled = np.empty_like(z2)  # one per thread
+        null = np.empty((z1.shape[1], len(seeds)))
+        for ii, seed in enumerate(seeds):
+            np.take(z2, np.random.RandomState(seed).permutation(n_voxels), axis=0,
+                    out=shuffled)
+            null[:, ii] = np.einsum('vr,vr->r', z1, shuffled)
+        return null / n_voxels
+
+    return _run_batches(score_batch, n_permutations,
+                        int(np.ceil(n_permutations / float(n_batches))),
+                        random_state=random_state, n_jobs=n_jobs)
+
+
+def get_p_values(observed, null, tail='two-sided'):
+    """
+    Permutation p-value of each observed value (one per row of null):
+    the fraction of the null at least as extreme, counting the observed
+    value itself. tail is 'two-sided' (by magnitude) or 'greater'.
+    NaN where the observed value is NaN.
+    """
+    observed = np.asarray(observed, dtype=float)[:, np.newaxis]
+    with np.errstate(invalid='ignore'):
+        if tail == 'two-sided':
+            n_extreme = (np.abs(null) >= np.abs(observed) - 1e-12).sum(axis=1)
+        elif tail == 'greater':
+            n_extreme = (null >= observed - 1e-12).sum(axis=1)
+        else:
+            raise NotImplementedError(tail)
+    p_values = (n_extreme + 1.) / (null.shape[1] + 1.)
+    p_values[np.isnan(observed[:, 0])] = np.nan
+    return p_values
@@ -6,19 +6,25 @@ import os
 import os.path as op
 
 import numpy as np
-import pandas as pd
-import seaborn as sns
-from matplotlib import pyplot as plt
-from nilearn import datasets
-from nilearn.image import iter_img, index_img, math_img
-from nilearn.plotting import plot_stat_map
 from scipy import stats
 
 from nilearn_ext.utils import reorder_mat, get_ic_terms, get_n_terms, get_match_idx_pair
-from nilearn_ext.radar import radar_factory
 
 import math
 
+# matplotlib, seaborn and nilearn are slow to import, so they're
+# imported by the functions that plot, not by this module.
+
+_bg_img = []
+
+
+def get_bg_img():
+    """The MNI152 template (the default background), loaded once."""
+    if not _bg_img:
+        from nilearn import datasets
+        _bg_img.append(datasets.load_mni152_template())
+    return _bg_img[0]
+
 
 def nice_number(value, round_=False):
     """
@@ -77,6 +83,7 @@ def rescale(arr, val_range=(10, 200)):
 
 
 def save_and_close(out_path, fh=None):
+    from matplotlib import pyplot as plt
     fh = fh or plt.gcf()
     if not op.exists(op.dirname(out_path)):
         os.makedirs(op.dirname(out_path))
@@ -84,6 +91,23 @@ def save_and_close(out_path, fh=None):
     plt.close(fh)
 
 
+def _get_nonzero_abs(data):
+    """Absolute values of the nonzero voxels of an image's data array.
+
+    Zeros are dropped so that thresholds of r- or l- only
+    components are not dragged down by the empty hemisphere."""
+    data = np.abs(data)
+    return data[data != 0]
+
+
+def _get_threshold_data(img):
+    """Image data for computing thresholds: the masked components, if the
+    image carries them, otherwise the full 4D volume. Both have the same
+    nonzero values."""
+    masked = img.extra.get('masked')
+    return img.get_data() if masked is None else masked[1]
+
+
 def _title_from_terms(terms, ic_idx, label=None, n_terms=4, sign=1):
 
     if terms is None:
@@ -102,16 +126,19 @@ def _title_from_terms(terms, ic_idx, label=None, n_terms=4, sign=1):
     return title
 
 
-def plot_components(ica_image, hemi='', out_dir=None,
-                    bg_img=datasets.load_mni152_template()):
+def plot_components(ica_image, hemi='', out_dir=None, bg_img=None):
+    from matplotlib import pyplot as plt
+    from nilearn.image import iter_img
+    from nilearn.plotting import plot_stat_map
+    bg_img = get_bg_img() if bg_img is None else bg_img
     print("Plotting %s components..." % hemi)
 
     # Determine threshoold and vmax for all the plots
     # get nonzero part of the image for proper thresholding of
     # r- or l- only component
-    nonzero_img = ica_image.get_data()[np.nonzero(ica_image.get_data())]
-    thr = stats.scoreatpercentile(np.abs(nonzero_img), 90)
-    vmax = stats.scoreatpercentile(np.abs(nonzero_img), 99.99)
+    nonzero_img = _get_nonzero_abs(_get_threshold_data(ica_image))
+    thr = stats.scoreatpercentile(nonzero_img, 90)
+    vmax = stats.scoreatpercentile(nonzero_img, 99.99)
     for ci, ic_img in enumerate(iter_img(ica_image)):
 
         title = _title_from_terms(terms=ica_image.terms, ic_idx=ci, label=hemi)
@@ -125,18 +152,21 @@ def plot_components(ica_image, hemi='', out_dir=None,
                 out_dir, '%s_component_%i.png' % (hemi, ci)))
 
 
-def plot_components_summary(ica_image, hemi='', out_dir=None,
-                            bg_img=datasets.load_mni152_template()):
+def plot_components_summary(ica_image, hemi='', out_dir=None, bg_img=None):
+    from matplotlib import pyplot as plt
+    from nilearn.image import iter_img
+    from nilearn.plotting import plot_stat_map
+    bg_img = get_bg_img() if bg_img is None else bg_img
     print("Plotting %s components summary..." % hemi)
 
-    n_components = ica_image.get_data().shape[3]
+    n_components = ica_image.shape[3]
 
     # Determine threshoold and vmax for all the plots
     # get nonzero part of the image for proper thresholding of
     # r- or l- only component
-    nonzero_img = ica_image.get_data()[np.nonzero(ica_image.get_data())]
-    thr = stats.scoreatpercentile(np.abs(nonzero_img), 90)
-    vmax = stats.scoreatpercentile(np.abs(nonzero_img), 99.99)
+    nonzero_img = _get_nonzero_abs(_get_threshold_data(ica_image))
+    thr = stats.scoreatpercentile(nonzero_img, 90)
+    vmax = stats.scoreatpercentile(nonzero_img, 99.99)
     for ii, ic_img in enumerate(iter_img(ica_image)):
 
         ri = ii % 5  # row i
@@ -170,6 +200,10 @@ def plot_matched_components(images, labels, score_mat, sign_mat,
     is forced.
     Sign_mat is used to flip signs when comparing two images.
     """
+    from matplotlib import pyplot as plt
+    from nilearn.image import new_img_like
+    from nilearn.plotting import plot_stat_map
+
     # Be careful
     assert len(images) == 2
     assert len(labels) == 2
@@ -189,13 +223,15 @@ def plot_matched_components(images, labels, score_mat, sign_mat,
 
     n_comp = len(idx_pair[0])   # number of comparisons
 
+    # Load each 4D image once; only the 3D slices that are plotted
+    # get wrapped into new images below.
+    img_data = [img.get_data() for img in images]
+
     # Calculate a vmax optimal across all the plots
     # get nonzero part of the image for proper thresholding of
     # r- or l- only component
-    nonzero_imgs = [img.get_data()[np.nonzero(img.get_data())]
-                    for img in images]
-    dat = np.append(nonzero_imgs[0], nonzero_imgs[1])
-    vmax = stats.scoreatpercentile(np.abs(dat), 99.99)
+    dat = np.concatenate([_get_nonzero_abs(_get_threshold_data(img)) for img in images])
+    vmax = stats.scoreatpercentile(dat, 99.99)
 
     print("Plotting results.")
     for i in range(n_comp):
@@ -207,19 +243,17 @@ def plot_matched_components(images, labels, score_mat, sign_mat,
         png_name = '%s%s_%s_%s.png' % (prefix, labels[0], labels[1], num)
         print "plotting %s" % png_name
 
-        comp_imgs = [index_img(img, ci) for img, ci in zip(images, cis)]
-
         # flip the sign if sign_mat for the corresponding comparison is -1
         signs = [sign_pair[0][i], sign_pair[1][i]]
-        comp_imgs = [math_img("%d*img" % (sign), img=img)
-                     for sign, img in zip(signs, comp_imgs)]
+        comp_data = [sign * d[..., ci]
+                     for sign, d, ci in zip(signs, img_data, cis)]
 
         if ('R' in labels and 'L' in labels):
             # Combine left and right image, show just one.
             # terms are not combined here
-            comp = math_img("img1+img2", img1=comp_imgs[0], img2=comp_imgs[1])
+            comp = new_img_like(images[0], comp_data[0] + comp_data[1])
             titles = [_title_from_terms(
-                terms=comp_imgs[labels.index(hemi)].terms,
+                terms=images[labels.index(hemi)].terms,
                 ic_idx=cis[labels.index(hemi)], label=hemi,
                 sign=signs[labels.index(hemi)]) for hemi in labels]
             fh = plt.figure(figsize=(14, 8))
@@ -233,7 +267,7 @@ def plot_matched_components(images, labels, score_mat, sign_mat,
 
             for ii in [0, 1]:  # Subplot per image
                 ax = fh.add_subplot(2, 1, ii + 1)
-                comp = comp_imgs[ii]
+                comp = new_img_like(images[ii], comp_data[ii])
 
                 title = _title_from_terms(
                     terms=images[ii].terms, ic_idx=cis[ii],
@@ -258,6 +292,7 @@ def plot_matched_components(images, labels, score_mat, sign_mat,
 
 def plot_comparison_matrix(score_mat, labels, scoring, normalize=True,
                            out_dir=None, vmax=None, colorbar=True, prefix=""):
+    from matplotlib import pyplot as plt
 
     # Settings
     score_mat, x_idx, y_idx = reorder_mat(score_mat, normalize=normalize)
@@ -291,6 +326,10 @@ def plot_term_comparisons(termscores_summary, labels, plot_type="heatmap",
 
     The labels should be found in the DF column names.
     """
+    import seaborn as sns
+    from matplotlib import pyplot as plt
+    from nilearn_ext.radar import radar_factory
+
     for label in labels:
         assert label in termscores_summary.columns
         assert "%s_idx" % label in termscores_summary.columns
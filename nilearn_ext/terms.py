@@ -0,0 +1,72 @@
+# *- encoding: utf-8 -*-
+# Author: Ben Cipollini
+# License: BSD
+
+import numpy as np
+
+
+class TermScores(object):
+    """Neurosynth term scores for a set of images, as a
+    (terms x images) float32 matrix with a term index.
+
+    Filtering or reordering images is a single column selection
+    (see `take`). For older code, it also acts as a read-only dict
+    of term => scores across images.
+    """
+    def __init__(self, terms, matrix):
+        self.terms = np.asarray(terms)
+        self.matrix = np.asarray(matrix, dtype=np.float32)
+        if self.matrix.ndim != 2 or self.matrix.shape[0] != len(self.terms):
+            raise ValueError("Term matrix must be (%d terms x images); got %s" % (
+                len(self.terms), self.matrix.shape))
+        self._term_idx = dict((term, ii) for ii, term in enumerate(self.terms))
+
+    @classmethod
+    def from_dict(cls, term_scores, n_images=0):
+        """Convert a dict of term => scores across images."""
+        if isinstance(term_scores, cls):
+            return term_scores
+        terms = list((term_scores or dict()).keys())
+        matrix = np.empty((len(terms), n_images), dtype=np.float32)
+        for ti, term in enumerate(terms):
+            matrix[ti] = term_scores[term]
+        return cls(terms, matrix)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as npz:
+            return cls(npz['terms'], npz['matrix'])
+
+    def save(self, path):
+        """Save as an (uncompressed) .npz file."""
+        np.savez(path, terms=self.terms, matrix=self.matrix)
+
+    @property
+    def n_images(self):
+        return self.matrix.shape[1]
+
+    def take(self, idx):
+        """Select / reorder images; idx is a boolean mask or index array."""
+        return TermScores(self.terms, self.matrix[:, idx])
+
+    # dict-style access
+    def keys(self):
+        return list(self.terms)
+
+    def values(self):
+        return list(self.matrix)
+
+    def items(self):
+        return list(zip(self.terms, self.matrix))
+
+    def __getitem__(self, term):
+        return self.matrix[self._term_idx[term]]
+
+    def __contains__(self, term):
+        return term in self._term_idx
+
+    def __iter__(self):
+        return iter(self.terms)
+
+    def __len__(self):
+        return len(self.terms)
@@ -0,0 +1,76 @@
+import numpy as np
+import pytest
+
+from nilearn_ext import backends
+
+
+def _get_data(n_images=8, n_voxels=300, n_sources=3, random_state=0):
+    # Sparse (super-gaussian) spatial sources, mixed into images.
+    rng = np.random.RandomState(random_state)
+    sources = rng.laplace(size=(n_sources, n_voxels)) ** 3
+    mixing = rng.randn(n_images, n_sources)
+    X = mixing.dot(sources) + 0.01 * rng.randn(n_images, n_voxels)
+    return X, sources, mixing
+
+
+def test_get_backend():
+    assert backends.get_backend(backends.DEFAULT_BACKEND) is backends.fit_fastica
+    with pytest.raises(ValueError):
+        backends.get_backend('nmf')
+
+
+@pytest.mark.parametrize('name', sorted(backends.BACKENDS))
+def test_backend_shapes(name):
+    X, _, _ = _get_data()
+    # chunk_size doesn't divide the voxels, so the last chunk is partial.
+    result = backends.get_backend(name)(X, 3, random_state=0, chunk_size=128,
+                                        n_seeds=3, n_jobs=1)
+    maps, components = result[:2]
+    assert maps.shape == (3, X.shape[1])
+    assert components.shape == (3, X.shape[0])
+    assert np.all(np.isfinite(maps)) and np.all(np.isfinite(components))
+
+    # Same seed, same result.
+    maps2 = backends.get_backend(name)(X, 3, random_state=0, chunk_size=128,
+                                       n_seeds=3, n_jobs=1)[0]
+    np.testing.assert_allclose(maps2, maps)
+
+
+def test_fit_fastica_recovers_sources():
+    X, sources, _ = _get_data()
+    maps, _ = backends.fit_fastica(X, 3, random_state=0)
+    corrs = np.abs(np.corrcoef(maps, sources)[:3, 3:])
+    np.testing.assert_array_less(0.99, corrs.max(axis=1))
+
+
+def test_align():
+    rng = np.random.RandomState(0)
+    ref_maps = rng.randn(4, 100)
+    perm, signs = np.array([2, 0, 3, 1]), np.array([1, -1, -1, 1])
+    maps = np.empty_like(ref_maps)
+    maps[perm] = ref_maps * signs[:, np.newaxis]
+    maps += 0.1 * rng.randn(*maps.shape)
+
+    found_perm, found_signs, corrs = backends._align(ref_maps, maps)
+    np.testing.assert_array_equal(found_perm, perm)
+    np.testing.assert_array_equal(found_signs, signs)
+    np.testing.assert_array_less(0.9, corrs)
+    np.testing.assert_allclose(maps[found_perm] * found_signs[:, np.newaxis], ref_maps, atol=0.5)
+
+
+def test_fit_ensemble():
+    X, sources, _ = _get_data()
+    maps, components, info = backends.fit_ensemble(X, 3, random_state=0, n_seeds=4, n_jobs=1)
+
+    # Recoverable sources are found in every run: stable, and in the consensus.
+    np.testing.assert_array_less(0.99, info['stability'])
+    np.testing.assert_array_less(info['stability'], 1 + 1e-10)
+    corrs = np.abs(np.corrcoef(maps, sources)[:3, 3:])
+    np.testing.assert_array_less(0.99, corrs.max(axis=1))
+
+    # Runs in parallel give the same result.
+    parallel = backends.fit_ensemble(X, 3, random_state=0, n_seeds=4, n_jobs=2)
+    np.testing.assert_allclose(parallel[0], maps)
+    np.testing.assert_allclose(parallel[1], components)
+    np.testing.assert_allclose(parallel[2]['stability'], info['stability'])
+
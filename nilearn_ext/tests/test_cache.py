@@ -0,0 +1,123 @@
+import os
+import os.path as op
+
+import numpy as np
+
+from nilearn_ext import cache
+
+
+def _add_entry(cache_dir, dataset, func, call, size, last_access):
+    path = op.join(cache_dir, dataset, 'joblib', func, call)
+    os.makedirs(path)
+    out_path = op.join(path, 'output.pkl')
+    with open(out_path, 'wb') as fp:
+        fp.write(b'x' * size)
+    os.utime(out_path, (last_access, last_access))
+    return path
+
+
+def test_parse_size():
+    assert cache.parse_size(1024) == 1024
+    assert cache.parse_size('500') == 500
+    assert cache.parse_size('2K') == 2048
+    assert cache.parse_size('1.5m') == 1536 * 1024
+    assert cache.parse_size(' 20GB ') == 20 * 1024 ** 3
+    assert cache.format_size(100) == '100B'
+    assert cache.format_size(1536 * 1024) == '1.5M'
+    assert cache.parse_size(cache.format_size(20 * 1024 ** 3)) == 20 * 1024 ** 3
+
+
+def test_list_entries(tmpdir):
+    cache_dir = str(tmpdir)
+    path = _add_entry(cache_dir, 'neurovault', 'nilearn_ext/decomposition/fit', 'abc', 10, 1000)
+    _add_entry(cache_dir, '', 'nilearn/masking/apply', 'def', 20, 2000)
+    os.makedirs(op.join(cache_dir, 'neurovault', 'joblib', 'empty', 'ghi'))
+
+    entries = sorted(cache.list_entries(cache_dir), key=lambda entry: entry['size'])
+    assert [entry['path'] for entry in entries][0] == path
+    assert [(entry['dataset'], entry['func'], entry['size']) for entry in entries] == [
+        ('neurovault', 'nilearn_ext.decomposition.fit', 10),
+        ('-', 'nilearn.masking.apply', 20)]
+    assert entries[0]['last_access'] >= 1000
+
+
+def test_evict_lru(tmpdir):
+    cache_dir = str(tmpdir)
+    # Least recently used first: old, then mid, then new.
+    now = 1e9
+    paths = dict((name, _add_entry(cache_dir, 'ds', 'func', name, 100, now - age))
+                 for name, age in (('new', 0), ('old', 300), ('mid', 200)))
+    # Read since written: atime counts as an access.
+    os.utime(op.join(paths['old'], 'output.pkl'), (now + 10, now - 300))
+
+    removed = cache.evict(250, cache_dir=cache_dir, verbose=False)
+    assert [op.basename(entry['path']) for entry in removed] == ['mid']
+    assert not op.exists(paths['mid'])
+    assert cache.evict(250, cache_dir=cache_dir, verbose=False) == []
+
+    removed = cache.evict(100, cache_dir=cache_dir, verbose=False)
+    assert [op.basename(entry['path']) for entry in removed] == ['new']
+    assert [op.basename(entry['path']) for entry in cache.list_entries(cache_dir)] == ['old']
+
+
+def test_enforce_budget(monkeypatch, tmpdir):
+    cache_dir = str(tmpdir)
+    _add_entry(cache_dir, 'ds', 'func', 'a', 100, 1000)
+    _add_entry(cache_dir, 'ds', 'func', 'b', 100, 2000)
+
+    monkeypatch.delenv(cache.BUDGET_ENV, raising=False)
+    assert cache.get_budget() is None
+    assert cache.enforce_budget(cache_dir) == []
+
+    monkeypatch.setenv(cache.BUDGET_ENV, '150B')
+    assert cache.get_budget() == 150
+    removed = cache.enforce_budget(cache_dir)
+    assert [op.basename(entry['path']) for entry in removed] == ['a']
+
+
+def test_hash_array():
+    arr = np.arange(12, dtype=np.float32).reshape((3, 4))
+    assert cache.hash_array(arr) == cache.hash_array(arr.copy())
+    assert cache.hash_array(arr.T) == cache.hash_array(np.ascontiguousarray(arr.T))
+    assert cache.hash_array(arr) != cache.hash_array(arr.reshape((4, 3)))
+    assert cache.hash_array(arr) != cache.hash_array(arr.astype(np.float64))
+    assert cache.hash_array(np.zeros((0,))) != cache.hash_array(np.zeros((0, 1)))
+
+
+def test_fingerprint_and_file_stamp(tmpdir):
+    assert (cache.fingerprint(dict(a=1, b=[1, 2])) ==
+            cache.fingerprint(dict([('b', [1, 2]), ('a', 1)])))
+    assert cache.fingerprint(dict(a=1)) != cache.fingerprint(dict(a=2))
+
+    path = op.join(str(tmpdir), 'img.nii')
+    with open(path, 'w') as fp:
+        fp.write('abc')
+    stamp = cache.file_stamp(path)
+    assert stamp[0] == path and stamp[2] == 3
+    os.utime(path, (stamp[1] + 10, stamp[1] + 10))
+    assert cache.file_stamp(path) != stamp
+
+
+def test_save_load_arrays(monkeypatch, tmpdir):
+    monkeypatch.setattr(cache, '_memories', dict())
+    memory = cache.get_memory(str(tmpdir))
+    namespace = 'nilearn_ext.decomposition.generate_components'
+    assert cache.load_arrays(memory, namespace, 'abc') is None
+
+    maps = np.arange(6, dtype=np.float32).reshape((2, 3))
+    path = cache.save_arrays(memory, namespace, 'abc', maps=maps, idx=np.array([True, False]))
+    arrays = cache.load_arrays(memory, namespace, 'abc')
+    assert sorted(arrays) == ['idx', 'maps']
+    assert arrays['maps'].dtype == np.float32
+    np.testing.assert_array_equal(arrays['maps'], maps)
+    np.testing.assert_array_equal(arrays['idx'], [True, False])
+    assert os.listdir(op.dirname(path)) == ['output.npz']  # no temp files left
+
+    # Listed (and evicted) like joblib's own entries.
+    (entry,) = cache.list_entries(str(tmpdir))
+    assert entry['func'] == namespace and entry['path'] == op.dirname(path)
+
+    # A Memory that doesn't cache stores nothing.
+    no_memory = cache.get_memory(None)
+    assert cache.save_arrays(no_memory, namespace, 'abc', maps=maps) is None
+    assert cache.load_arrays(no_memory, namespace, 'abc') is None
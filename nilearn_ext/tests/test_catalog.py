@@ -0,0 +1,55 @@
+import os.path as op
+import sqlite3
+
+import numpy as np
+from nilearn import datasets
+
+from nilearn_ext import catalog
+
+
+def _fake_fetcher(image_ids):
+    """Offline neurovault fetcher with images in the given (non-id) order."""
+    images = [dict(id=iid, collection_id=iid % 2 + 1, map_type='T map',
+                   local_path='%d.nii.gz' % iid) for iid in image_ids]
+    calls = []
+
+    def fetch_neurovault(query_server=False, max_images=np.inf, fetch_terms=True, **kwargs):
+        calls.append(kwargs)
+        out = images if np.isinf(max_images) else images[:int(max_images)]
+        return dict(images=out,
+                    collections=dict((cid, dict(id=cid)) for cid in (1, 2)),
+                    terms=dict(a=[float(image['id']) for image in out]))
+    return fetch_neurovault, calls
+
+
+def test_query_catalog_fetcher_order(monkeypatch, tmpdir):
+    fetcher, calls = _fake_fetcher([5, 2, 9, 1])
+    monkeypatch.setattr(datasets, 'fetch_neurovault', fetcher)
+    catalog_path = op.join(str(tmpdir), 'catalog.sqlite')
+
+    # max_images keeps the fetcher's first images, not the lowest ids.
+    out = catalog.query_catalog(catalog_path, max_images=2)
+    expected = fetcher(max_images=2)
+    assert [image['id'] for image in out['images']] == [5, 2]
+    assert out['images'] == expected['images']
+    np.testing.assert_array_equal(out['terms']['a'], expected['terms']['a'])
+
+    out = catalog.query_catalog(catalog_path, collection_ids=[2],
+                                image_filters=[lambda image: image['id'] > 1])
+    assert [image['id'] for image in out['images']] == [5, 9]
+    assert len(calls) == 2  # built once (plus the call for expected)
+
+
+def test_query_catalog_rebuilds_old_version(monkeypatch, tmpdir):
+    fetcher, calls = _fake_fetcher([3, 1])
+    monkeypatch.setattr(datasets, 'fetch_neurovault', fetcher)
+    catalog_path = op.join(str(tmpdir), 'catalog.sqlite')
+    catalog.build_catalog(catalog_path)
+    conn = sqlite3.connect(catalog_path)
+    conn.execute("PRAGMA user_version = 1")
+    conn.close()
+
+    out = catalog.query_catalog(catalog_path)
+    assert [image['id'] for image in out['images']] == [3, 1]
+    assert len(calls) == 2
+    assert catalog.get_catalog_version(catalog_path) == catalog.CATALOG_VERSION
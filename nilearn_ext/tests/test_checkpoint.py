@@ -0,0 +1,54 @@
+import json
+import os
+import os.path as op
+
+import pytest
+
+from nilearn_ext.checkpoint import Manifest, atomic_path, get_tmp_path
+
+
+def test_get_tmp_path():
+    tmp_path = get_tmp_path(op.join('out', 'wb_ica_components.nii.gz'))
+    assert op.dirname(tmp_path) == 'out'
+    assert op.basename(tmp_path) == 'wb_ica_components.tmp%d.nii.gz' % os.getpid()
+    assert get_tmp_path('manifest') == 'manifest.tmp%d' % os.getpid()
+
+
+def test_atomic_path(tmpdir):
+    path = op.join(str(tmpdir), 'sub', 'out.csv')
+    with atomic_path(path) as tmp_path:
+        with open(tmp_path, 'w') as fp:
+            fp.write('new')
+        assert not op.exists(path)  # only once complete
+    with open(path) as fp:
+        assert fp.read() == 'new'
+
+    # A failed write leaves neither the temp file, nor a changed output.
+    with pytest.raises(ValueError):
+        with atomic_path(path) as tmp_path:
+            with open(tmp_path, 'w') as fp:
+                fp.write('partial')
+            raise ValueError
+    assert os.listdir(op.dirname(path)) == ['out.csv']
+    with open(path) as fp:
+        assert fp.read() == 'new'
+
+
+def test_manifest(tmpdir):
+    path = op.join(str(tmpdir), 'manifest.json')
+    manifest = Manifest(path)
+    assert op.exists(path)
+    assert not manifest.is_done('ica/wb/20')
+    manifest.mark_done('ica/wb/20', n_images=10)
+    with open(path) as fp:
+        assert json.load(fp) == {'ica/wb/20': {'n_images': 10}}
+
+    # Resuming picks up the units done...
+    resumed = Manifest(path, resume=True)
+    assert resumed.is_done('ica/wb/20')
+    assert resumed.get('ica/wb/20') == dict(n_images=10)
+
+    # ... otherwise, the manifest starts over.
+    restarted = Manifest(path)
+    assert not restarted.is_done('ica/wb/20')
+    assert not Manifest(path, resume=True).is_done('ica/wb/20')
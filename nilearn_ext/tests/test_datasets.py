@@ -0,0 +1,30 @@
+import json
+import os.path as op
+
+import nibabel as nib
+import numpy as np
+
+from nilearn_ext.datasets import IMAGE_STATS_VERSION, get_image_stats
+
+
+def test_get_image_stats(tmpdir):
+    data = np.zeros((4, 4, 4), dtype=np.float32)
+    data[0, :3, 0] = [1., 2., -np.inf]
+    data[1, :2, 0] = np.nan
+    path = op.join(str(tmpdir), 'img.nii.gz')
+    nib.save(nib.Nifti1Image(data, np.eye(4)), path)
+    index_path = op.join(str(tmpdir), 'image_stats.json')
+
+    stats, = get_image_stats([path], index_path=index_path, n_jobs=1)
+    assert (stats['n_pos'], stats['n_neg'], stats['n_nan'], stats['n_unique']) == (2, 1, 2, 5)
+    assert stats['frac_nonfinite'] == 3 / 64.
+
+    # Entries from an older version of the stats are recomputed.
+    with open(index_path) as fp:
+        index = json.load(fp)
+    index[path].pop('version')
+    index[path].pop('n_nan')
+    with open(index_path, 'w') as fp:
+        json.dump(index, fp)
+    stats, = get_image_stats([path], index_path=index_path, n_jobs=1)
+    assert stats['version'] == IMAGE_STATS_VERSION and stats['n_nan'] == 2
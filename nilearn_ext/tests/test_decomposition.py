@@ -0,0 +1,118 @@
+import os
+import os.path as op
+
+import nibabel as nib
+import numpy as np
+from scipy import sparse
+
+from nibabel_ext import NiftiImageWithTerms
+from nilearn_ext import decomposition
+from nilearn_ext.decomposition import get_masked_path, score_components
+from nilearn_ext.image import get_resampling_matrix
+
+
+def test_score_components_l1norm():
+    rng = np.random.RandomState(0)
+    data1, data2 = rng.randn(7, 50), rng.randn(5, 50)
+    expected = np.asarray([[[np.abs(c1 - sign * c2).sum() for c2 in data2] for c1 in data1]
+                           for sign in (1, -1)])
+
+    # A budget of a few tile pairs, so most tiles are partial.
+    score_mat, sign_mat = score_components(data1, data2, scoring='l1norm',
+                                           max_memory=4 * 50 * 4, n_jobs=2)
+    np.testing.assert_allclose(score_mat, expected.min(axis=0), rtol=1e-5)
+    np.testing.assert_array_equal(sign_mat, np.where(expected[1] < expected[0], -1, 1))
+
+
+def test_load_components_kept_loaded(tmpdir):
+    img_path = op.join(str(tmpdir), 'wb_ica_components.nii.gz')
+
+    def save(n_components):
+        img = NiftiImageWithTerms(np.ones((2, 2, 2, n_components), dtype=np.float32), np.eye(4))
+        img.to_filename(img_path)
+        np.save(get_masked_path(img_path), np.ones((n_components, 8), dtype=np.float32))
+
+    save(3)
+    decomposition.keep_components_loaded()
+    try:
+        img = decomposition.load_components(img_path, hemi='wb')
+        assert decomposition.load_components(img_path, hemi='wb') is img
+        assert img.extra['masked'][1].shape == (3, 8)
+
+        # A regenerated file replaces the stale image.
+        save(4)
+        new_img = decomposition.load_components(img_path, hemi='wb')
+        assert new_img.shape[3] == 4 and new_img.extra['masked'][1].shape == (4, 8)
+        assert len(decomposition._loaded_components) == 1
+    finally:
+        decomposition.keep_components_loaded(False)
+
+
+def test_get_l1_settings(monkeypatch):
+    monkeypatch.delenv('NILEARN_L1_MEMORY', raising=False)
+    monkeypatch.delenv('NILEARN_L1_JOBS', raising=False)
+    assert decomposition.get_l1_settings() == (2 ** 28, 1)
+
+    monkeypatch.setenv('NILEARN_L1_MEMORY', '2G')
+    monkeypatch.setenv('NILEARN_L1_JOBS', '4')
+    assert decomposition.get_l1_settings() == (2 * 1024 ** 3, 4)
+    assert decomposition.get_l1_settings(max_memory=100, n_jobs=2) == (100, 2)
+
+
+class _Masker(object):
+    def __init__(self, mask_img):
+        self.mask_img_ = mask_img
+
+    def transform(self, img):
+        raise ValueError("Can't mask a %dD image" % len(img.shape))
+
+
+def test_mask_images(tmpdir):
+    mask = np.zeros((4, 5, 3), dtype=np.int8)
+    mask[1:3, 1:4, 1] = 1
+    mask_img = nib.Nifti1Image(mask, np.diag([2., 2., 2., 1.]))
+    rng = np.random.RandomState(0)
+
+    # Two images on the mask's grid (one with a nan), two on a coarser grid,
+    # and one that can't be masked.
+    on_grid = [rng.randn(4, 5, 3) for _ in range(2)]
+    on_grid[1][1, 1, 1] = np.nan
+    coarse_affine = np.diag([4., 4., 4., 1.])
+    coarse = [rng.randn(3, 3, 2) for _ in range(2)]
+    imgs = ([nib.Nifti1Image(data, mask_img.affine) for data in on_grid] +
+            [nib.Nifti1Image(data, coarse_affine) for data in coarse] +
+            [nib.Nifti1Image(np.zeros((4, 5, 3, 2)), mask_img.affine)])
+
+    X, xformable_idx = decomposition.mask_images(imgs[:2] + imgs[2:3] + imgs[4:] + imgs[3:4],
+                                                 _Masker(mask_img))
+    np.testing.assert_array_equal(xformable_idx, [True, True, True, False, True])
+    np.testing.assert_allclose(X[0], on_grid[0][mask > 0], rtol=1e-6)
+    np.testing.assert_allclose(X[1], np.nan_to_num(on_grid[1])[mask > 0], rtol=1e-6)
+    resampler = get_resampling_matrix(coarse_affine, (3, 3, 2), mask_img)
+    for row, data in zip(X[[2, 3]], coarse):
+        np.testing.assert_allclose(row, resampler.dot(data.ravel()), rtol=1e-5)
+
+    # With a reducer, rows are reduced as they're loaded.
+    reducer = sparse.csr_matrix(np.ones((mask.sum(), 1)))
+    X_reduced, _ = decomposition.mask_images(imgs[:4], _Masker(mask_img), reducer=reducer)
+    np.testing.assert_allclose(X_reduced[:, 0], X.sum(axis=1), rtol=1e-5)
+
+
+def test_get_decomposition_key(tmpdir):
+    mask_img = nib.Nifti1Image(np.ones((2, 2, 2), dtype=np.int8), np.eye(4))
+    path = op.join(str(tmpdir), 'img.nii.gz')
+    nib.save(nib.Nifti1Image(np.ones((2, 2, 2)), np.eye(4)), path)
+    in_memory = nib.Nifti1Image(np.zeros((2, 2, 2)), np.eye(4))
+
+    key = decomposition.get_decomposition_key([path, in_memory], mask_img, n_components=5)
+    assert key == decomposition.get_decomposition_key(
+        [path, nib.Nifti1Image(np.zeros((2, 2, 2)), np.eye(4))], mask_img, n_components=5)
+    assert key != decomposition.get_decomposition_key([path, in_memory], mask_img, n_components=6)
+    assert key != decomposition.get_decomposition_key([in_memory, path], mask_img, n_components=5)
+    assert key != decomposition.get_decomposition_key(
+        [path, in_memory], mask_img, parcellation=path, n_components=5)
+
+    # A rewritten file is a new input.
+    mtime = op.getmtime(path)
+    os.utime(path, (mtime + 10, mtime + 10))
+    assert key != decomposition.get_decomposition_key([path, in_memory], mask_img, n_components=5)
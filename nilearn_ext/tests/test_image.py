@@ -0,0 +1,69 @@
+import os.path as op
+
+import nibabel as nib
+import numpy as np
+
+from nilearn_ext.image import get_grid_key, get_resampling_matrix, load_clean_img
+
+
+def _save_img(tmpdir, data, name='img.nii.gz'):
+    path = op.join(str(tmpdir), name)
+    nib.save(nib.Nifti1Image(data, np.eye(4)), path)
+    return path
+
+
+def test_load_clean_img_from_file(tmpdir):
+    data = np.arange(24, dtype=np.float64).reshape((2, 3, 4))
+    data[0, 0, 0] = np.nan
+    data[1, 2, 3] = np.inf
+    for name in ('img.nii.gz', 'img.nii'):  # compressed, and memory-mappable
+        img, n_nonfinite = load_clean_img(_save_img(tmpdir, data, name))
+
+        assert n_nonfinite == 2
+        assert img.get_data().dtype == np.float32
+        expected = np.where(np.isfinite(data), data, 0)
+        np.testing.assert_array_equal(img.get_data(), expected)
+
+
+def test_load_clean_img_keeps_input(tmpdir):
+    data = np.ones((2, 2, 2), dtype=np.float32)
+    data[0, 0, 0] = np.nan
+    in_img = nib.Nifti1Image(data, np.eye(4))
+    img, n_nonfinite = load_clean_img(in_img)
+
+    assert n_nonfinite == 1
+    assert img.get_data()[0, 0, 0] == 0
+    assert np.isnan(in_img.get_data()[0, 0, 0])
+
+
+def test_get_resampling_matrix():
+    from nilearn.image import resample_img
+
+    rng = np.random.RandomState(0)
+    src_data = rng.randn(8, 9, 7)
+    src_affine = np.diag([3., 3., 3., 1.])
+    src_affine[:3, 3] = [-10, -12, -9]
+    mask = np.zeros((7, 6, 4), dtype=np.int8)
+    mask[1:7, 1:5, 1:3] = 1
+    mask_affine = np.diag([2., 2., 2., 1.])
+    mask_affine[:3, 3] = [-5, -6, -4]
+    mask_img = nib.Nifti1Image(mask, mask_affine)
+
+    resampled = get_resampling_matrix(src_affine, src_data.shape, mask_img).dot(src_data.ravel())
+    expected = resample_img(nib.Nifti1Image(src_data, src_affine), target_affine=mask_affine,
+                            target_shape=mask.shape, interpolation='linear').get_data()
+    np.testing.assert_allclose(resampled, expected[mask > 0], atol=1e-10)
+
+    # Mask voxels outside the source image get 0.
+    src_affine[0, 3] = -2
+    resampled = get_resampling_matrix(src_affine, src_data.shape, mask_img).dot(src_data.ravel())
+    outside = (np.where(mask > 0)[0] * 2 - 5) < -2  # x (mm) of the mask voxels
+    assert outside.any() and np.all(resampled[outside] == 0)
+    assert np.all(resampled[~outside] != 0)
+
+
+def test_get_grid_key():
+    affine = np.diag([2., 2., 2., 1.])
+    img = nib.Nifti1Image(np.zeros((3, 4, 5, 2)), affine)
+    assert get_grid_key(img) == get_grid_key(nib.Nifti1Image(np.ones((3, 4, 5)), affine + 1e-9))
+    assert get_grid_key(img) != get_grid_key(nib.Nifti1Image(np.zeros((3, 4, 6)), affine))
@@ -0,0 +1,147 @@
+import os.path as op
+
+import nibabel as nib
+import numpy as np
+
+from nilearn_ext import masking
+
+
+class _Img(object):
+    extra = dict()
+
+
+def test_get_masked_data_from_read_only_sidecar(monkeypatch, tmpdir):
+    # As loaded by load_components: memory-mapped, read-only
+    path = op.join(str(tmpdir), 'masked.npy')
+    np.save(path, np.arange(12, dtype=np.float32).reshape((3, 4)))
+    src_data = np.load(path, mmap_mode='r')
+    idx = np.array([2, -1, 0])
+    monkeypatch.setattr(masking, 'get_img_resolution', lambda img: None)
+    monkeypatch.setattr(masking, 'get_mask_index', lambda *args, **kwargs: idx)
+
+    img = _Img()
+    img.extra = dict(masked=('wb', src_data))
+    data = masking.get_masked_data(img, hemi='L', flip=True)
+
+    assert data.dtype == np.float32
+    np.testing.assert_array_equal(data, [[2, 0, 0], [6, 0, 4], [10, 0, 8]])
+    assert masking.get_masked_data(img, hemi='wb') is src_data
+
+
+def _use_gm_mask(monkeypatch, tmpdir, mask, affine):
+    path = op.join(str(tmpdir), 'gm_mask.nii.gz')
+    nib.save(nib.Nifti1Image(mask, affine), path)
+    monkeypatch.setattr(masking, 'fetch_grey_matter_mask', lambda: path)
+    monkeypatch.setattr(masking, '_gm_mask_imgs', dict())
+    monkeypatch.setattr(masking, '_hemi_gm_masks', dict())
+    monkeypatch.setattr(masking, '_mask_indices', dict())
+
+
+def _get_ellipsoid_mask():
+    # An MNI-like (x-flipped) 2mm grid, centered on the origin.
+    affine = np.diag([-2., 2., 2., 1.])
+    affine[:3, 3] = [20, -12, -10]
+    ijk = np.indices((21, 13, 11)).reshape((3, -1))
+    xyz = affine[:3, :3].dot(ijk) + affine[:3, 3:]
+    mask = ((xyz / [[18.], [10.], [8.]]) ** 2).sum(axis=0) <= 1
+    return mask.reshape((21, 13, 11)).astype(np.int8), affine
+
+
+def _get_coords(img, mask):
+    ijk = np.array(np.where(mask))
+    return img.affine[:3, :3].dot(ijk) + img.affine[:3, 3:]
+
+
+def test_get_hemi_gm_mask(monkeypatch, tmpdir):
+    # An odd number of x slices, so the midpoint is rounded.
+    mask = np.zeros((7, 4, 3), dtype=np.int8)
+    mask[:, 1:3, 1] = 1
+    _use_gm_mask(monkeypatch, tmpdir, mask, np.diag([2., 2., 2., 1.]))
+
+    # The 3D grey matter mask is split as a single map.
+    hemi_data = [masking.get_hemi_gm_mask(hemi).get_data().squeeze() > 0
+                 for hemi in ('R', 'L')]
+    np.testing.assert_array_equal(hemi_data[0], mask.astype(bool) & (np.arange(7) < 4)[:, None, None])
+    np.testing.assert_array_equal(hemi_data[1], mask.astype(bool) & (np.arange(7) >= 4)[:, None, None])
+
+
+def test_get_gm_mask_img_resolution(monkeypatch, tmpdir):
+    mask, affine = _get_ellipsoid_mask()
+    _use_gm_mask(monkeypatch, tmpdir, mask, affine)
+
+    gm_img = masking.get_gm_mask_img()
+    coarse_img = masking.get_gm_mask_img(resolution=4)
+    assert masking.get_gm_mask_img(resolution=4) is coarse_img
+
+    # Same center and orientation, at the new voxel size; still binary.
+    for img in (gm_img, coarse_img):
+        center = img.affine[:3, :3].dot((np.asarray(img.shape) - 1) / 2.) + img.affine[:3, 3]
+        np.testing.assert_allclose(center, 0, atol=1e-10)
+    np.testing.assert_array_equal(np.diag(coarse_img.affine), [-4, 4, 4, 1])
+    assert coarse_img.shape == (11, 7, 6)
+    assert set(np.unique(coarse_img.get_data())) == set([0, 1])
+    # Roughly the same volume
+    n_coarse = coarse_img.get_data().sum() * 8
+    assert abs(n_coarse - mask.sum()) < 0.2 * mask.sum()
+
+    assert masking.get_img_resolution(gm_img) is None
+    assert masking.get_img_resolution(coarse_img) == 4.
+
+
+def test_get_masked_data_coarse(monkeypatch, tmpdir):
+    mask, affine = _get_ellipsoid_mask()
+    _use_gm_mask(monkeypatch, tmpdir, mask, affine)
+    coarse_img = masking.get_gm_mask_img(resolution=4)
+    hemi_masks = dict((hemi, masking.get_hemi_gm_mask(hemi, resolution=4).get_data() > 0)
+                      for hemi in ('L', 'R', 'wb'))
+    assert not (hemi_masks['L'] & hemi_masks['R']).any()
+    np.testing.assert_array_equal(hemi_masks['L'] | hemi_masks['R'], hemi_masks['wb'])
+
+    # Images on the coarse grid are masked with the coarse masks.
+    data = np.random.RandomState(0).rand(*(coarse_img.shape + (2,)))
+    img = nib.Nifti1Image(data, coarse_img.affine)
+    np.testing.assert_array_equal(masking.get_masked_data(img, hemi='L'),
+                                  data[hemi_masks['L']].T)
+
+    # Flipping maps each voxel onto its mirror image, in the other hemisphere.
+    idx = masking.get_mask_index('R', 'L', flip=True, resolution=4)
+    r_coords = _get_coords(coarse_img, hemi_masks['R'])
+    l_coords = _get_coords(coarse_img, hemi_masks['L'])
+    assert (idx >= 0).sum() > 0.8 * len(idx)
+    for ii, src_idx in enumerate(idx):
+        mirror = l_coords[:, ii:ii + 1] * [[-1], [1], [1]]
+        matches = np.flatnonzero(np.all(np.isclose(r_coords, mirror), axis=0))
+        assert list(matches) == ([src_idx] if src_idx >= 0 else [])
+
+
+def test_get_parcel_matrix(monkeypatch, tmpdir):
+    mask = np.zeros((8, 4, 3), dtype=np.int8)
+    mask[:, 1:3, 1] = 1
+    affine = np.diag([2., 2., 2., 1.])
+    _use_gm_mask(monkeypatch, tmpdir, mask, affine)
+    mask_img = masking.get_gm_mask_img()
+
+    # Label 1 straddles the midline; label 2 is right-only; some voxels unlabeled.
+    labels = np.zeros(mask.shape, dtype=np.int16)
+    labels[2:6] = 1
+    labels[:2] = 2
+    labels[7] = 3
+    labels[:, 0] = 4  # outside the mask
+    membership, parcels = masking.get_parcel_matrix(
+        nib.Nifti1Image(labels, affine), mask_img)
+
+    assert parcels == [(1, 'R'), (1, 'L'), (2, 'R'), (3, 'L')]
+    assert membership.shape == (mask.sum(), 4)
+    membership = membership.toarray()
+    mask_labels = labels[mask > 0]
+    is_left = (np.arange(8) >= 4)[:, None, None].repeat(4, axis=1).repeat(3, axis=2)[mask > 0]
+    for col, (label, hemi) in zip(membership.T, parcels):
+        np.testing.assert_array_equal(
+            col, (mask_labels == label) & (is_left == (hemi == 'L')))
+
+    # Label images on another grid are resampled (nearest neighbor).
+    padded_labels = np.concatenate([labels, np.zeros((8, 4, 2), dtype=np.int16)], axis=2)
+    padded_membership, padded_parcels = masking.get_parcel_matrix(
+        nib.Nifti1Image(padded_labels, affine), mask_img)
+    assert padded_parcels == parcels
+    np.testing.assert_array_equal(padded_membership.toarray(), membership)
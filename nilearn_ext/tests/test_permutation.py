@@ -0,0 +1,54 @@
+import numpy as np
+from scipy import stats
+
+from nilearn_ext.permutation import (get_p_values, permutation_null_corr, row_correlations,
+                                     sign_flip_null)
+
+
+def _data(random_state=0):
+    rng = np.random.RandomState(random_state)
+    data1 = rng.randn(4, 500)
+    data2 = 0.5 * data1 + rng.randn(4, 500)
+    return data1, data2
+
+
+def test_sign_flip_null():
+    rng = np.random.RandomState(1)
+    diffs = rng.randint(-1, 2, size=(6, 300))
+    null = sign_flip_null(diffs, n_permutations=50, random_state=3)
+    assert null.shape == (6, 50)
+
+    # Each permutation is one set of flips, shared by all rows.
+    seed = np.random.RandomState(3).randint(np.iinfo(np.int32).max, size=50)[7]
+    signs = 2 * np.random.RandomState(seed).randint(2, size=300) - 1
+    np.testing.assert_array_equal(null[:, 7], np.dot(diffs, signs))
+
+
+def test_nulls_depend_on_seed_only():
+    data1, data2 = _data()
+    diffs = np.sign(data1 - data2)
+    for null_func, kwargs in ((sign_flip_null, dict(max_memory=300 * 4 * 7)),
+                              (permutation_null_corr, dict())):
+        args = (diffs,) if null_func is sign_flip_null else (data1, data2)
+        null = null_func(*args, n_permutations=40, random_state=0)
+        np.testing.assert_array_equal(
+            null, null_func(*args, n_permutations=40, random_state=0, n_jobs=3, **kwargs))
+        assert not np.array_equal(null, null_func(*args, n_permutations=40, random_state=1))
+
+
+def test_permutation_null_corr():
+    data1, data2 = _data()
+    observed = row_correlations(data1, data2)
+    np.testing.assert_allclose(
+        observed, [stats.pearsonr(row1, row2)[0] for row1, row2 in zip(data1, data2)])
+
+    null = permutation_null_corr(data1, data2, n_permutations=200)
+    assert null.shape == (4, 200)
+    assert np.abs(null).max() < 0.3  # shuffling destroys the (~0.45) correlation
+    np.testing.assert_array_equal(get_p_values(observed, null, tail='greater'), 1 / 201.)
+
+
+def test_get_p_values():
+    null = np.array([[-2., -1., 1., 2.], [0., 0., 0., 0.]])
+    np.testing.assert_allclose(get_p_values([1.5, np.nan], null), [3 / 5., np.nan])
+    np.testing.assert_allclose(get_p_values([1.5, 0.], null, tail='greater'), [2 / 5., 1.])
@@ -0,0 +1,84 @@
+import os
+import os.path as op
+import time
+
+from nilearn_ext.workqueue import WorkQueue
+
+
+def test_claim_complete(tmpdir):
+    queue = WorkQueue(str(tmpdir))
+    assert queue.submit('a', dict(n_components=5))
+    assert not queue.submit('a', dict(n_components=5))
+
+    job_id, job = queue.claim()
+    assert job_id == 'a' and job['worker'] == queue.worker
+    assert queue.claim() is None
+    assert queue.complete(job_id, img_path='a.nii.gz')
+    assert queue.status() == dict(pending=0, claimed=0, done=1, failed=0)
+
+
+def test_heartbeat_keeps_claim(tmpdir):
+    queue = WorkQueue(str(tmpdir))
+    queue.submit('a', dict())
+    job_id, _ = queue.claim()
+    old = time.time() - 100
+    os.utime(os.path.join(str(tmpdir), 'claimed', 'a.json'), (old, old))
+
+    assert queue.heartbeat(job_id)
+    assert queue.requeue(older_than=50) == []
+    with queue.keep_alive(job_id, interval=0.01):
+        time.sleep(0.05)
+    assert queue.status()['claimed'] == 1
+
+
+def test_finish_requeued_job(tmpdir):
+    queue, other = WorkQueue(str(tmpdir)), WorkQueue(str(tmpdir))
+    other.worker = 'other-node:1'
+    queue.submit('a', dict())
+    job_id, _ = queue.claim()
+
+    # Requeued (e.g. as stale): finishing leaves it pending.
+    assert queue.requeue() == ['a']
+    assert not queue.complete(job_id)
+    assert queue.status()['pending'] == 1
+
+    # ... and claimed by another worker: finishing leaves it to that worker.
+    other.claim()
+    assert not queue.fail(job_id, error='boom')
+    assert queue.status()['claimed'] == 1
+    assert other.complete(job_id)
+    assert queue.status()['done'] == 1
+
+
+def test_claim_requeued_meanwhile(tmpdir, monkeypatch):
+    queue = WorkQueue(str(tmpdir))
+    queue.submit('a', dict())
+    real_utime = os.utime
+
+    # Requeued between the claiming rename and adding the worker to the claim:
+    # right before, and right after, the claim's mtime is refreshed.
+    for requeue_first in (True, False):
+        def utime(path, times):
+            if requeue_first:
+                queue.requeue()
+            real_utime(path, times)
+            if not requeue_first:
+                queue.requeue()
+        monkeypatch.setattr(os, 'utime', utime)
+        assert queue.claim() is None
+        assert queue.status() == dict(pending=1, claimed=0, done=0, failed=0)
+
+    monkeypatch.setattr(os, 'utime', real_utime)
+    job_id, job = queue.claim()
+    assert job['worker'] == queue.worker
+    assert queue.status() == dict(pending=0, claimed=1, done=0, failed=0)
+    assert os.listdir(op.join(str(tmpdir), 'claimed')) == ['a.json']
+
+
+def test_claim_refreshes_mtime(tmpdir):
+    queue = WorkQueue(str(tmpdir))
+    queue.submit('a', dict())
+    old = time.time() - 100
+    os.utime(op.join(str(tmpdir), 'pending', 'a.json'), (old, old))
+    queue.claim()
+    assert queue.requeue(older_than=50) == []
@@ -0,0 +1,167 @@
+# *- encoding: utf-8 -*-
+# Author: Ben Cipollini
+# License: BSD
+"""
+Lightweight per-stage instrumentation.
+
+    with stage('ica', hemi=hemi, n_components=20) as st:
+        ...
+        st.add(n_images)
+
+records wall time, cpu time, peak RSS and an item count for the stage,
+tagged with its keyword arguments. Disabled (the default), stage()
+returns a shared no-op object. Once enabled, write_trace() saves the
+stages as a Chrome trace (chrome://tracing, or ui.perfetto.dev) and
+print_summary() prints totals per stage and tags.
+"""
+
+import json
+import os
+import os.path as op
+import sys
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from timeit import default_timer
+
+try:
+    import resource
+except ImportError:  # windows
+    resource = None
+
+
+_events = []
+_enabled = False
+_t0 = default_timer()
+
+
+def enable():
+    global _enabled
+    _enabled = True
+
+
+def is_enabled():
+    return _enabled
+
+
+def _cpu_time():
+    times = os.times()
+    return times[0] + times[1]  # user + system
+
+
+def _peak_rss_mb():
+    """Peak resident memory of the process so far, in MB."""
+    if resource is None:
+        return None
+    # ru_maxrss is in kB on linux, in bytes on OS X.
+    scale = 1024. ** 2 if sys.platform == 'darwin' else 1024.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+
+
+class _NullStage(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def add(self, count=1):
+        pass
+
+
+_null_stage = _NullStage()
+
+
+class Stage(object):
+    def __init__(self, name, tags):
+        self.name = name
+        self.tags = tags
+        self.count = 0
+
+    def add(self, count=1):
+        """Count items (images, components, ...) processed in this stage."""
+        self.count += count
+
+    def __enter__(self):
+        self.start = default_timer()
+        self.cpu_start = _cpu_time()
+        return self
+
+    def __exit__(self, *args):
+        _events.append(dict(
+            name=self.name, tags=self.tags, count=self.count,
+            start=self.start - _t0, wall=default_timer() - self.start,
+            cpu=_cpu_time() - self.cpu_start, peak_rss_mb=_peak_rss_mb(),
+            tid=threading.current_thread().ident))
+        return False
+
+
+def stage(name, **tags):
+    """Time a pipeline stage (see module docstring); no-op unless enabled."""
+    if not _enabled:
+        return _null_stage
+    return Stage(name, tags)
+
+
+def get_events():
+    return list(_events)
+
+
+def write_trace(out_path):
+    """Save recorded stages in Chrome trace event format."""
+    pid = os.getpid()
+    trace_events = []
+    for ev in _events:
+        args = dict(ev['tags'], cpu_s=round(ev['cpu'], 6), count=ev['count'],
+                    peak_rss_mb=ev['peak_rss_mb'])
+        trace_events.append(dict(
+            name=ev['name'], cat='stage', ph='X', pid=pid, tid=ev['tid'],
+            ts=int(ev['start'] * 1e6), dur=int(ev['wall'] * 1e6), args=args))
+
+    if op.dirname(out_path) and not op.exists(op.dirname(out_path)):
+        os.makedirs(op.dirname(out_path))
+    with open(out_path, 'w') as fp:
+        json.dump(dict(traceEvents=trace_events, displayTimeUnit='ms'), fp)
+    return out_path
+
+
+def summarize(by=('hemi', 'n_components')):
+    """Totals per stage name and (the given) tags, in order of first use."""
+    totals = OrderedDict()
+    for ev in _events:
+        key = (ev['name'],) + tuple(ev['tags'].get(tag) for tag in by)
+        tot = totals.setdefault(key, dict(calls=0, wall=0., cpu=0., count=0,
+                                          peak_rss_mb=0.))
+        tot['calls'] += 1
+        tot['wall'] += ev['wall']
+        tot['cpu'] += ev['cpu']
+        tot['count'] += ev['count']
+        tot['peak_rss_mb'] = max(tot['peak_rss_mb'], ev['peak_rss_mb'] or 0)
+    return totals
+
+
+def print_summary(by=('hemi', 'n_components')):
+    totals = summarize(by=by)
+    if not totals:
+        return
+    header = ('stage',) + tuple(by) + ('calls', 'wall (s)', 'cpu (s)', 'items', 'peak RSS (MB)')
+    print(("%-28s" + " %12s" * (len(header) - 1)) % header)
+    for key, tot in totals.items():
+        key = key[:1] + tuple('-' if val is None else val for val in key[1:])
+        print(("%-28s" + " %12s" * len(by) + " %12d %12.2f %12.2f %12d %12.1f") % (
+            key + (tot['calls'], tot['wall'], tot['cpu'], tot['count'], tot['peak_rss_mb'])))
+
+
+@contextmanager
+def record_trace(out_path=None):
+    """For scripts: if out_path, enable tracing; on exit (even on error),
+    save the trace there and print the summary."""
+    if out_path is None:
+        yield
+        return
+    enable()
+    try:
+        yield
+    finally:
+        print("Saved trace to %s" % write_trace(out_path))
+        print_summary()
@@ -73,7 +73,7 @@ def get_match_idx_pair(score_mat, sign_mat, force=False):
         # sort by rows
         ordered_rows = rows[np.argsort(rows)]
         ordered_cols = cols[np.argsort(rows)]
-        sign_arr = sign_mat[[ordered_rows, ordered_cols]]
+        sign_arr = sign_mat[ordered_rows, ordered_cols]
 
         match["idx"] = np.vstack((ordered_rows, ordered_cols))
         match["sign"] = np.vstack((np.ones(len(rows)), sign_arr))
@@ -82,7 +82,7 @@ def get_match_idx_pair(score_mat, sign_mat, force=False):
     else:
         rows = np.arange(score_mat.shape[0])
         cols = score_mat.argmin(axis=1)
-        matched_signs = sign_mat[[rows, cols]]
+        matched_signs = sign_mat[rows, cols]
 
         match["idx"] = np.vstack((rows, cols))
         match["sign"] = np.vstack((np.ones(len(rows)), matched_signs))
@@ -93,7 +93,7 @@ def get_match_idx_pair(score_mat, sign_mat, force=False):
         else:
             unmatched_msi = score_mat.argmin(axis=0)
             unmatched_rows = unmatched_msi[unmatched_cols]
-            unmatched_signs = sign_mat[[unmatched_rows, unmatched_cols]]
+            unmatched_signs = sign_mat[unmatched_rows, unmatched_cols]
 
             unmatch["idx"] = np.vstack((unmatched_rows, unmatched_cols))
             unmatch["sign"] = np.vstack((np.ones(len(unmatched_rows)), unmatched_signs))
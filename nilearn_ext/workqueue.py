@@ -0,0 +1,180 @@
+# *- encoding: utf-8 -*-
+# Author: Ben Cipollini, Ami Tsuchida
+# License: BSD
+"""
+A job queue in a (shared) directory; no server needed.
+
+Each job is a json file, in one of the sub-directories pending/,
+claimed/, done/ or failed/. Workers claim a job by renaming it from
+pending/ to claimed/: a rename is atomic (also on NFS), so exactly one
+worker gets each job, whatever node it runs on. While it runs a job, a
+worker touches the claim file (keep_alive), so claims of dead workers
+can be told apart by their age, and requeued.
+"""
+
+import json
+import os
+import os.path as op
+import socket
+import threading
+import time
+from contextlib import contextmanager
+
+STATES = ('pending', 'claimed', 'done', 'failed')
+
+
+class WorkQueue(object):
+    def __init__(self, queue_dir):
+        self.queue_dir = queue_dir
+        self.worker = '%s:%d' % (socket.gethostname(), os.getpid())
+        for state in STATES:
+            if not op.exists(self._get_path(state)):
+                try:
+                    os.makedirs(self._get_path(state))
+                except OSError:  # another process created it
+                    pass
+
+    def _get_path(self, state, job_id=None):
+        if job_id is None:
+            return op.join(self.queue_dir, state)
+        return op.join(self.queue_dir, state, '%s.json' % job_id)
+
+    def _read(self, state, job_id):
+        with open(self._get_path(state, job_id), 'r') as fp:
+            return json.load(fp)
+
+    def _write(self, state, job_id, job):
+        # Hidden temp file (ignored by list_jobs), renamed into place.
+        path = self._get_path(state, job_id)
+        tmp_path = op.join(op.dirname(path), '.%s.%s.%d' % (
+            op.basename(path), socket.gethostname(), os.getpid()))
+        with open(tmp_path, 'w') as fp:
+            json.dump(job, fp, indent=1, sort_keys=True)
+        os.rename(tmp_path, path)
+
+    def list_jobs(self, state):
+        return sorted(name[:-len('.json')] for name in os.listdir(self._get_path(state))
+                      if name.endswith('.json') and not name.startswith('.'))
+
+    def get_state(self, job_id):
+        for state in STATES:
+            if op.exists(self._get_path(state, job_id)):
+                return state
+        return None
+
+    def submit(self, job_id, job):
+        """Add a job, unless it's queued (in any state) already.
+        Returns whether it was added."""
+        if self.get_state(job_id) is not None:
+            return False
+        self._write('pending', job_id, dict(job, submitted=time.time()))
+        return True
+
+    def claim(self):
+        """Claim the first pending job; returns (job_id, job), or None if
+        no job is pending."""
+        for job_id in self.list_jobs('pending'):
+            claimed_path = self._get_path('claimed', job_id)
+            tmp_path = op.join(op.dirname(claimed_path), '.%s.%s.%d.claim' % (
+                op.basename(claimed_path), socket.gethostname(), os.getpid()))
+            try:
+                os.rename(self._get_path('pending', job_id), claimed_path)
+                # The rename keeps the submit time; don't look stale meanwhile.
+                os.utime(claimed_path, None)
+                # Take the claim file out of claimed/ while adding the worker
+                # to it, so it can't be requeued (and claimed twice) meanwhile.
+                os.rename(claimed_path, tmp_path)
+                with open(tmp_path, 'r') as fp:
+                    job = json.load(fp)
+            except (IOError, OSError):  # claimed, or requeued, by another worker first
+                continue
+            job.update(worker=self.worker, claimed=time.time())
+            self._write('claimed', job_id, job)
+            os.remove(tmp_path)
+            return job_id, job
+        return None
+
+    def heartbeat(self, job_id):
+        """Mark a claimed job as still running; returns whether it's still claimed."""
+        try:
+            os.utime(self._get_path('claimed', job_id), None)
+        except OSError:  # requeued meanwhile
+            return False
+        return True
+
+    @contextmanager
+    def keep_alive(self, job_id, interval=60.):
+        """Heartbeat a claimed job every interval seconds, while running it."""
+        stopped = threading.Event()
+
+        def beat():
+            while not stopped.wait(interval):
+                self.heartbeat(job_id)
+
+        thread = threading.Thread(target=beat)
+        thread.daemon = True
+        thread.start()
+        try:
+            yield
+        finally:
+            stopped.set()
+            thread.join()
+
+    def _finish(self, job_id, state, **info):
+        """Move this worker's claim of a job to state. Returns False (and
+        leaves the job be) if the job was requeued since it was claimed."""
+        # Take the claim file out of claimed/ first, so that it can't be
+        # requeued while we check that it's (still) ours.
+        claimed_path = self._get_path('claimed', job_id)
+        tmp_path = op.join(op.dirname(claimed_path), '.%s.%s.%d.finish' % (
+            op.basename(claimed_path), socket.gethostname(), os.getpid()))
+        try:
+            os.rename(claimed_path, tmp_path)
+        except OSError:
+            print("%s was requeued while running; not marking it %s." % (job_id, state))
+            return False
+        with open(tmp_path, 'r') as fp:
+            job = json.load(fp)
+        if job.get('worker') != self.worker:  # requeued, then claimed by another worker
+            os.rename(tmp_path, claimed_path)
+            print("%s was requeued while running; not marking it %s." % (job_id, state))
+            return False
+
+        job.update(info, finished=time.time())
+        self._write(state, job_id, job)
+        os.remove(tmp_path)
+        return True
+
+    def complete(self, job_id, **results):
+        return self._finish(job_id, 'done', **results)
+
+    def fail(self, job_id, error):
+        return self._finish(job_id, 'failed', error=error)
+
+    def requeue(self, state='claimed', older_than=None):
+        """Move jobs back to pending: failed ones, or claimed ones whose
+        worker died (no heartbeat for more than older_than seconds; make
+        that a few keep_alive intervals). Returns the requeued job ids."""
+        requeued = []
+        for job_id in self.list_jobs(state):
+            path = self._get_path(state, job_id)
+            try:
+                if older_than is not None and time.time() - op.getmtime(path) < older_than:
+                    continue
+                os.rename(path, self._get_path('pending', job_id))
+            except OSError:  # finished (or requeued) meanwhile
+                continue
+            requeued.append(job_id)
+        return requeued
+
+    def get_jobs(self, state):
+        jobs = []
+        for job_id in self.list_jobs(state):
+            try:
+                jobs.append((job_id, self._read(state, job_id)))
+            except (IOError, OSError):  # moved meanwhile
+                continue
+        return jobs
+
+    def status(self):
+        return dict((state, len(self.list_jobs(state))) for state in STATES)
@@ -13,32 +13,45 @@ score matrix).
 
 import os.path as op
 
-import matplotlib.pyplot as plt
 import numpy as np
-import pandas as pd
 import re
 
-from main import do_main_analysis, get_dataset
+from match import (do_match_analysis, get_dataset, get_dataset_key, get_matches,
+                   load_saved_match_results)
 from nibabel_ext import NiftiImageWithTerms
-from nilearn_ext.masking import HemisphereMasker
+from nilearn_ext.backends import BACKENDS, DEFAULT_BACKEND
+from nilearn_ext.cache import get_dataset_memory
+from nilearn_ext.checkpoint import Manifest, atomic_path
 from nilearn_ext.plotting import save_and_close
-from nilearn_ext.utils import get_match_idx_pair
-from sklearn.externals.joblib import Memory
+from nilearn_ext.tracing import record_trace
 
+# matplotlib, pandas (which imports matplotlib) and nilearn (via nilearn_ext.masking)
+# are imported by the functions that use them, so that --help starts fast.
 
-def image_analyses(components, dataset, memory=Memory(cachedir='nilearn_cache'),
-                   **kwargs):
+
+def image_analyses(components, dataset, memory=None,
+                   resolution=None, parcellation=None, backend=DEFAULT_BACKEND, n_seeds=10,
+                   random_state=42, **kwargs):
     """
     1) Plot sparsity of ICA images for wb, R, and L.
     2) Plot Hemispheric Participation Index (HPI) for wb ICA images
     """
-    out_dir = op.join('ica_imgs', dataset)
+    import matplotlib.pyplot as plt
+    import pandas as pd
+    from nilearn_ext.masking import HemisphereMasker
+
+    dataset_key = get_dataset_key(dataset, resolution=resolution,
+                                  parcellation=parcellation, backend=backend, n_seeds=n_seeds,
+                                  random_state=random_state)
+    out_dir = op.join('ica_imgs', dataset_key)
+    memory = get_dataset_memory(dataset_key) if memory is None else memory
     images_key = ["R", "L", "wb"]
     sparsity_levels = ['pos_005', 'neg_005', 'abs_005']
 
     # For calculating hemispheric participation index (HPI) from wb components,
     # prepare hemisphere maskers
-    hemi_maskers = [HemisphereMasker(hemisphere=hemi, memory=memory).fit()
+    hemi_maskers = [HemisphereMasker(hemisphere=hemi, memory=memory,
+                                     resolution=resolution).fit()
                     for hemi in ['R', 'L']]
 
     # Store sparsity (and hpi for wb) vals in a DF
@@ -50,7 +63,7 @@ def image_analyses(components, dataset, memory=Memory(cachedir='nilearn_cache'),
     # Loop over components
     for c in components:
         print("Simply loading component images for n_component = %s" % c)
-        nii_dir = op.join('ica_nii', dataset, str(c))
+        nii_dir = op.join('ica_nii', dataset_key, str(c))
         for hemi in images_key:
             img_path = op.join(nii_dir, '%s_ica_components.nii.gz' % (hemi))
             img = NiftiImageWithTerms.from_filename(img_path)
@@ -141,89 +154,110 @@ def image_analyses(components, dataset, memory=Memory(cachedir='nilearn_cache'),
     # Save sparsity and HPI vals for all the components
     for hemi in images_key:
         hemi_dfs[hemi].index.name = "idx"
-        hemi_dfs[hemi].to_csv(op.join(out_dir, "%s_summary.csv" % (hemi)))
+        with atomic_path(op.join(out_dir, "%s_summary.csv" % (hemi))) as tmp_path:
+            hemi_dfs[hemi].to_csv(tmp_path)
 
 
 def main_ic_loop(components, scoring,
                  dataset, query_server=True, force=False,
-                 memory=Memory(cachedir='nilearn_cache'), **kwargs):
+                 memory=None, resolution=None,
+                 parcellation=None, backend=DEFAULT_BACKEND, n_seeds=10,
+                 random_state=42, resume=False, **kwargs):
+    """
+    With resume, pick up an interrupted sweep where it stopped: the scores
+    of each (match method, n_components) are checkpointed as they're done.
+    """
+    import matplotlib.pyplot as plt
+    import pandas as pd
+
     # $FIX Test with just 'wb' and 'rl' matching until 'lr' matching is fixed
     # match_methods = ['wb', 'rl', 'lr']
     match_methods = ['wb', 'rl']
-    out_dir = op.join('ica_imgs', dataset)
+    dataset_key = get_dataset_key(dataset, resolution=resolution, parcellation=parcellation,
+                                  backend=backend, n_seeds=n_seeds, random_state=random_state)
+    out_dir = op.join('ica_imgs', dataset_key)
     mean_scores, unmatched = [], []
 
     # Get the data once.
     images, term_scores = get_dataset(
         dataset, query_server=query_server)
 
+    # Each (match_method, n_components) is a unit of work; with resume,
+    # units done by an earlier (interrupted) run are not re-run.
+    manifest = Manifest(op.join(out_dir, '%s-simscores_manifest.json' % scoring),
+                        resume=resume)
+
     for match_method in match_methods:
         print("Plotting results for %s matching method" % match_method)
-        mean_score_d, num_unmatched_d = {}, {}
+        mean_score_rows, num_unmatched_rows = [], []
         for c in components:
+            unit = '%s/%d' % (match_method, c)
+            if manifest.is_done(unit):
+                print("Skipping %d components (%s matching); done already." % (c, match_method))
+                mean_score_rows.append(manifest.get(unit)['mean_scores'])
+                num_unmatched_rows.append(manifest.get(unit)['n_unmatched'])
+                continue
+
             print("Running analysis with %d components" % c)
-            # main analysis is run for each component and match method:
+            # main analysis is run for each component and match method,
+            # unless its scores were saved by an earlier run:
             # plotting for component comparisons are done only if force=True
-            img_d, score_mats_d, sign_mats_d = do_main_analysis(
-                dataset=dataset, images=images, term_scores=term_scores,
-                key=match_method, force=force, plot=force,
-                n_components=c, scoring=scoring, **kwargs)
+            saved_mats = None if force else load_saved_match_results(
+                op.join('ica_nii', dataset_key, str(c)), match_method, scoring)
+            if saved_mats is not None:
+                score_mats_d, sign_mats_d, _ = saved_mats
+            else:
+                img_d, score_mats_d, sign_mats_d = do_match_analysis(
+                    dataset=dataset, images=images, term_scores=term_scores,
+                    key=match_method, force=force, plot=force,
+                    n_components=c, scoring=scoring, resolution=resolution,
+                    parcellation=parcellation, backend=backend, n_seeds=n_seeds,
+                    random_state=random_state, **kwargs)
 
             # Get mean dissimilarity scores and number of unmatched for each comparisons
             # in score_mats_d
+            mean_score_d, num_unmatched_d = {}, {}
             for comp in score_mats_d:
                 score_mat, sign_mat = score_mats_d[comp], sign_mats_d[comp]
                 # For ("wb", "RL-forced") and ("wb", "RL-unforced")
                 if "forced" in comp[1]:
                     if "-forced" in comp[1]:
-                        match, unmatch = get_match_idx_pair(score_mat, sign_mat, force=True)
+                        match, unmatch = get_matches(comp, score_mat, sign_mat, True, saved_mats)
                     elif "-unforced" in comp[1]:
-                        match, unmatch = get_match_idx_pair(score_mat, sign_mat, force=False)
+                        match, unmatch = get_matches(comp, score_mat, sign_mat, False, saved_mats)
                         n_unmatched = unmatch["idx"].shape[1] if unmatch["idx"] is not None else 0
-                        um_label = "unmatched RL"
+                        num_unmatched_d["unmatched RL"] = n_unmatched
                     mean_score = score_mat[[match["idx"][0], match["idx"][1]]].mean()
-                    score_label = "%s" % (" vs ".join(comp))
-                    # Store values in respective dict
-                    if c == components[0]:
-                        mean_score_d[score_label] = [mean_score]
-                        if "-unforced" in comp[1]:
-                            num_unmatched_d[um_label] = [n_unmatched]
-                    else:
-                        mean_score_d[score_label].append(mean_score)
-                        if "-unforced" in comp[1]:
-                            num_unmatched_d[um_label].append(n_unmatched)
+                    mean_score_d["%s" % (" vs ".join(comp))] = float(mean_score)
 
                 # For ("wb", "R"), ("wb", "L") --wb matching or ("R", "L") --rl matching
                 else:
                     for force_match in [True, False]:
-                        match, unmatch = get_match_idx_pair(score_mat, sign_mat, force=force_match)
+                        match, unmatch = get_matches(comp, score_mat, sign_mat, force_match,
+                                                     saved_mats)
                         mean_score = score_mat[[match["idx"][0], match["idx"][1]]].mean()
                         if force_match:
                             score_label = "%s%s" % (" vs ".join(comp), "-forced")
-                            n_unmatched = None
                         else:
                             score_label = "%s%s" % (" vs ".join(comp), "-unforced")
                             n_unmatched = unmatch["idx"].shape[1] if unmatch["idx"] is not None else 0
-                            um_label = "unmatched %s" % comp[1]
-                        # Store values in respective dict
-                        if c == components[0]:
-                            mean_score_d[score_label] = [mean_score]
-                            if not force_match:
-                                num_unmatched_d[um_label] = [n_unmatched]
-                        else:
-                            mean_score_d[score_label].append(mean_score)
-                            if not force_match:
-                                num_unmatched_d[um_label].append(n_unmatched)
+                            num_unmatched_d["unmatched %s" % comp[1]] = n_unmatched
+                        mean_score_d[score_label] = float(mean_score)
+
+            manifest.mark_done(unit, mean_scores=mean_score_d, n_unmatched=num_unmatched_d)
+            mean_score_rows.append(mean_score_d)
+            num_unmatched_rows.append(num_unmatched_d)
 
         # Store vals as df
-        ms_df = pd.DataFrame(mean_score_d, index=components)
-        um_df = pd.DataFrame(num_unmatched_d, index=components)
+        ms_df = pd.DataFrame(mean_score_rows, index=components)
+        um_df = pd.DataFrame(num_unmatched_rows, index=components)
         mean_scores.append(ms_df)
         unmatched.append(um_df)
         # Save combined df
         combined = pd.concat([ms_df, um_df], axis=1)
         out = op.join(out_dir, '%s-matching_simscores.csv' % match_method)
-        combined.to_csv(out)
+        with atomic_path(out) as tmp_path:
+            combined.to_csv(tmp_path)
 
     # We have all the scores for the matching method; now plot.
     fh, axes = plt.subplots(1, len(match_methods), sharex=True, sharey=True, figsize=(18, 6))
@@ -274,6 +308,9 @@ if __name__ == '__main__':
     # parser.add_argument('key2', nargs='?', default='L', choices=hemi_choices)
     parser.add_argument('--noSimScore', action='store_true', default=False)
     parser.add_argument('--force', action='store_true', default=False)
+    parser.add_argument('--resume', action='store_true', default=False,
+                        help="Continue an interrupted run, skipping the "
+                             "n_components already done.")
     parser.add_argument('--offline', action='store_true', default=False)
     parser.add_argument('--components', nargs='?',
                         default="5,10,15,20,25,30,35,40,45,50")
@@ -283,6 +320,19 @@ if __name__ == '__main__':
                         dest='random_state')
     parser.add_argument('--scoring', nargs='?', default='l1norm',
                         choices=['l1norm', 'l2norm', 'correlation'])
+    parser.add_argument('--resolution', nargs='?', type=float, default=None,
+                        help="Resample mask and images to this resolution (mm), "
+                             "e.g. 4 or 6, for fast exploratory runs.")
+    parser.add_argument('--parcellation', nargs='?', default=None,
+                        help="Label image (path); run ICA on parcel means "
+                             "instead of voxels.")
+    parser.add_argument('--backend', nargs='?', default=DEFAULT_BACKEND,
+                        choices=sorted(BACKENDS))
+    parser.add_argument('--n-seeds', nargs='?', type=int, default=10,
+                        help="Number of FastICA runs for the ensemble backend.")
+    parser.add_argument('--trace', nargs='?', const='trace.json', default=None,
+                        help="Save per-stage timings to this Chrome trace (json) file, "
+                             "and print a summary.")
     args = vars(parser.parse_args())
 
     # Alias args
@@ -290,13 +340,17 @@ if __name__ == '__main__':
     # keys = args.pop('key1'), args.pop('key2')
     components = [int(c) for c in args.pop('components').split(',')]
 
-    # If noSimScore, run only image_analyses
-    if args.pop('noSimScore'):
+    no_sim_score = args.pop('noSimScore')
+    with record_trace(args.pop('trace')):
+        # If noSimScore, run only image_analyses
+        if no_sim_score:
+            image_analyses(query_server=query_server,
+                           components=components, **args)
+        # Otherwise run loops, followed by the image_analyses
+        main_ic_loop(query_server=query_server,
+                     components=components, **args)
         image_analyses(query_server=query_server,
                        components=components, **args)
-    # Otherwise run loops, followed by the image_analyses
-    main_ic_loop(query_server=query_server,
-                 components=components, **args)
-    image_analyses(query_server=query_server,
-                   components=components, **args)
+
+    import matplotlib.pyplot as plt
     plt.show()
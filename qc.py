@@ -10,10 +10,10 @@ import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
 from nilearn.plotting import plot_stat_map
-from sklearn.externals.joblib import Memory
 
 from main import get_dataset
-from nilearn_ext.image import clean_img, cast_img
+from nilearn_ext.cache import get_memory
+from nilearn_ext.image import load_clean_img
 from nilearn_ext.masking import GreyMatterNiftiMasker
 from nilearn_ext.plotting import save_and_close
 
@@ -30,7 +30,7 @@ def qc_image_metadata(images):
 
 def qc_image_data(dataset, images, plot_dir='qc'):
     # Get ready
-    masker = GreyMatterNiftiMasker(memory=Memory(cachedir='nilearn_cache')).fit()
+    masker = GreyMatterNiftiMasker(memory=get_memory()).fit()
     if op.exists(plot_dir):  # Delete old plots.
         shutil.rmtree(plot_dir)
 
@@ -40,7 +40,7 @@ def qc_image_data(dataset, images, plot_dir='qc'):
             columns=('Figure #', 'col_id', 'image_id', 'name',
                      'modality', 'map_type', 'analysis_level',
                      'is_thresholded', 'not_mni', 'brain_coverage',
-                     'perc_bad_voxels', 'perc_voxels_outside'))
+                     'perc_bad_voxels', 'perc_voxels_outside', 'n_nonfinite'))
 
     for ii, image in enumerate(images):
         im_path = image['local_path']
@@ -59,6 +59,8 @@ def qc_image_data(dataset, images, plot_dir='qc'):
         title = "%s%s" % (
             '(X) ' if image['rejected'] else '', op.basename(im_path))
 
+        img, n_nonfinite = load_clean_img(im_path, dtype=np.float32)
+
         if dataset == 'neurovault':
             fetch_summary.loc[ii] = [
                 'fig%03d' % (fi + 1), image.get('collection_id'),
@@ -66,12 +68,10 @@ def qc_image_data(dataset, images, plot_dir='qc'):
                 image.get('map_type'), image.get('analysis_level'),
                 image.get('is_thresholded'), image.get('not_mni'),
                 image.get('brain_coverage'), image.get('perc_bad_voxels'),
-                image.get('perc_voxels_outside')]
+                image.get('perc_voxels_outside'), n_nonfinite]
 
         # Images may fail to be transformed, and are of different shapes,
         # so we need to trasnform one-by-one and keep track of failures.
-        img = cast_img(im_path, dtype=np.float32)
-        img = clean_img(img)
         try:
             img = masker.inverse_transform(masker.transform(img))
         except Exception as e:
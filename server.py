@@ -0,0 +1,280 @@
+# *- encoding: utf-8 -*-
+# Author: Ben Cipollini, Ami Tsuchida
+# License: BSD
+"""
+Serve match, metric and plot jobs from one long-running process.
+
+Each script run loads the grey-matter masks, the MNI template, the
+dataset's term scores and the component images before doing any work.
+The server loads them once and keeps them (masked data included), so
+what-if queries (another scoring, key, threshold or percentile) take
+seconds. Jobs are json objects, one per line, over a local Unix socket:
+
+    python server.py serve --dataset neurovault --components 20 &
+    python server.py send '{"job": "match", "n_components": 20, "key": "rl"}'
+    python server.py send '{"job": "metric", "n_components": 20, "hpai_percentile": 90}'
+    python server.py send '{"job": "plot", "n_components": 20, "hemis": ["wb"]}'
+    python server.py send '{"job": "shutdown"}'
+
+Besides its own parameters, a job can override the dataset settings the
+server was started with (dataset, resolution, seed, ...). Jobs run one at
+a time, in the server's working directory; each gets back
+{"ok": true, "result": ..., "seconds": ...}, or {"ok": false, "error": ...}.
+"""
+
+import json
+import os
+import os.path as op
+import socket
+import traceback
+from timeit import default_timer
+
+import numpy as np
+
+from nilearn_ext.backends import BACKENDS, DEFAULT_BACKEND
+
+SOCKET_PATH = 'analysis.sock'
+
+DATASET_SETTINGS = dict(dataset='neurovault', max_images=np.inf, resolution=None,
+                        parcellation=None, backend=DEFAULT_BACKEND, n_seeds=10,
+                        random_state=42)
+
+_datasets = dict()
+
+
+def get_dataset(dataset, max_images=np.inf, query_server=False):
+    """match.get_dataset, memoized: images and term scores are read once."""
+    from match import get_dataset as _get_dataset
+
+    key = (dataset, max_images)
+    if key not in _datasets:
+        _datasets[key] = _get_dataset(dataset, max_images=max_images,
+                                      query_server=query_server)
+    return _datasets[key]
+
+
+def get_dataset_key(settings):
+    from match import get_dataset_key as _get_dataset_key
+
+    return _get_dataset_key(**dict((name, val) for name, val in settings.items()
+                                   if name != 'max_images'))
+
+
+def load_components(settings, n_components, hemi):
+    from nilearn_ext.decomposition import load_components as _load_components
+
+    img_path = op.join('ica_nii', get_dataset_key(settings), str(n_components),
+                       '%s_ica_components.nii.gz' % hemi)
+    if not op.exists(img_path):
+        raise ValueError("No %s components at %s; run a match job first." % (hemi, img_path))
+    return _load_components(img_path, hemi=hemi)
+
+
+def warm_up(settings, components=(), query_server=True):
+    """Load what jobs on these settings need: masks, template, dataset
+    and the components computed so far."""
+    from nilearn_ext.masking import get_hemi_gm_mask
+    from nilearn_ext.plotting import get_bg_img
+
+    get_dataset(settings['dataset'], settings['max_images'], query_server=query_server)
+    for hemi in ('wb', 'R', 'L'):
+        get_hemi_gm_mask(hemi, resolution=settings['resolution'])
+    get_bg_img()
+    for c in components:
+        for hemi in ('wb', 'R', 'L'):
+            try:
+                load_components(settings, c, hemi)
+            except ValueError as e:
+                print(e)
+
+
+def run_match(settings, n_components=20, key='wb', scoring='l1norm', plot=False,
+              force=False):
+    """Match components (as match.py); returns the score and sign matrices."""
+    from match import do_match_analysis
+
+    images, term_scores = get_dataset(settings['dataset'], settings['max_images'])
+    imgs, score_mats, sign_mats = do_match_analysis(
+        images=images, term_scores=term_scores, key=key, n_components=n_components,
+        scoring=scoring, plot=plot, force=force, query_server=False, **settings)
+    return dict(score_mats=dict(('%s:%s' % comp, mat) for comp, mat in score_mats.items()),
+                sign_mats=dict(('%s:%s' % comp, mat) for comp, mat in sign_mats.items()))
+
+
+def run_metric(settings, n_components=20, scoring='correlation', sparsity_threshold=None,
+               acni_percentile=95.0, hpai_percentile=95.0, n_permutations=0, plot=False):
+    """
+    Per-component summaries (as analysis.py) for one n_components; returns
+    them as lists of rows, per hemi. The sparsity threshold defaults to the
+    one of this n_components' wb components (analysis.py uses all of them).
+
+    Results go to a directory per set of parameters, under
+    ica_imgs/[dataset]/queries, not over analysis.py's outputs.
+    """
+    from analysis import get_sparsity_threshold, load_or_generate_summary
+    from nilearn_ext.cache import fingerprint, get_dataset_memory
+
+    images, term_scores = get_dataset(settings['dataset'], settings['max_images'])
+    if sparsity_threshold is None:
+        run_match(settings, n_components=n_components, scoring=scoring)
+        sparsity_threshold = get_sparsity_threshold(
+            [load_components(settings, n_components, 'wb')])
+
+    dataset_key = get_dataset_key(settings)
+    params = dict(n_components=n_components, scoring=scoring,
+                  sparsity_threshold=float(sparsity_threshold),
+                  acni_percentile=acni_percentile, hpai_percentile=hpai_percentile,
+                  n_permutations=n_permutations)
+    out_dir = op.join('ica_imgs', dataset_key, 'queries',
+                      'metric-%s' % fingerprint(params)[:12])
+    kwargs = dict((name, val) for name, val in settings.items() if name != 'max_images')
+    kwargs.update(params)
+    summaries = load_or_generate_summary(
+        images=images, term_scores=term_scores, force=True, plot=plot, out_dir=out_dir,
+        memory=get_dataset_memory(dataset_key), **kwargs)
+
+    result = dict(params, out_dir=out_dir)
+    for hemi, summary in zip(('wb', 'R', 'L'), summaries):
+        result[hemi] = json.loads(summary.to_json(orient='records'))
+    return result
+
+
+def run_plot(settings, n_components=20, hemis=('wb', 'R', 'L'), out_dir=None):
+    """Plot components (as match.py); returns the output directory."""
+    from nilearn_ext.plotting import plot_components, plot_components_summary
+
+    out_dir = out_dir or op.join('ica_nii', get_dataset_key(settings), str(n_components), 'png')
+    for hemi in hemis:
+        img = load_components(settings, n_components, hemi)
+        plot_components(img, hemi=hemi, out_dir=out_dir)
+        plot_components_summary(img, hemi=hemi, out_dir=out_dir)
+    return dict(out_dir=out_dir)
+
+
+JOBS = dict(match=run_match, metric=run_metric, plot=run_plot)
+
+
+def run_job(request, settings):
+    """Run a job (a dict with its name under 'job'); returns the reply."""
+    request = dict(request)
+    job = request.pop('job', None)
+    if job not in JOBS:
+        return dict(ok=False, error="Unknown job %r; use one of %s." % (
+            job, ', '.join(sorted(JOBS) + ['shutdown'])))
+    job_settings = dict((name, request.pop(name, val)) for name, val in settings.items())
+    if job_settings['max_images'] is None:
+        job_settings['max_images'] = np.inf  # json has no inf
+
+    start = default_timer()
+    try:
+        result = JOBS[job](job_settings, **request)
+    except Exception:
+        traceback.print_exc()
+        return dict(ok=False, error=traceback.format_exc())
+    return dict(ok=True, result=result, seconds=default_timer() - start)
+
+
+def _to_json(obj):
+    """json default, for numpy arrays and scalars."""
+    if isinstance(obj, (np.ndarray, np.generic)):
+        return obj.tolist()
+    raise TypeError("%r is not JSON serializable" % obj)
+
+
+def serve(socket_path=SOCKET_PATH, components=(), query_server=True, **settings):
+    import matplotlib
+    matplotlib.use('Agg')  # No windows; plots are saved.
+    from six.moves import socketserver
+    from nilearn_ext.decomposition import keep_components_loaded
+
+    settings = dict(DATASET_SETTINGS, **settings)
+    keep_components_loaded()
+    start = default_timer()
+    warm_up(settings, components=components, query_server=query_server)
+    print("Loaded in %.1fs." % (default_timer() - start))
+
+    class JobHandler(socketserver.StreamRequestHandler):
+        def handle(self):
+            for line in self.rfile:
+                if not line.strip():
+                    continue
+                try:
+                    request = json.loads(line.decode('utf-8'))
+                except ValueError as e:
+                    reply = dict(ok=False, error="Bad request: %s" % e)
+                else:
+                    print("Job: %s" % json.dumps(request, sort_keys=True))
+                    if request.get('job') == 'shutdown':
+                        self.server.stopping = True
+                        reply = dict(ok=True, result=None)
+                    else:
+                        reply = run_job(request, settings)
+                self.wfile.write((json.dumps(reply, default=_to_json) + '\n').encode('utf-8'))
+                self.wfile.flush()
+
+    if op.exists(socket_path):
+        os.remove(socket_path)  # left by a server that died
+    server = socketserver.UnixStreamServer(socket_path, JobHandler)
+    server.stopping = False
+    print("Serving jobs on %s" % socket_path)
+    try:
+        while not server.stopping:
+            server.handle_request()
+    finally:
+        server.server_close()
+        os.remove(socket_path)
+
+
+def send(request, socket_path=SOCKET_PATH):
+    """Send a job to the server; returns its reply."""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+        sock.sendall((json.dumps(request) + '\n').encode('utf-8'))
+        reply = b''
+        while not reply.endswith(b'\n'):
+            chunk = sock.recv(2 ** 16)
+            if not chunk:
+                break
+            reply += chunk
+    finally:
+        sock.close()
+    return json.loads(reply.decode('utf-8'))
+
+
+if __name__ == '__main__':
+    import sys
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(description="Keep masks, term scores and components loaded, "
+                                        "and run match, metric and plot jobs.")
+    parser.add_argument('--socket', nargs='?', default=SOCKET_PATH, dest='socket_path')
+    subparsers = parser.add_subparsers(dest='command')
+
+    serve_parser = subparsers.add_parser('serve', help="Start the server.")
+    serve_parser.add_argument('--offline', action='store_true', default=False)
+    serve_parser.add_argument('--components', nargs='?', default="",
+                              help="Comma-separated n_components to load at start-up.")
+    serve_parser.add_argument('--dataset', nargs='?', default='neurovault',
+                              choices=['neurovault', 'abide', 'nyu'])
+    serve_parser.add_argument('--max-images', nargs='?', type=int, default=np.inf)
+    serve_parser.add_argument('--seed', nargs='?', type=int, default=42,
+                              dest='random_state')
+    serve_parser.add_argument('--resolution', nargs='?', type=float, default=None)
+    serve_parser.add_argument('--parcellation', nargs='?', default=None)
+    serve_parser.add_argument('--backend', nargs='?', default=DEFAULT_BACKEND,
+                              choices=sorted(BACKENDS))
+    serve_parser.add_argument('--n-seeds', nargs='?', type=int, default=10)
+
+    send_parser = subparsers.add_parser('send', help="Send a job (json) to the server.")
+    send_parser.add_argument('request', help='e.g. \'{"job": "match", "n_components": 20}\'')
+    args = vars(parser.parse_args())
+
+    socket_path = args.pop('socket_path')
+    if args.pop('command') == 'serve':
+        serve(socket_path=socket_path, query_server=not args.pop('offline'),
+              components=[int(c) for c in args.pop('components').split(',') if c], **args)
+    else:
+        reply = send(json.loads(args['request']), socket_path=socket_path)
+        print(json.dumps(reply, indent=1, sort_keys=True))
+        sys.exit(0 if reply['ok'] else 1)
@@ -0,0 +1,209 @@
+# *- encoding: utf-8 -*-
+# Author: Ben Cipollini, Ami Tsuchida
+# License: BSD
+"""
+Run an analysis.py sweep on many nodes at once.
+
+Each (hemi, n_components, seed) ICA is a job in a queue directory on a
+shared filesystem (see nilearn_ext.workqueue); workers on any node claim
+jobs and write the components to ica_nii/ (and the joblib cache) as
+usual. Once all jobs are done, aggregate runs the summaries and plots
+once per seed, loading the components the workers computed.
+
+    python sweep.py submit --components 5,10,20 --seeds 42,43
+    python sweep.py work              # on each node, as often as wanted
+    python sweep.py status
+    python sweep.py requeue --stale-after 600   # jobs of dead workers
+    python sweep.py aggregate --scoring correlation
+
+All commands must run from the same (shared) working directory.
+"""
+
+import os.path as op
+import traceback
+
+import numpy as np
+
+from nilearn_ext.backends import BACKENDS, DEFAULT_BACKEND
+from nilearn_ext.workqueue import WorkQueue
+
+# Seconds between a worker's heartbeats; requeue --stale-after should be
+# a few times longer.
+HEARTBEAT_INTERVAL = 60.
+
+SETTINGS = ('dataset', 'max_images', 'resolution', 'parcellation', 'backend', 'n_seeds')
+
+_datasets = dict()
+
+
+def get_job_id(job):
+    return '%s-%s-%d' % (job['dataset_key'], job['hemi'], job['n_components'])
+
+
+def _get_dataset(dataset, max_images, query_server=False):
+    """get_dataset, memoized: a worker loads each dataset once."""
+    from match import get_dataset
+
+    key = (dataset, max_images)
+    if key not in _datasets:
+        _datasets[key] = get_dataset(dataset, max_images=max_images,
+                                     query_server=query_server)
+    return _datasets[key]
+
+
+def submit(queue, components, seeds, hemis=('wb', 'R', 'L'), query_server=True,
+           dataset='neurovault', max_images=np.inf, resolution=None,
+           parcellation=None, backend=DEFAULT_BACKEND, n_seeds=10):
+    """Queue one job per (hemi, n_components, seed) not queued already."""
+    from match import get_dataset_key
+
+    # Download once, here, so workers can run offline.
+    _get_dataset(dataset, max_images, query_server=query_server)
+
+    n_added = 0
+    for seed in seeds:
+        dataset_key = get_dataset_key(dataset, resolution=resolution,
+                                      parcellation=parcellation, backend=backend,
+                                      n_seeds=n_seeds, random_state=seed)
+        for c in components:
+            for hemi in hemis:
+                job = dict(dataset=dataset, max_images=max_images, resolution=resolution,
+                           parcellation=parcellation, backend=backend, n_seeds=n_seeds,
+                           random_state=seed, dataset_key=dataset_key,
+                           hemi=hemi, n_components=c)
+                if np.isinf(max_images):
+                    job['max_images'] = None  # json has no inf
+                n_added += queue.submit(get_job_id(job), job)
+    print("Queued %d jobs." % n_added)
+
+
+def run_job(job):
+    """Compute (or load) the components of a job; returns their path."""
+    from match import load_or_generate_components
+    from nilearn_ext.cache import get_dataset_memory
+
+    max_images = np.inf if job['max_images'] is None else job['max_images']
+    images, term_scores = _get_dataset(job['dataset'], max_images)
+    nii_dir = op.join('ica_nii', job['dataset_key'], str(job['n_components']))
+    load_or_generate_components(
+        hemi=job['hemi'], out_dir=nii_dir, no_plot=True,
+        images=[im['local_path'] for im in images], term_scores=term_scores,
+        n_components=job['n_components'], random_state=job['random_state'],
+        resolution=job['resolution'], parcellation=job['parcellation'],
+        backend=job['backend'], n_seeds=job['n_seeds'],
+        memory=get_dataset_memory(job['dataset_key']))
+    return op.join(nii_dir, '%s_ica_components.nii.gz' % job['hemi'])
+
+
+def work(queue, max_jobs=None):
+    """Claim and run jobs until none are pending (or max_jobs are run)."""
+    n_jobs = 0
+    while max_jobs is None or n_jobs < max_jobs:
+        claimed = queue.claim()
+        if claimed is None:
+            break
+        job_id, job = claimed
+        print("Running %s" % job_id)
+        try:
+            with queue.keep_alive(job_id, interval=HEARTBEAT_INTERVAL):
+                img_path = run_job(job)
+        except Exception:
+            traceback.print_exc()
+            queue.fail(job_id, error=traceback.format_exc())
+        else:
+            queue.complete(job_id, img_path=img_path)
+        n_jobs += 1
+    print("Ran %d jobs." % n_jobs)
+
+
+def print_status(queue):
+    status = queue.status()
+    print(', '.join('%s: %d' % (state, status[state])
+                    for state in ('pending', 'claimed', 'done', 'failed')))
+    for job_id, job in queue.get_jobs('failed'):
+        print("%s failed:\n%s" % (job_id, job['error'].strip().splitlines()[-1]))
+
+
+def aggregate(queue, scoring, plot=True):
+    """Summarize and plot each seed (and settings) of the finished jobs."""
+    from analysis import loop_main_and_plot
+
+    status = queue.status()
+    if status['pending'] or status['claimed']:
+        raise ValueError("%d jobs are not done yet (see `sweep.py status`)."
+                         % (status['pending'] + status['claimed']))
+
+    groups = dict()
+    for job_id, job in queue.get_jobs('done'):
+        group_key = tuple(job[name] for name in SETTINGS + ('random_state',))
+        groups.setdefault(group_key, set()).add(job['n_components'])
+
+    for group_key, components in sorted(groups.items()):
+        settings = dict(zip(SETTINGS + ('random_state',), group_key))
+        if settings['max_images'] is None:
+            settings['max_images'] = np.inf
+        print("Aggregating %s, seed %d" % (settings['dataset'], settings['random_state']))
+        loop_main_and_plot(components=sorted(components), scoring=scoring,
+                           query_server=False, plot=plot, **settings)
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(description="Run a sweep with workers on many nodes.")
+    parser.add_argument('--queue-dir', nargs='?', default='sweep_queue',
+                        help="Queue directory, on a filesystem all nodes share.")
+    subparsers = parser.add_subparsers(dest='command')
+
+    submit_parser = subparsers.add_parser('submit', help="Queue the ICA jobs of a sweep.")
+    submit_parser.add_argument('--offline', action='store_true', default=False)
+    submit_parser.add_argument('--components', nargs='?',
+                               default="5,10,15,20,30,40,50,75,100")
+    submit_parser.add_argument('--seeds', nargs='?', default="42")
+    submit_parser.add_argument('--hemis', nargs='?', default="wb,R,L")
+    submit_parser.add_argument('--dataset', nargs='?', default='neurovault',
+                               choices=['neurovault', 'abide', 'nyu'])
+    submit_parser.add_argument('--max-images', nargs='?', type=int, default=np.inf)
+    submit_parser.add_argument('--resolution', nargs='?', type=float, default=None)
+    submit_parser.add_argument('--parcellation', nargs='?', default=None)
+    submit_parser.add_argument('--backend', nargs='?', default=DEFAULT_BACKEND,
+                               choices=sorted(BACKENDS))
+    submit_parser.add_argument('--n-seeds', nargs='?', type=int, default=10)
+
+    work_parser = subparsers.add_parser('work', help="Claim and run queued jobs.")
+    work_parser.add_argument('--max-jobs', nargs='?', type=int, default=None)
+
+    subparsers.add_parser('status', help="Count jobs per state; show failures.")
+
+    requeue_parser = subparsers.add_parser(
+        'requeue', help="Queue again claimed jobs (of dead workers), or failed ones.")
+    requeue_parser.add_argument('--stale-after', nargs='?', type=float, default=None,
+                                help="Only jobs whose worker sent no heartbeat for this "
+                                     "many seconds (it sends one every %d)."
+                                     % HEARTBEAT_INTERVAL)
+    requeue_parser.add_argument('--failed', action='store_true', default=False)
+
+    aggregate_parser = subparsers.add_parser(
+        'aggregate', help="Summarize and plot, once all jobs are done.")
+    aggregate_parser.add_argument('--scoring', nargs='?', default='correlation',
+                                  choices=['l1norm', 'l2norm', 'correlation'])
+    aggregate_parser.add_argument('--no-plot', action='store_true', default=False)
+    args = vars(parser.parse_args())
+
+    queue = WorkQueue(args.pop('queue_dir'))
+    command = args.pop('command')
+    if command == 'submit':
+        submit(queue, query_server=not args.pop('offline'),
+               components=[int(c) for c in args.pop('components').split(',')],
+               seeds=[int(s) for s in args.pop('seeds').split(',')],
+               hemis=args.pop('hemis').split(','), **args)
+    elif command == 'work':
+        work(queue, **args)
+    elif command == 'status':
+        print_status(queue)
+    elif command == 'requeue':
+        state = 'failed' if args['failed'] else 'claimed'
+        requeued = queue.requeue(state=state, older_than=args['stale_after'])
+        print("Requeued %d %s jobs." % (len(requeued), state))
+    else:
+        aggregate(queue, scoring=args['scoring'], plot=not args['no_plot'])
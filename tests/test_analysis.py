@@ -0,0 +1,64 @@
+import os
+import os.path as op
+
+import pandas as pd
+import pytest
+
+import analysis
+
+
+def _patch_analysis(monkeypatch, fail_at=None):
+    """Stub out the data, ICA, summaries and plots; returns the calls made."""
+    calls = dict(generate=[], load=[], summary=[])
+
+    def load_or_generate_components(hemi, n_components, **kwargs):
+        calls['generate'].append((hemi, n_components))
+        return 'img-%s-%d' % (hemi, n_components)
+
+    def load_components(img_path, hemi):
+        calls['load'].append(img_path)
+        return 'img'
+
+    def load_or_generate_summary(n_components, out_dir, **kwargs):
+        calls['summary'].append(n_components)
+        if n_components == fail_at:
+            raise KeyboardInterrupt
+        summary = pd.DataFrame(dict(
+            [('n_comp', [n_components])] +
+            [('vc-%s_wb' % sign, [1.]) for sign in analysis.SPARSITY_SIGNS]))
+        if not op.exists(out_dir):
+            os.makedirs(out_dir)
+        for hemi in ('wb', 'R', 'L'):
+            summary.to_csv(op.join(out_dir, '%s_summary.csv' % hemi), index=False)
+        return summary, summary, summary
+
+    monkeypatch.setattr(analysis, 'get_dataset', lambda *args, **kwargs: ([], None))
+    monkeypatch.setattr(analysis, 'load_or_generate_components', load_or_generate_components)
+    monkeypatch.setattr(analysis, 'load_components', load_components)
+    monkeypatch.setattr(analysis, 'load_or_generate_summary', load_or_generate_summary)
+    monkeypatch.setattr(analysis, 'get_sparsity_threshold', lambda *args, **kwargs: 0.5)
+    for name in ('generate_component_specific_plots', '_generate_plot_1', '_generate_plot_2_3',
+                 '_generate_plot_4', '_generate_plot_5', '_generate_plot_6'):
+        monkeypatch.setattr(analysis, name, lambda *args, **kwargs: None)
+    return calls
+
+
+def test_resume_skips_done_units(monkeypatch, tmpdir):
+    monkeypatch.chdir(str(tmpdir))
+    calls = _patch_analysis(monkeypatch, fail_at=10)
+    with pytest.raises(KeyboardInterrupt):  # all ICA done, summary of 5 components done
+        analysis.loop_main_and_plot([5, 10], 'correlation', 'neurovault')
+    assert len(calls['generate']) == 6 and calls['summary'] == [5, 10]
+
+    # Done units are loaded, not re-run; without --force as well.
+    calls = _patch_analysis(monkeypatch)
+    analysis.loop_main_and_plot([5, 10], 'correlation', 'neurovault', resume=True)
+    assert calls['generate'] == []
+    assert len(calls['load']) == 6
+    assert calls['load'][0] == op.join('ica_nii', 'neurovault', '5', 'wb_ica_components.nii.gz')
+    assert calls['summary'] == [10]
+
+    # Without resume, everything is run again.
+    calls = _patch_analysis(monkeypatch)
+    analysis.loop_main_and_plot([5, 10], 'correlation', 'neurovault')
+    assert len(calls['generate']) == 6 and calls['summary'] == [5, 10]
@@ -0,0 +1,68 @@
+import json
+import os
+import os.path as op
+
+import numpy as np
+
+import hierarchy
+
+
+def test_match_model_orders_split():
+    # 2 => 4 components: component 0 splits into 0, 2 and 3.
+    score_mat = np.array([[0.1, 0.9, 0.2, 0.3],
+                          [0.8, 0.1, 0.9, 0.7]])
+    sign_mat = np.array([[1, 1, -1, 1],
+                         [1, -1, 1, 1]])
+    edges = hierarchy.match_model_orders(score_mat, sign_mat)
+    assert edges == [[0, 0, 'match', 1, 0.1],
+                     [1, 1, 'match', -1, 0.1],
+                     [0, 2, 'split', -1, 0.2],
+                     [0, 3, 'split', 1, 0.3]]
+
+
+def test_match_model_orders_merge():
+    # 3 => 2 components: components 1 and 2 merge into 1.
+    score_mat = np.array([[0.1, 0.9],
+                          [0.8, 0.2],
+                          [0.7, 0.3]])
+    sign_mat = np.ones((3, 2), dtype=int)
+    sign_mat[2, 1] = -1
+    edges = hierarchy.match_model_orders(score_mat, sign_mat)
+    assert edges == [[0, 0, 'match', 1, 0.1],
+                     [1, 1, 'match', 1, 0.2],
+                     [2, 1, 'merge', -1, 0.3]]
+
+    # Merged into its best column, whichever that is.
+    score_mat[2] = [0.5, 0.6]
+    edges = hierarchy.match_model_orders(score_mat, sign_mat)
+    assert [edge[2] for edge in edges] == ['match', 'match', 'merge']
+    assert edges[2][:2] == [2, 0]
+
+    # json-able, as saved.
+    json.dumps(edges)
+
+
+def test_build_hierarchy(monkeypatch, tmpdir):
+    from nilearn_ext import masking
+    monkeypatch.chdir(str(tmpdir))
+    rng = np.random.RandomState(0)
+    base = rng.randn(6, 50)
+    data = {2: base[:2], 3: np.vstack([base[:2], -base[1] + 0.1 * base[5]])}
+    for n_components in data:
+        os.makedirs(op.join('ica_nii', 'neurovault', str(n_components)))
+        open(op.join('ica_nii', 'neurovault', str(n_components),
+                     'wb_ica_components.nii.gz'), 'w').close()
+    monkeypatch.setattr(hierarchy, 'load_components',
+                        lambda img_path, hemi: int(img_path.split(os.sep)[-2]))
+    monkeypatch.setattr(masking, 'get_masked_data', lambda n_components, hemi: data[n_components])
+
+    graph = hierarchy.build_hierarchy([3, 2], 'neurovault', hemis=('wb',))
+    assert graph['components'] == [2, 3]
+    (level,) = graph['hemis']['wb']
+    assert level['orders'] == [2, 3]
+    assert [edge[:4] for edge in level['edges']] == [
+        [0, 0, 'match', 1], [1, 1, 'match', 1], [1, 2, 'split', -1]]
+
+    out_path = hierarchy.save_hierarchy(graph, op.join('ica_imgs', 'neurovault', 'hierarchy.json'))
+    with open(out_path) as fp:
+        assert json.load(fp) == graph
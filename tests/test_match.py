@@ -0,0 +1,81 @@
+import os
+import os.path as op
+
+import numpy as np
+
+import match
+from nilearn_ext.utils import get_match_idx_pair
+
+
+def _get_mats():
+    # wb => R: rows 0 and 2 both match column 0, so column 1 is unmatched.
+    score_mats = {('wb', 'R'): np.array([[0.1, 0.5, 0.9],
+                                         [0.8, 0.7, 0.2],
+                                         [0.3, 0.6, 0.9]], dtype=np.float32),
+                  ('R', 'L'): np.array([[0.1, 0.9],
+                                        [0.9, 0.1]], dtype=np.float32)}
+    sign_mats = {('wb', 'R'): np.array([[1, -1, 1], [1, 1, -1], [-1, 1, 1]], dtype=np.int8),
+                 ('R', 'L'): np.array([[-1, 1], [1, 1]], dtype=np.int8)}
+    return score_mats, sign_mats
+
+
+def _assert_match_equal(result, expected):
+    for res, exp in zip(result, expected):
+        for key in ('idx', 'sign'):
+            if exp[key] is None:
+                assert res[key] is None
+            else:
+                np.testing.assert_array_equal(res[key], exp[key])
+                assert res[key].dtype == exp[key].dtype
+
+
+def test_save_load_match_results(tmpdir):
+    score_mats, sign_mats = _get_mats()
+    out_path = op.join(str(tmpdir), 'neurovault-matching_correlation.npz')
+    assert match.save_match_results(out_path, score_mats, sign_mats) == out_path
+    assert os.listdir(str(tmpdir)) == [op.basename(out_path)]
+
+    saved_mats = match.load_match_results(out_path)
+    loaded_scores, loaded_signs, matches = saved_mats
+    assert sorted(loaded_scores) == sorted(score_mats)
+    for comp in score_mats:
+        np.testing.assert_array_equal(loaded_scores[comp], score_mats[comp])
+        assert loaded_scores[comp].dtype == np.float32
+        np.testing.assert_array_equal(loaded_signs[comp], sign_mats[comp])
+        assert loaded_signs[comp].dtype == np.int8
+
+        for force_match in (True, False):
+            expected = get_match_idx_pair(score_mats[comp], sign_mats[comp], force=force_match)
+            _assert_match_equal(match.get_matches(list(comp), None, None, force_match,
+                                                  saved_mats=saved_mats), expected)
+    assert matches[(('wb', 'R'), 'unforced')][1]["idx"] is not None
+    assert matches[(('R', 'L'), 'unforced')][1]["idx"] is None
+
+
+def test_get_matches_computed():
+    score_mats, sign_mats = _get_mats()
+    comp = ('wb', 'R')
+    expected = get_match_idx_pair(score_mats[comp], sign_mats[comp], force=True)
+    # Not saved (or nothing saved): computed.
+    for saved_mats in (None, (dict(), dict(), dict())):
+        _assert_match_equal(match.get_matches(comp, score_mats[comp], sign_mats[comp], True,
+                                              saved_mats=saved_mats), expected)
+
+
+def test_load_saved_match_results(tmpdir):
+    nii_dir = str(tmpdir)
+    score_mats, sign_mats = _get_mats()
+    results_path = match.get_match_results_path(nii_dir, 'neurovault', 'correlation')
+    assert match.load_saved_match_results(nii_dir, 'neurovault', 'correlation') is None
+
+    match.save_match_results(results_path, score_mats, sign_mats)
+    img_path = op.join(nii_dir, 'wb_ica_components.nii.gz')
+    open(img_path, 'w').close()
+    mtime = op.getmtime(results_path)
+    os.utime(img_path, (mtime - 10, mtime - 10))
+    saved_mats = match.load_saved_match_results(nii_dir, 'neurovault', 'correlation')
+    assert sorted(saved_mats[0]) == sorted(score_mats)
+
+    # Components recomputed since: the saved results are stale.
+    os.utime(img_path, (mtime + 10, mtime + 10))
+    assert match.load_saved_match_results(nii_dir, 'neurovault', 'correlation') is None
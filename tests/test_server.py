@@ -0,0 +1,44 @@
+import numpy as np
+
+import server
+
+
+def test_run_job_unknown():
+    reply = server.run_job(dict(job='fit'), server.DATASET_SETTINGS)
+    assert not reply['ok']
+    assert 'Unknown job' in reply['error'] and 'match' in reply['error']
+    assert not server.run_job(dict(), server.DATASET_SETTINGS)['ok']
+
+
+def test_run_job_settings(monkeypatch):
+    calls = []
+
+    def echo(settings, n_components=20):
+        calls.append((settings, n_components))
+        return n_components
+
+    monkeypatch.setitem(server.JOBS, 'echo', echo)
+    settings = dict(server.DATASET_SETTINGS, resolution=4.)
+    reply = server.run_job(dict(job='echo', n_components=5, random_state=1,
+                                max_images=None), settings)
+    assert reply['ok'] and reply['result'] == 5 and reply['seconds'] >= 0
+
+    # Job settings override the server's, for this job only.
+    job_settings, n_components = calls[0]
+    assert job_settings == dict(settings, random_state=1, max_images=np.inf)
+    assert settings['random_state'] == 42
+
+
+def test_run_job_error(monkeypatch):
+    def fail(settings, **kwargs):
+        raise ValueError("No wb components")
+
+    monkeypatch.setitem(server.JOBS, 'fail', fail)
+    reply = server.run_job(dict(job='fail'), server.DATASET_SETTINGS)
+    assert not reply['ok']
+    assert 'ValueError: No wb components' in reply['error']
+
+    # Unexpected job parameters are errors too.
+    monkeypatch.setitem(server.JOBS, 'plot', lambda settings, n_components=20: None)
+    reply = server.run_job(dict(job='plot', bogus=1), server.DATASET_SETTINGS)
+    assert not reply['ok'] and 'bogus' in reply['error']